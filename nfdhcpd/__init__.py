@@ -25,6 +25,7 @@ server for virtual machine hosting.
 import os
 import signal
 import sys
+import time
 import logging
 import logging.handlers
 import traceback
@@ -64,6 +65,31 @@ pidfile = string()
 datapath = string()
 logdir = string()
 user = string()
+snapshot_file = string(default=None)
+snapshot_interval = integer(min=0, default=300)
+config_debounce = float(min=0, default=0.2)
+config_batch = integer(min=1, default=64)
+control_socket = string(default=None)
+binding_db = string(default=None)
+binding_db_poll = float(min=0, default=1.0)
+watchdog_threshold = float(min=0, default=1.0)
+reply_workers = integer(min=0, default=0)
+reply_queue = integer(min=1, default=1000)
+queue_budget = integer(min=1, default=10)
+dhcp_weight = integer(min=1, default=10)
+dhcpv6_weight = integer(min=1, default=1)
+rs_weight = integer(min=1, default=1)
+ns_weight = integer(min=1, default=1)
+load_shedding = boolean(default=True)
+tx_queue = integer(min=0, default=32)
+ingress = option('nfqueue', 'packet', default='nfqueue')
+capture_interfaces = force_list(default=None)
+capture_frames = integer(min=1, default=1024)
+reply_cache_ttl = float(min=0, default=2.0)
+reply_cache_size = integer(min=1, default=4096)
+track_links = boolean(default=True)
+stats_interval = integer(min=0, default=300)
+dump_file = string(default=None)
 
 [dhcp]
 enable_dhcp = boolean(default=True)
@@ -74,6 +100,7 @@ server_on_link = boolean(default=False)
 dhcp_queue = integer(min=0, max=65535)
 nameservers = ip_addr_list(family=4)
 domain = string(default=None)
+renewal_jitter = float(min=0, max=1, default=0)
 
 [ipv6]
 enable_ipv6 = boolean(default=True)
@@ -85,6 +112,8 @@ dhcp_queue = integer(min=0, max=65535, default=None)
 dhcpv6_queue = integer(min=0, max=65535, default=None)
 nameservers = ip_addr_list(family=6)
 domains = force_list(default=None)
+proxy_ndp = boolean(default=False)
+ra_multicast = boolean(default=False)
 """
 
 
@@ -112,6 +141,7 @@ def is_ip_list(value, family=4):
 
 def main():
     """Main nfdhcpd entry point"""
+    startup = time.time()
     validator = validate.Validator()
 
     validator.functions["ip_addr_list"] = is_ip_list
@@ -229,7 +259,33 @@ def main():
     logging.info("Running as %s (uid:%d, gid: %d)",
                  config["general"]["user"], uid.pw_uid, uid.pw_gid)
 
-    proxy_opts = {}
+    proxy_opts = {
+        "snapshot_file": config["general"]["snapshot_file"],
+        "snapshot_interval": config["general"].as_int("snapshot_interval"),
+        "config_debounce": config["general"].as_float("config_debounce"),
+        "config_batch": config["general"].as_int("config_batch"),
+        "control_socket": config["general"]["control_socket"],
+        "binding_db": config["general"]["binding_db"],
+        "binding_db_poll": config["general"].as_float("binding_db_poll"),
+        "watchdog_threshold":
+            config["general"].as_float("watchdog_threshold"),
+        "reply_workers": config["general"].as_int("reply_workers"),
+        "reply_queue": config["general"].as_int("reply_queue"),
+        "queue_budget": config["general"].as_int("queue_budget"),
+        "queue_weights": dict(
+            (q, config["general"].as_int("%s_weight" % q))
+            for q in ("dhcp", "dhcpv6", "rs", "ns")),
+        "load_shedding": config["general"].as_bool("load_shedding"),
+        "tx_queue": config["general"].as_int("tx_queue"),
+        "ingress": config["general"]["ingress"],
+        "capture_interfaces": config["general"]["capture_interfaces"],
+        "capture_frames": config["general"].as_int("capture_frames"),
+        "reply_cache_ttl": config["general"].as_float("reply_cache_ttl"),
+        "reply_cache_size": config["general"].as_int("reply_cache_size"),
+        "track_links": config["general"].as_bool("track_links"),
+        "stats_interval": config["general"].as_int("stats_interval"),
+        "dump_file": config["general"]["dump_file"],
+    }
     if config["dhcp"].as_bool("enable_dhcp"):
         proxy_opts.update({
             "dhcp_queue_num": config["dhcp"].as_int("dhcp_queue"),
@@ -239,6 +295,7 @@ def main():
             "dhcp_server_on_link": config["dhcp"]["server_on_link"],
             "dhcp_nameservers": config["dhcp"]["nameservers"],
             "dhcp_domain": config["dhcp"]["domain"],
+            "dhcp_renewal_jitter": config["dhcp"].as_float("renewal_jitter"),
         })
 
     if config["ipv6"].as_bool("enable_ipv6"):
@@ -306,6 +363,8 @@ def main():
             {"ra_period": config["ipv6"].as_int("ra_period"),
              "ipv6_nameservers": config["ipv6"]["nameservers"],
              "dhcpv6_domains": config["ipv6"]["domains"],
+             "proxy_ndp": config["ipv6"].as_bool("proxy_ndp"),
+             "ra_multicast": config["ipv6"].as_bool("ra_multicast"),
              "ipv6_mode": mode,
              "rs_queue_num": int(queues['rs']) if queues['rs'] else None,
              "ns_queue_num": int(queues['ns']) if queues['ns'] else None,
@@ -315,14 +374,15 @@ def main():
     # pylint: disable=star-args
     proxy = VMNetProxy(data_path=config["general"]["datapath"], **proxy_opts)
 
-    logging.info("Ready to serve requests")
+    logging.info("Ready to serve requests (startup took %.2f seconds)",
+                 time.time() - startup)
 
     def debug_handler(signum, _):
         """ Signal handler that will print the state of the server
 
         """
-        logging.debug('Received signal %d. Printing proxy state...', signum)
-        proxy.print_clients()
+        logging.debug('Received signal %d. Dumping proxy state...', signum)
+        proxy.dump_clients()
 
     # Set the signal handler for debuging clients
     signal.signal(signal.SIGUSR1, debug_handler)
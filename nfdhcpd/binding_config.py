@@ -18,18 +18,171 @@
 """Module for manipulating nfdhcpd client binding configurations"""
 
 import os
+import sys
+import time
+import errno
+import json
 import logging
 import socket
+import weakref
+import threading
 import IPy
 
-from scapy.data import ETH_P_ALL
-from scapy.packet import BasePacket
+# From linux/if_ether.h, so that we do not need to import scapy here
+ETH_P_ALL = 0x0003
+
+# Binding files with this suffix hold many bindings, one JSON object per line
+MANIFEST_SUFFIX = ".manifest"
+
+# Answered requests remembered per binding, see mark_answered()
+MAX_ANSWERED = 16
+
+# Serializes replacing failed sockets, which may happen from any thread
+_SOCKET_LOCK = threading.Lock()
+
+# Guards the reply parts and answered requests of all bindings, which the
+# reply workers update too
+_STATE_LOCK = threading.Lock()
+
+# Attributes that fully describe a binding, as found in a binding file
+BINDING_FIELDS = ("tap", "indev", "mac", "ip", "hostname", "subnet", "gateway",
+                  "subnet6", "gateway6", "eui64", "macspoof", "mtu", "private")
+
+
+def is_manifest(path):
+    """ Returns True if path is a manifest of bindings
+
+    """
+    return path.endswith(MANIFEST_SUFFIX)
+
+
+def read_manifest(path, known=None):
+    """ Reads a manifest file and returns a dictionary mapping every tap to
+    the raw line describing its binding
+
+    known maps lines already read to their tap, so that only new lines need
+    to be parsed. Malformed lines are logged and skipped. Raises
+    EnvironmentError if the file cannot be read.
+
+    """
+    logging.info("Parsing binding manifest %s", path)
+    known = known or {}
+    ret = {}
+    f = open(path, 'r')
+    try:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line in known:
+                ret[known[line]] = line
+                continue
+            try:
+                tap = str(json.loads(line)["tap"])
+            except (ValueError, KeyError, TypeError) as e:
+                logging.warn(" - Malformed line %d in %s: %s", lineno, path,
+                             str(e))
+                continue
+            ret[tap] = line
+    finally:
+        f.close()
+    return ret
+
+
+def _intern(value):
+    """ Interns strings that are expected to be shared among bindings
+
+    """
+    if isinstance(value, str):
+        return intern(value)
+    return value
+
+
+def pack_mac(mac):
+    """ Converts a textual MAC address to its 6 byte binary form
+
+    """
+    if mac is None:
+        return None
+    parts = mac.split(":")
+    try:
+        if len(parts) != 6:
+            raise ValueError
+        return "".join(chr(int(p, 16)) for p in parts)
+    except ValueError:
+        raise ValueError("Invalid MAC address %s" % mac)
+
+
+def unpack_mac(packed):
+    """ Converts a binary MAC address to its textual form
+
+    """
+    if packed is None:
+        return None
+    return ":".join("%02x" % ord(c) for c in packed)
+
+
+def pack_ip(ip, family=socket.AF_INET):
+    """ Converts a textual IP address to its binary form
+
+    """
+    if ip is None:
+        return None
+    try:
+        return socket.inet_pton(family, ip)
+    except socket.error:
+        raise ValueError("Invalid IP address %s" % ip)
+
+
+def unpack_ip(packed, family=socket.AF_INET):
+    """ Converts a binary IP address to its textual form
+
+    """
+    if packed is None:
+        return None
+    return socket.inet_ntop(family, packed)
+
+
+def bytes2int(packed):
+    """ Converts a binary address to an integer
+
+    """
+    return int(packed.encode("hex"), 16)
+
+
+def int2bytes(value, length=16):
+    """ Converts an integer to a binary address of the given length
+
+    """
+    return ("%0*x" % (length * 2, value)).decode("hex")
+
+
+def make_eui64(prefix, mac):
+    """ Compute the binary EUI-64 address of an EUI-48 (MAC) address in the
+    /64 network given as an integer
+
+    """
+    if mac is None:
+        return None
+    m = [ord(c) for c in pack_mac(mac)]
+    iid = ((m[0] ^ 0x02) << 56 | m[1] << 48 | m[2] << 40 | 0xfffe << 24 |
+           m[3] << 16 | m[4] << 8 | m[5])
+    return int2bytes((prefix >> 64) << 64 | iid)
+
+
+LINK_LOCAL_PREFIX = 0xfe80 << 112
 
 
 class Subnet(object):
     """ Represents an IP subnet
 
     """
+    __slots__ = ("net", "gw", "dev", "netmask", "broadcast", "prefix",
+                 "prefixlen", "family", "net_int", "mask_int", "__weakref__")
+
+    # Instances shared among bindings, see Subnet.shared()
+    _shared = weakref.WeakValueDictionary()
+
     def __init__(self, net=None, gw=None, dev=None):
         if isinstance(net, str):
             try:
@@ -39,9 +192,40 @@ class Subnet(object):
                 raise e
         else:
             self.net = net
-        self.gw = gw
+        self.gw = _intern(gw)
         self.dev = dev
 
+        # Everything needed while serving requests is derived here once, so
+        # that IPy is only used while loading the configuration
+        if self.net is None:
+            self.netmask = self.broadcast = self.prefix = None
+            self.prefixlen = self.family = self.net_int = self.mask_int = None
+        else:
+            self.netmask = str(self.net.netmask())
+            self.broadcast = str(self.net.broadcast())
+            self.prefix = str(self.net.net())
+            self.prefixlen = self.net.prefixlen()
+            if self.net.version() == 6:
+                self.family = socket.AF_INET6
+            else:
+                self.family = socket.AF_INET
+            self.net_int = self.net.net().int()
+            self.mask_int = self.net.netmask().int()
+
+    @classmethod
+    def shared(cls, net=None, gw=None):
+        """ Returns a Subnet instance shared by all callers asking for the
+        same network and gateway
+
+        """
+        key = (net, gw)
+        try:
+            return cls._shared[key]
+        except KeyError:
+            subnet = cls(net=net, gw=gw)
+            cls._shared[key] = subnet
+            return subnet
+
     def __getitem__(self, idx):
         """ Return the n-th address (network+idx) in the subnet (self.net)
 
@@ -51,81 +235,232 @@ class Subnet(object):
         else:
             return None
 
-    @property
-    def netmask(self):
-        """ Return the netmask in textual representation
-
-        """
-        return str(self.net.netmask())
-
-    @property
-    def broadcast(self):
-        """ Return the broadcast address in textual representation
+    def contains(self, packed):
+        """ Returns True if the binary address packed is in this subnet
 
         """
-        return str(self.net.broadcast())
+        if self.net is None:
+            return False
+        return bytes2int(packed) & self.mask_int == self.net_int
 
-    @property
-    def prefix(self):
-        """ Return the network as an IPy.IP
+    def make_eui64(self, mac):
+        """ Compute the EUI-64 address of an EUI-48 (MAC) address in this
+        subnet
 
         """
-        return self.net.net()
-
-    @property
-    def prefixlen(self):
-        """ Return the prefix length as an integer
-
-        """
-        return self.net.prefixlen()
+        return unpack_ip(make_eui64(self.net_int, mac), socket.AF_INET6)
 
     @staticmethod
-    def _make_eui64(net, mac):
-        """ Compute an EUI-64 address from an EUI-48 (MAC) address
-
-        """
-        if mac is None:
-            return None
-        comp = mac.split(":")
-        prefix = IPy.IP(net).net().strFullsize().split(":")[:4]
-        eui64 = comp[:3] + ["ff", "fe"] + comp[3:]
-        eui64[0] = "%02x" % (int(eui64[0], 16) ^ 0x02)
-        for l in range(0, len(eui64), 2):
-            prefix += ["".join(eui64[l:l+2])]
-        return IPy.IP(":".join(prefix))
-
-    def make_ll64(self, mac):
+    def make_ll64(mac):
         """ Compute an IPv6 Link-local address from an EUI-48 (MAC) address
 
         """
-        return self._make_eui64("fe80::", mac)
+        return unpack_ip(make_eui64(LINK_LOCAL_PREFIX, mac), socket.AF_INET6)
 
 
 class BindingConfig(object):
     """ Represents a binding configuration of an nfdhcpd client
 
+    Addresses are kept in binary form and the subnets are shared among all
+    bindings on the same network, to keep the client table small on hosts
+    with many interfaces.
+
     """
+    __slots__ = ("_mac", "_mac_text", "_ip", "_eui64", "_ll64", "hostname",
+                 "indev", "indev_mac", "_indev_ll", "tap", "net", "net6",
+                 "socket", "macspoof", "mtu", "private", "ifindex",
+                 "reply_cache", "answered", "txqueue", "replies")
+
     def __init__(self, tap=None, indev=None,
                  mac=None, ip=None, hostname=None,
                  subnet=None, gateway=None,
                  subnet6=None, gateway6=None, eui64=None,
                  macspoof=None, mtu=None, private=None):
-        self.mac = mac
-        self.ip = ip
+        self._mac = pack_mac(mac)
+        # The MAC is compared on every packet, so its textual form is kept
+        # too; being interned, it is shared with the client table key
+        self._mac_text = _intern(unpack_mac(self._mac))
+        self._ip = pack_ip(ip)
         self.hostname = hostname
-        self.indev = indev
+        self.indev = _intern(indev)
         self.tap = tap
-        self.subnet = subnet
-        self.gateway = gateway
-        self.net = Subnet(net=subnet, gw=gateway, dev=tap)
-        self.subnet6 = subnet6
-        self.gateway6 = gateway6
-        self.net6 = Subnet(net=subnet6, gw=gateway6, dev=tap)
-        self.eui64 = eui64
+        self.net = Subnet.shared(net=_intern(subnet), gw=gateway)
+        self.net6 = Subnet.shared(net=_intern(subnet6), gw=gateway6)
+        self._eui64 = pack_ip(eui64, socket.AF_INET6)
+        self._ll64 = make_eui64(LINK_LOCAL_PREFIX, mac)
+        # Set by set_indev_mac() once the indev's address is known
+        self.indev_mac = None
+        self._indev_ll = None
+        self.socket = None
         self.open_socket()
-        self.macspoof = macspoof
+        self.macspoof = _intern(macspoof)
         self.mtu = mtu
-        self.private = private
+        self.private = _intern(private)
+        # Set by the server when the binding gets registered
+        self.ifindex = None
+        # Pre-encoded reply parts, see get_reply_part()
+        self.reply_cache = None
+        # Request key -> time of the last reply, see mark_answered()
+        self.answered = None
+        # Frames waiting for the socket to become writable, see
+        # nfdhcpd.transmit
+        self.txqueue = None
+        # Replies dispatched to the client
+        self.replies = 0
+
+    @property
+    def mac(self):
+        """ The MAC address of the client in textual representation
+
+        """
+        return self._mac_text
+
+    @property
+    def mac_bytes(self):
+        """ The MAC address of the client in binary form
+
+        """
+        return self._mac
+
+    @property
+    def ip(self):
+        """ The IPv4 address of the client in textual representation
+
+        """
+        return unpack_ip(self._ip)
+
+    @property
+    def eui64(self):
+        """ The IPv6 address of the client in textual representation
+
+        """
+        return unpack_ip(self._eui64, socket.AF_INET6)
+
+    @property
+    def ll64(self):
+        """ The link-local address of the client in textual representation
+
+        """
+        return unpack_ip(self._ll64, socket.AF_INET6)
+
+    @property
+    def ll64_bytes(self):
+        """ The link-local address of the client in binary form
+
+        """
+        return self._ll64
+
+    @property
+    def indev_ll(self):
+        """ The link-local address of the indev in textual representation
+
+        """
+        return unpack_ip(self._indev_ll, socket.AF_INET6)
+
+    @property
+    def indev_ll_bytes(self):
+        """ The link-local address of the indev in binary form
+
+        """
+        return self._indev_ll
+
+    def set_indev_mac(self, mac):
+        """ Stores the hardware address of the indev and derives its
+        link-local address
+
+        """
+        with _STATE_LOCK:
+            self.indev_mac = _intern(mac)
+            self._indev_ll = make_eui64(LINK_LOCAL_PREFIX, mac)
+            self.reply_cache = None
+
+    def get_reply_part(self, key):
+        """ Returns a reply part that only depends on this binding, as kept by
+        set_reply_part(), or None
+
+        """
+        with _STATE_LOCK:
+            if self.reply_cache is None:
+                return None
+            return self.reply_cache.get(key)
+
+    def set_reply_part(self, key, value):
+        """ Keeps a reply part that only depends on this binding
+
+        """
+        with _STATE_LOCK:
+            if self.reply_cache is None:
+                self.reply_cache = {}
+            self.reply_cache[key] = value
+
+    def mark_answered(self, key, window):
+        """ Records that a request identified by key (e.g. the target of an
+        NS) was just answered
+
+        Requests answered more than window seconds ago are forgotten, and at
+        most MAX_ANSWERED requests are remembered, since a client may ask
+        for any number of distinct targets.
+
+        """
+        now = time.time()
+        with _STATE_LOCK:
+            if self.answered is None:
+                self.answered = {}
+            elif len(self.answered) >= MAX_ANSWERED:
+                self.answered = dict((k, t) for k, t in self.answered.items()
+                                     if now - t < window)
+                if len(self.answered) >= MAX_ANSWERED:
+                    del self.answered[min(self.answered,
+                                          key=self.answered.get)]
+            self.answered[key] = now
+
+    def answered_within(self, key, window):
+        """ Tells if a request identified by key was answered during the last
+        window seconds
+
+        """
+        with _STATE_LOCK:
+            if self.answered is None:
+                return False
+            answered = self.answered.get(key, 0)
+        return time.time() - answered < window
+
+    @property
+    def subnet(self):
+        """ The IPv4 subnet as found in the binding file
+
+        """
+        return self._subnet_str(self.net)
+
+    @property
+    def gateway(self):
+        """ The IPv4 gateway as found in the binding file
+
+        """
+        return self.net.gw
+
+    @property
+    def subnet6(self):
+        """ The IPv6 subnet as found in the binding file
+
+        """
+        return self._subnet_str(self.net6)
+
+    @property
+    def gateway6(self):
+        """ The IPv6 gateway as found in the binding file
+
+        """
+        return self.net6.gw
+
+    @staticmethod
+    def _subnet_str(subnet):
+        """ Returns the textual representation of a subnet or None
+
+        """
+        if subnet.net is None:
+            return None
+        return subnet.net.strCompressed(1)
 
     def is_valid(self):
         """ Returns True if this binding configuration is valid
@@ -146,22 +481,48 @@ class BindingConfig(object):
             self.socket = s
         except socket.error as e:
             logging.warning(" - Cannot open socket %s", e)
+            self.socket = None
+
+    def close_socket(self):
+        """ Closes the socket of the binding, if any
+
+        """
+        sock, self.socket = self.socket, None
+        if sock is not None:
+            sock.close()
+
+    def reopen_socket(self, failed):
+        """ Replaces the socket failed with a new one, unless another thread
+        already did
+
+        """
+        with _SOCKET_LOCK:
+            if self.socket is failed:
+                self.close_socket()
+                self.open_socket()
 
     def sendp(self, data):
         """ Sends data to the client this binding refers to
 
         """
-        if isinstance(data, BasePacket):
+        if not isinstance(data, str):
+            # A scapy packet that needs to be encoded
             data = str(data)
 
         # logging.debug(" - Sending raw packet %r", data)
 
+        sock = self.socket
         try:
-            count = self.socket.send(data, socket.MSG_DONTWAIT)
+            if sock is None:
+                raise socket.error(errno.EBADF, "No socket for %s" % self.tap)
+            count = sock.send(data, socket.MSG_DONTWAIT)
         except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.ENOBUFS):
+                # The socket is fine, its buffer is just full
+                logging.debug(" - Send on %s would block", self.tap)
+                raise
             logging.warn(" - Send with MSG_DONTWAIT failed: %s", str(e))
-            self.socket.close()
-            self.open_socket()
+            self.reopen_socket(sock)
             raise e
 
         ldata = len(data)
@@ -179,6 +540,75 @@ class BindingConfig(object):
             ret += ", eui64 %s" % self.eui64
         return ret
 
+    def to_dict(self):
+        """ Returns a serializable representation of this binding
+
+        """
+        ret = dict((f, getattr(self, f)) for f in BINDING_FIELDS)
+        ret["ifindex"] = self.ifindex
+        return ret
+
+    def state(self):
+        """ Returns a serializable representation of this binding along with
+        its derived addresses, socket state and counters
+
+        """
+        ret = self.to_dict()
+        answered = dict(self.answered or {})
+        sock = self.socket
+        try:
+            fd = sock.fileno() if sock is not None else None
+        except socket.error:
+            fd = "closed"
+        ret.update({
+            "ll64": self.ll64,
+            "indev_mac": self.indev_mac,
+            "indev_ll": self.indev_ll,
+            "socket": fd,
+            "tx_queued": len(self.txqueue or ()),
+            "replies": self.replies,
+            "answered": dict((" ".join(str(k) for k in key)
+                              if isinstance(key, tuple) else key, t)
+                             for key, t in answered.items()),
+        })
+        return ret
+
+    def memory_usage(self, seen):
+        """ Returns the number of bytes used by this binding
+
+        Objects whose id is in seen (e.g. shared subnets) are not accounted
+        for again.
+
+        """
+        total = 0
+        objs = [self, self.net, self.net6, self.net.net, self.net6.net,
+                self.socket]
+        objs.extend(getattr(self, attr) for attr in self.__slots__)
+        for obj in objs:
+            if obj is None or id(obj) in seen:
+                continue
+            seen.add(id(obj))
+            total += sys.getsizeof(obj)
+            if hasattr(obj, "__dict__"):
+                total += sys.getsizeof(obj.__dict__)
+        return total
+
+    @staticmethod
+    def from_dict(data):
+        """ Creates a binding from the output of to_dict()
+
+        """
+        kwargs = {}
+        for f in BINDING_FIELDS:
+            v = data.get(f)
+            # json gives us unicode strings back
+            if isinstance(v, unicode):
+                v = v.encode("utf-8")
+            kwargs[f] = v
+        binding = BindingConfig(**kwargs)
+        binding.ifindex = data.get("ifindex")
+        return binding
+
     @staticmethod
     def load(path):
         """ Reads a configuration binding file
@@ -249,8 +679,8 @@ class BindingConfig(object):
                                  subnet6=subnet6, gateway6=gateway6,
                                  eui64=eui64, macspoof=macspoof, mtu=mtu,
                                  private=private)
-        except ValueError:
+        except ValueError as e:
             logging.warning(
-                " - Cannot add client for host %s and IP %s on tap %s",
-                hostname, ip, tap)
+                " - Cannot add client for host %s and IP %s on tap %s: %s",
+                hostname, ip, tap, str(e))
             return None
@@ -0,0 +1,194 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Module for reading bindings from an SQLite database
+
+Writers insert, update and delete rows of the bindings table. Triggers stamp
+every change with an increasing sequence number (deletions, and the old tap
+of renamed rows, are recorded in the binding_deletions table), so that
+nfdhcpd only needs to fetch the rows that changed since it last looked.
+
+The database is polled from the main loop, so it is switched to WAL mode,
+where writers do not block readers, and nfdhcpd waits only briefly for
+locks, retrying on the next poll instead.
+
+"""
+
+import sqlite3
+import logging
+
+from nfdhcpd.binding_config import BINDING_FIELDS
+
+# Milliseconds to wait for a lock held by a writer while polling
+BUSY_TIMEOUT = 10
+
+COLUMNS = BINDING_FIELDS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bindings (
+    tap TEXT PRIMARY KEY,
+    indev TEXT,
+    mac TEXT,
+    ip TEXT,
+    hostname TEXT,
+    subnet TEXT,
+    gateway TEXT,
+    subnet6 TEXT,
+    gateway6 TEXT,
+    eui64 TEXT,
+    macspoof TEXT,
+    mtu INTEGER,
+    private TEXT,
+    ifindex INTEGER,
+    seq INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS bindings_mac ON bindings (mac);
+CREATE INDEX IF NOT EXISTS bindings_ifindex ON bindings (ifindex);
+CREATE INDEX IF NOT EXISTS bindings_seq ON bindings (seq);
+
+CREATE TABLE IF NOT EXISTS binding_deletions (
+    tap TEXT NOT NULL,
+    seq INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS binding_deletions_seq ON binding_deletions (seq);
+
+CREATE TABLE IF NOT EXISTS binding_seq (seq INTEGER NOT NULL);
+INSERT INTO binding_seq SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM binding_seq);
+
+CREATE TRIGGER IF NOT EXISTS bindings_insert AFTER INSERT ON bindings
+BEGIN
+    UPDATE binding_seq SET seq = seq + 1;
+    UPDATE bindings SET seq = (SELECT seq FROM binding_seq)
+        WHERE tap = NEW.tap;
+END;
+
+CREATE TRIGGER IF NOT EXISTS bindings_update AFTER UPDATE OF
+    tap, indev, mac, ip, hostname, subnet, gateway, subnet6, gateway6, eui64,
+    macspoof, mtu, private, ifindex ON bindings
+BEGIN
+    UPDATE binding_seq SET seq = seq + 1;
+    UPDATE bindings SET seq = (SELECT seq FROM binding_seq)
+        WHERE tap = NEW.tap;
+END;
+
+CREATE TRIGGER IF NOT EXISTS bindings_delete AFTER DELETE ON bindings
+BEGIN
+    UPDATE binding_seq SET seq = seq + 1;
+    INSERT INTO binding_deletions (tap, seq)
+        SELECT OLD.tap, seq FROM binding_seq;
+END;
+
+CREATE TRIGGER IF NOT EXISTS bindings_rename AFTER UPDATE OF tap ON bindings
+    WHEN OLD.tap != NEW.tap
+BEGIN
+    UPDATE binding_seq SET seq = seq + 1;
+    INSERT INTO binding_deletions (tap, seq)
+        SELECT OLD.tap, seq FROM binding_seq;
+END;
+"""
+
+
+def is_busy(error):
+    """ Tells if an SQLite error means that a writer holds a lock
+
+    """
+    return isinstance(error, sqlite3.OperationalError) and \
+        ("locked" in str(error) or "busy" in str(error))
+
+
+class BindingDatabase(object):
+    """ Read access to the bindings kept in an SQLite database
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.text_factory = str
+        try:
+            self.conn.execute("PRAGMA journal_mode = WAL")
+        except sqlite3.Error as e:
+            logging.warn("Cannot switch binding database to WAL mode: %s",
+                         str(e))
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+        # Waiting for writers is fine on startup, but not while polling
+        self.conn.execute("PRAGMA busy_timeout = %d" % BUSY_TIMEOUT)
+        logging.info("Using binding database %s", path)
+
+    def close(self):
+        """ Closes the database connection
+
+        """
+        self.conn.close()
+
+    def _row_to_dict(self, row):
+        """ Converts a row of the bindings table to BindingConfig.to_dict()
+        form
+
+        """
+        return dict(zip(COLUMNS, row))
+
+    def load(self):
+        """ Returns the current sequence number and all bindings
+
+        """
+        cur = self.conn.cursor()
+        # Both reads have to see the same snapshot of the database
+        cur.execute("BEGIN")
+        try:
+            cur.execute("SELECT seq FROM binding_seq")
+            seq = cur.fetchone()[0]
+            cur.execute("SELECT %s FROM bindings" % ", ".join(COLUMNS))
+            bindings = [self._row_to_dict(r) for r in cur.fetchall()]
+        finally:
+            self.conn.rollback()
+        return seq, bindings
+
+    def changes(self, since, limit):
+        """ Returns up to limit changes after sequence number since
+
+        Each change is a (seq, tap, binding) tuple, where binding is None for
+        deleted bindings.
+
+        """
+        cur = self.conn.cursor()
+        cur.execute("BEGIN")
+        try:
+            cur.execute("SELECT seq, %s FROM bindings WHERE seq > ? "
+                        "ORDER BY seq LIMIT ?" % ", ".join(COLUMNS),
+                        (since, limit))
+            changes = [(r[0], r[1], self._row_to_dict(r[1:]))
+                       for r in cur.fetchall()]
+            cur.execute("SELECT seq, tap FROM binding_deletions "
+                        "WHERE seq > ? ORDER BY seq LIMIT ?", (since, limit))
+            changes.extend((r[0], r[1], None) for r in cur.fetchall())
+        finally:
+            self.conn.rollback()
+
+        changes.sort()
+        return changes[:limit]
+
+    def prune_deletions(self, seq):
+        """ Forgets the deletions up to sequence number seq
+
+        """
+        try:
+            self.conn.execute("DELETE FROM binding_deletions WHERE seq <= ?",
+                              (seq,))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logging.debug(" - Cannot prune binding deletions: %s", e)
@@ -0,0 +1,105 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Module for persisting the parsed client table across daemon restarts"""
+
+import os
+import json
+import time
+import logging
+import tempfile
+
+SNAPSHOT_VERSION = 1
+
+
+def file_stat(path):
+    """ Returns the (mtime, size, inode) tuple used to detect changes of a
+    binding file, or None if the file cannot be stat'ed
+
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+
+def save_snapshot(path, entries):
+    """ Atomically writes a snapshot of the client table to path
+
+    Every entry is a dictionary holding the serialized binding along with the
+    stat information of the file it was parsed from.
+
+    """
+    data = {
+        "version": SNAPSHOT_VERSION,
+        "timestamp": time.time(),
+        "entries": entries,
+    }
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=".nfdhcpd-snapshot.", dir=dirname)
+    try:
+        f = os.fdopen(fd, "w")
+        try:
+            json.dump(data, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp, path)
+    except:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+    logging.debug(" - Wrote snapshot of %d bindings to %s", len(entries),
+                  path)
+
+
+def load_snapshot(path):
+    """ Reads a snapshot previously written by save_snapshot()
+
+    Returns the list of entries or None if the snapshot is missing, unreadable
+    or was written by an incompatible version.
+
+    """
+    try:
+        f = open(path, "r")
+    except EnvironmentError as e:
+        logging.info(" - No usable binding snapshot at %s: %s", path, str(e))
+        return None
+
+    try:
+        data = json.load(f)
+    except ValueError as e:
+        logging.warn(" - Corrupted binding snapshot %s: %s", path, str(e))
+        return None
+    finally:
+        f.close()
+
+    if not isinstance(data, dict) or \
+            data.get("version") != SNAPSHOT_VERSION:
+        logging.warn(" - Ignoring binding snapshot %s with unknown version",
+                     path)
+        return None
+
+    logging.info(" - Loaded binding snapshot %s from %s (%d entries)", path,
+                 time.ctime(data.get("timestamp", 0)),
+                 len(data.get("entries", [])))
+    return data.get("entries", [])
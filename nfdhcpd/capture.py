@@ -0,0 +1,322 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Module for capturing requests with AF_PACKET sockets
+
+This is an alternative to NFQUEUE for hosts where the requests do not go
+through netfilter, or where the kernel does not need to drop them. A classic
+BPF filter lets only DHCP, RS, NS and DHCPv6 requests through to a memory
+mapped receive ring (PACKET_RX_RING), and every captured frame is handed to
+the same handlers as the NFQUEUE packets, wrapped in a CapturedPacket.
+
+"""
+
+import os
+import mmap
+import time
+import ctypes
+import socket
+import struct
+import logging
+import collections
+
+from nfdhcpd.binding_config import ETH_P_ALL
+
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_ORIGDEV = 9
+PACKET_VERSION = 10
+TPACKET_V2 = 1
+SO_ATTACH_FILTER = 26
+
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+PACKET_OUTGOING = 4
+
+FRAME_SIZE = 2048
+BLOCK_SIZE = 1 << 16
+# Size of struct tpacket2_hdr, which is followed by struct sockaddr_ll
+TPACKET2_HDRLEN = 32
+
+# Bridged frames are seen both on the port and on the bridge when capturing
+# on all interfaces; a frame seen again within DUP_WINDOW seconds, among the
+# last DUP_FRAMES frames, is such a copy
+DUP_FRAMES = 16
+DUP_WINDOW = 0.05
+
+ETH_HLEN = 14
+ETH_P_IP = 0x0800
+ETH_P_IPV6 = 0x86dd
+IPPROTO_UDP = 17
+IPPROTO_ICMPV6 = 58
+ND_ROUTER_SOLICIT = 133
+ND_NEIGHBOR_SOLICIT = 135
+DHCP_SERVER_PORT = 67
+DHCPV6_SERVER_PORT = 547
+
+# Accepts IPv4 UDP to port 67, ICMPv6 RS and NS and IPv6 UDP to port 547,
+# as (code, jt, jf, k) classic BPF instructions
+BPF_FILTER = [
+    (0x28, 0, 0, 12),                       # ldh [12] (ethertype)
+    (0x15, 0, 7, ETH_P_IP),                 # jeq IPv4 else 9
+    (0x30, 0, 0, 23),                       # ldb [23] (protocol)
+    (0x15, 0, 15, IPPROTO_UDP),             # jeq UDP else drop
+    (0x28, 0, 0, 20),                       # ldh [20] (fragment offset)
+    (0x45, 13, 0, 0x1fff),                  # jset fragment then drop
+    (0xb1, 0, 0, 14),                       # ldxb 4 * ([14] & 0xf)
+    (0x48, 0, 0, 16),                       # ldh [x + 16] (UDP dport)
+    (0x15, 9, 10, DHCP_SERVER_PORT),        # jeq 67 accept else drop
+    (0x15, 0, 9, ETH_P_IPV6),               # 9: jeq IPv6 else drop
+    (0x30, 0, 0, 20),                       # ldb [20] (next header)
+    (0x15, 0, 3, IPPROTO_ICMPV6),           # jeq ICMPv6 else 15
+    (0x30, 0, 0, 54),                       # ldb [54] (ICMPv6 type)
+    (0x15, 4, 0, ND_ROUTER_SOLICIT),        # jeq RS accept
+    (0x15, 3, 4, ND_NEIGHBOR_SOLICIT),      # jeq NS accept else drop
+    (0x15, 0, 3, IPPROTO_UDP),              # 15: jeq UDP else drop
+    (0x28, 0, 0, 56),                       # ldh [56] (UDP dport)
+    (0x15, 0, 1, DHCPV6_SERVER_PORT),       # jeq 547 accept else drop
+    (0x06, 0, 0, 0x40000),                  # accept
+    (0x06, 0, 0, 0),                        # drop
+]
+
+
+def attach_filter(sock, program):
+    """ Attaches a classic BPF program to a socket
+
+    """
+    code = "".join(struct.pack("HBBI", *insn) for insn in program)
+    buf = ctypes.create_string_buffer(code, len(code))
+    fprog = struct.pack("HL", len(program), ctypes.addressof(buf))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+def classify(frame):
+    """ Returns the kind of request ("dhcp", "rs", "ns" or "dhcpv6") an
+    Ethernet frame carries, or None
+
+    """
+    if len(frame) < ETH_HLEN + 20:
+        return None
+    ethertype = struct.unpack("!H", frame[12:14])[0]
+    if ethertype == ETH_P_IP:
+        return "dhcp"
+    if ethertype != ETH_P_IPV6 or len(frame) < ETH_HLEN + 41:
+        return None
+    nh = ord(frame[20])
+    if nh == IPPROTO_UDP:
+        return "dhcpv6"
+    if nh == IPPROTO_ICMPV6:
+        icmp_type = ord(frame[54])
+        if icmp_type == ND_ROUTER_SOLICIT:
+            return "rs"
+        if icmp_type == ND_NEIGHBOR_SOLICIT:
+            return "ns"
+    return None
+
+
+class CapturedPacket(object):
+    """ A captured frame, with the interface of the NFQUEUE payloads the
+    handlers expect
+
+    """
+    __slots__ = ("frame", "ifindex", "timestamp")
+
+    def __init__(self, frame, ifindex, timestamp=None):
+        self.frame = frame
+        self.ifindex = ifindex
+        self.timestamp = timestamp
+
+    def get_data(self):
+        """ Returns the network layer packet, like NFQUEUE does
+
+        """
+        return self.frame[ETH_HLEN:]
+
+    def get_physindev(self):
+        """ Returns the interface the frame was captured on
+
+        """
+        return self.ifindex
+
+    get_indev = get_physindev
+
+    def get_hwaddr(self):
+        """ Returns the source MAC address of the frame
+
+        """
+        return self.frame[6:12]
+
+    def get_timestamp(self):
+        """ Returns when the kernel received the frame, if known
+
+        """
+        return self.timestamp
+
+    def set_verdict(self, verdict):
+        """ Captured frames are copies, so there is nothing to decide
+
+        """
+        pass
+
+
+class PacketCapture(object):
+    """ Captures requests on an interface, or on all interfaces if iface is
+    None
+
+    Implements the process_pending() and close() methods of the NFQUEUE
+    queues, so that it can be scheduled along with them.
+
+    With PACKET_ORIGDEV frames received through stacked devices, like bonds,
+    carry the index of the device they came in from. Bridges pass frames up
+    as new ones though, so frames captured on a bridge carry the index of
+    the bridge and the server finds their client by the source MAC.
+
+    """
+    def __init__(self, iface, callback, frames):
+        self.iface = iface
+        self.callback = callback
+        self.ring = None
+        self.index = 0
+        self.frame_nr = 0
+        # (frame, timestamp) of the last frames, see _duplicate()
+        self.recent = None
+        if iface is None:
+            self.recent = collections.deque(maxlen=DUP_FRAMES)
+
+        self.socket = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                                    socket.htons(ETH_P_ALL))
+        self.socket.setsockopt(SOL_PACKET, PACKET_ORIGDEV, 1)
+        attach_filter(self.socket, BPF_FILTER)
+        if iface:
+            self.socket.bind((iface, ETH_P_ALL))
+        self.socket.setblocking(0)
+
+        try:
+            self._setup_ring(frames)
+        except (socket.error, EnvironmentError) as e:
+            logging.warn("Cannot set up receive ring for %s, falling back to "
+                         "recvfrom(): %s", iface or "all interfaces", str(e))
+            self.ring = None
+        logging.info("Capturing requests on %s", iface or "all interfaces")
+
+    def _setup_ring(self, frames):
+        """ Sets up and maps a TPACKET_V2 receive ring for at least frames
+        frames
+
+        """
+        per_block = BLOCK_SIZE / FRAME_SIZE
+        block_nr = max(1, (frames + per_block - 1) / per_block)
+        self.frame_nr = block_nr * per_block
+        self.socket.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V2)
+        req = struct.pack("IIII", BLOCK_SIZE, block_nr, FRAME_SIZE,
+                          self.frame_nr)
+        self.socket.setsockopt(SOL_PACKET, PACKET_RX_RING, req)
+        self.ring = mmap.mmap(self.socket.fileno(), BLOCK_SIZE * block_nr,
+                              mmap.MAP_SHARED,
+                              mmap.PROT_READ | mmap.PROT_WRITE)
+
+    def fileno(self):
+        """ Returns the file descriptor of the capture socket
+
+        """
+        return self.socket.fileno()
+
+    def get_fd(self):
+        """ Returns the file descriptor to select() on, like NFQUEUE queues
+
+        """
+        return self.socket.fileno()
+
+    def close(self):
+        """ Unmaps the ring and closes the socket
+
+        """
+        if self.ring is not None:
+            self.ring.close()
+        self.socket.close()
+
+    def process_pending(self, count):
+        """ Hands up to count captured requests to the callback
+
+        Returns the number of frames processed.
+
+        """
+        if self.ring is None:
+            return self._process_recv(count)
+
+        done = 0
+        while done < count:
+            offset = self.index * FRAME_SIZE
+            status, _, snaplen, mac, _, sec, nsec = struct.unpack_from(
+                "IIIHHII", self.ring, offset)
+            if not status & TP_STATUS_USER:
+                break
+            ifindex, pkttype = struct.unpack_from(
+                "4xiHB", self.ring, offset + TPACKET2_HDRLEN)[0::2]
+            frame = self.ring[offset + mac:offset + mac + snaplen]
+            # Give the frame back to the kernel
+            self.ring[offset:offset + 4] = struct.pack("I", TP_STATUS_KERNEL)
+            self.index = (self.index + 1) % self.frame_nr
+            done += 1
+            timestamp = sec + nsec / 1e9
+            if pkttype != PACKET_OUTGOING and \
+                    not self._duplicate(frame, timestamp):
+                self.callback(CapturedPacket(frame, ifindex, timestamp))
+        return done
+
+    def _process_recv(self, count):
+        """ Hands up to count captured requests to the callback, without a
+        receive ring
+
+        """
+        done = 0
+        while done < count:
+            try:
+                frame, addr = self.socket.recvfrom(65535)
+            except socket.error:
+                break
+            done += 1
+            ifindex = self._ifindex(addr[0])
+            if addr[2] != PACKET_OUTGOING and \
+                    not self._duplicate(frame, time.time()):
+                self.callback(CapturedPacket(frame, ifindex))
+        return done
+
+    def _duplicate(self, frame, timestamp):
+        """ Tells if a frame is the copy of a bridged frame that was already
+        captured on the bridge port
+
+        """
+        if self.recent is None:
+            return False
+        for seen_frame, seen in self.recent:
+            if seen_frame == frame and abs(timestamp - seen) < DUP_WINDOW:
+                return True
+        self.recent.append((frame, timestamp))
+        return False
+
+    @staticmethod
+    def _ifindex(iface):
+        """ Returns the index of an interface, as found in sysfs
+
+        """
+        try:
+            with open(os.path.join("/sys/class/net", iface, "ifindex")) as f:
+                return int(f.read().strip())
+        except (EnvironmentError, ValueError):
+            return 0
@@ -0,0 +1,264 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Module hosting the copy-on-write client table
+
+The table is published as a dictionary that is never modified afterwards, so
+threads other than the main one can read it without locks. The main thread
+applies its changes to a private copy, which replaces the published one as a
+new generation when publish() is called, once per main loop iteration.
+
+Bindings that were removed from the table may still be used by readers of an
+older generation, so their sockets are only closed once those readers are
+done.
+
+"""
+
+import logging
+import threading
+import contextlib
+
+
+class ClientTable(object):
+    """ A table of bindings, read without locks and written by the main
+    thread
+
+    """
+    def __init__(self, on_release=None, alias=None, group=None):
+        # Called with every removed binding right before its socket is
+        # closed
+        self.on_release = on_release
+        # Returns the key bindings are also looked up by with get_alias(),
+        # e.g. the ifindex for a table keyed by MAC
+        self.alias = alias
+        # Alias -> binding, for the latest table
+        self.aliases = {}
+        # Returns the key bindings are grouped by for get_group(), e.g.
+        # their indev
+        self.group = group
+        # Group key -> set of bindings, for the latest table
+        self.groups = {}
+        # The published generation, which must never be modified
+        self.current = {}
+        self.generation = 0
+        # The next generation, while the main thread is changing the table
+        self.draft = None
+        # (generation, binding) of removed bindings, where generation is the
+        # first one they are not part of
+        self.retired = []
+        # Reader id -> generation it is reading
+        self.readers = {}
+        self.lock = threading.Lock()
+
+    def latest(self):
+        """ Returns the table including any unpublished changes, for use by
+        the main thread only
+
+        """
+        if self.draft is not None:
+            return self.draft
+        return self.current
+
+    def snapshot(self):
+        """ Returns the published table
+
+        """
+        return self.current
+
+    def __len__(self):
+        return len(self.latest())
+
+    def __contains__(self, key):
+        return key in self.latest()
+
+    def __getitem__(self, key):
+        return self.latest()[key]
+
+    def get(self, key, default=None):
+        """ Looks up a binding in the latest table
+
+        """
+        return self.latest().get(key, default)
+
+    def values(self):
+        """ Returns the bindings of the latest table
+
+        """
+        return self.latest().values()
+
+    def items(self):
+        """ Returns the (key, binding) pairs of the latest table
+
+        """
+        return self.latest().items()
+
+    def get_alias(self, key):
+        """ Looks up a binding in the latest table by its alias
+
+        """
+        return self.aliases.get(key)
+
+    def get_group(self, key):
+        """ Returns the bindings of the latest table in a group
+
+        """
+        return list(self.groups.get(key, ()))
+
+    def _index(self, binding):
+        """ Indexes a binding by its alias and group
+
+        """
+        if self.alias is not None:
+            self.aliases[self.alias(binding)] = binding
+        if self.group is not None:
+            self.groups.setdefault(self.group(binding), set()).add(binding)
+
+    def _unindex(self, binding):
+        """ Removes a binding from the alias index, unless another binding
+        took over its alias, and from its group
+
+        """
+        if self.alias is not None:
+            key = self.alias(binding)
+            if self.aliases.get(key) is binding:
+                del self.aliases[key]
+        if self.group is not None:
+            key = self.group(binding)
+            members = self.groups.get(key)
+            if members is not None:
+                members.discard(binding)
+                if not members:
+                    del self.groups[key]
+
+    def _draft(self):
+        """ Returns the next generation of the table, creating it if needed
+
+        """
+        if self.draft is None:
+            self.draft = dict(self.current)
+        return self.draft
+
+    def _retire(self, binding):
+        """ Schedules the socket of a removed binding to be closed
+
+        """
+        if binding.socket is not None:
+            self.retired.append((self.generation + 1, binding))
+
+    def __setitem__(self, key, binding):
+        draft = self._draft()
+        old = draft.get(key)
+        if old is not None and old is not binding:
+            self._retire(old)
+            self._unindex(old)
+        draft[key] = binding
+        self._index(binding)
+
+    def __delitem__(self, key):
+        binding = self._draft().pop(key)
+        self._retire(binding)
+        self._unindex(binding)
+
+    def clear(self):
+        """ Removes all bindings
+
+        """
+        draft = self._draft()
+        for binding in draft.values():
+            self._retire(binding)
+        draft.clear()
+        self.aliases.clear()
+        self.groups.clear()
+
+    def publish(self):
+        """ Makes all changes since the last call visible to the readers
+
+        """
+        if self.draft is not None:
+            with self.lock:
+                self.current = self.draft
+                self.generation += 1
+            self.draft = None
+            logging.debug(" - Published client table generation %d (%d "
+                          "bindings)", self.generation, len(self.current))
+        self.release_retired()
+
+    def release_retired(self):
+        """ Closes the sockets of removed bindings which no reader may use
+        anymore
+
+        """
+        if not self.retired:
+            return
+        with self.lock:
+            if self.readers:
+                oldest = min(self.readers.values())
+            else:
+                oldest = self.generation
+        keep = []
+        for generation, binding in self.retired:
+            if generation > oldest:
+                keep.append((generation, binding))
+                continue
+            if self.on_release:
+                self.on_release(binding)
+            binding.close_socket()
+        self.retired = keep
+
+    def acquire(self):
+        """ Registers a reader of the published table
+
+        Bindings removed after this call stay usable until release() is called
+        with the returned token, possibly from another thread.
+
+        """
+        token = object()
+        with self.lock:
+            self.readers[id(token)] = self.generation
+        return token
+
+    def release(self, token):
+        """ Unregisters a reader registered by acquire()
+
+        """
+        with self.lock:
+            del self.readers[id(token)]
+
+    @contextlib.contextmanager
+    def reader(self):
+        """ Context manager providing a consistent snapshot of the table,
+        whose bindings stay usable until the context exits
+
+        """
+        with self.lock:
+            # Register the generation along with the table it refers to
+            token = object()
+            table = self.current
+            self.readers[id(token)] = self.generation
+        try:
+            yield table
+        finally:
+            self.release(token)
+
+    def to_dict(self):
+        """ Returns the state of the table
+
+        """
+        with self.lock:
+            readers = len(self.readers)
+        return {"generation": self.generation, "readers": readers,
+                "retired": len(self.retired)}
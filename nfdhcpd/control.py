@@ -0,0 +1,254 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Module hosting the local control socket of nfdhcpd
+
+Clients connect to a Unix domain stream socket and send one JSON object per
+line. Every request gets a single line JSON reply with a "status" of either
+"ok" or "error". The supported requests are:
+
+ {"op": "add", "binding": {...}}        add or update a binding
+ {"op": "remove", "tap": "tap0"}        remove the binding of an interface
+ {"op": "replace", "bindings": [...]}   replace all bindings added through
+                                        the control socket
+ {"op": "get", "tap"|"mac"|"ip": ...}   look up bindings
+ {"op": "db_changed"}                   poll the binding database now
+ {"op": "stats"}                        get counters and measurements
+ {"op": "clients"}                      get the state of all clients
+
+Bindings are given in the form of BindingConfig.to_dict().
+
+"""
+
+import os
+import json
+import errno
+import socket
+import logging
+
+MAX_REQUEST_SIZE = 64 * 1024 * 1024
+RECV_SIZE = 65536
+
+
+class ControlConnection(object):
+    """ A client connection to the control socket
+
+    """
+    def __init__(self, sock):
+        self.socket = sock
+        self.inbuf = ""
+        self.outbuf = ""
+
+    def fileno(self):
+        """ Returns the file descriptor of the connection
+
+        """
+        return self.socket.fileno()
+
+
+class ControlServer(object):
+    """ Serves requests on the control socket from the main loop
+
+    """
+    def __init__(self, path, server, mode=0600):
+        self.path = path
+        self.server = server
+        self.connections = {}
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        os.chmod(path, mode)
+        self.socket.listen(16)
+        self.socket.setblocking(0)
+        logging.info("Listening for control requests on %s", path)
+
+    def fileno(self):
+        """ Returns the file descriptor of the listening socket
+
+        """
+        return self.socket.fileno()
+
+    def read_fds(self):
+        """ Returns all file descriptors to watch for reading
+
+        """
+        return [self.socket.fileno()] + self.connections.keys()
+
+    def write_fds(self):
+        """ Returns the file descriptors with pending replies
+
+        """
+        return [fd for fd, c in self.connections.items() if c.outbuf]
+
+    def close(self):
+        """ Closes all connections and removes the socket
+
+        """
+        for conn in self.connections.values():
+            conn.socket.close()
+        self.connections.clear()
+        self.socket.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def handle_read(self, fd):
+        """ Accepts a connection or reads requests from one
+
+        """
+        if fd == self.socket.fileno():
+            try:
+                sock, _ = self.socket.accept()
+            except socket.error as e:
+                logging.warn("Failed to accept control connection: %s", e)
+                return
+            sock.setblocking(0)
+            self.connections[sock.fileno()] = ControlConnection(sock)
+            return
+
+        conn = self.connections[fd]
+        try:
+            data = conn.socket.recv(RECV_SIZE)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ""
+        if not data:
+            self._drop(conn)
+            return
+
+        conn.inbuf += data
+        while "\n" in conn.inbuf:
+            line, conn.inbuf = conn.inbuf.split("\n", 1)
+            if line.strip():
+                conn.outbuf += json.dumps(self.process(line)) + "\n"
+
+        if len(conn.inbuf) > MAX_REQUEST_SIZE:
+            logging.warn("Dropping control connection with oversized request")
+            self._drop(conn)
+            return
+
+        self.handle_write(fd)
+
+    def handle_write(self, fd):
+        """ Sends as much of the pending replies as possible
+
+        """
+        conn = self.connections.get(fd)
+        if conn is None or not conn.outbuf:
+            return
+        try:
+            sent = conn.socket.send(conn.outbuf)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            self._drop(conn)
+            return
+        conn.outbuf = conn.outbuf[sent:]
+
+    def _drop(self, conn):
+        """ Closes a client connection
+
+        """
+        del self.connections[conn.fileno()]
+        conn.socket.close()
+
+    def process(self, line):
+        """ Processes a single request and returns the reply
+
+        """
+        try:
+            req = json.loads(line)
+            op = str(req["op"])
+        except (ValueError, KeyError, TypeError):
+            return {"status": "error", "error": "Malformed request"}
+        if not isinstance(req, dict):
+            return {"status": "error", "error": "Malformed request"}
+
+        handler = getattr(self, "op_%s" % op, None)
+        if handler is None:
+            return {"status": "error", "error": "Unknown op %s" % op}
+
+        try:
+            ret = handler(req)
+        except (ValueError, KeyError, TypeError) as e:
+            return {"status": "error", "error": str(e)}
+        except Exception as e:  # pylint: disable=W0703
+            # A bad request must never take down the main loop
+            logging.warn("Failed to process control request %s: %s", op,
+                         str(e))
+            return {"status": "error", "error": "Internal error"}
+
+        reply = {"status": "ok"}
+        if ret:
+            reply.update(ret)
+        return reply
+
+    def op_add(self, req):
+        """ Adds or updates a binding
+
+        """
+        if not self.server.add_control_binding(req["binding"]):
+            raise ValueError("Stale or invalid binding")
+
+    def op_remove(self, req):
+        """ Removes the binding of an interface
+
+        """
+        self.server.remove_control_binding(str(req["tap"]))
+
+    def op_replace(self, req):
+        """ Replaces all bindings added through the control socket
+
+        """
+        failed = self.server.replace_control_bindings(req["bindings"])
+        return {"failed": failed}
+
+    def op_get(self, req):
+        """ Looks up bindings by tap, MAC or IP address
+
+        """
+        for field in ("tap", "mac", "ip"):
+            if not isinstance(req.get(field), (basestring, type(None))):
+                raise TypeError("%s is not a string" % field)
+        bindings = self.server.find_bindings(tap=req.get("tap"),
+                                             mac=req.get("mac"),
+                                             ip=req.get("ip"))
+        return {"bindings": [b.to_dict() for b in bindings]}
+
+    def op_stats(self, _):
+        """ Returns the counters and measurements of the server
+
+        """
+        return {"stats": self.server.get_stats()}
+
+    def op_clients(self, _):
+        """ Returns the state of all clients, as in the dump file
+
+        """
+        return {"clients": self.server.get_client_states()}
+
+    def op_db_changed(self, _):
+        """ Notifies the server about changes in the binding database
+
+        """
+        if self.server.binding_db is None:
+            raise ValueError("No binding database configured")
+        self.server.binding_db_changed()
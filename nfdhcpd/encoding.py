@@ -0,0 +1,62 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Module with helpers for encoding reply frames from pre-encoded parts"""
+
+import struct
+
+from nfdhcpd.binding_config import pack_mac
+
+ETH_P_IPV6 = 0x86dd
+IPPROTO_UDP = 17
+DEFAULT_HOP_LIMIT = 64
+
+
+def checksum(data):
+    """ Computes the Internet checksum (RFC 1071) of data
+
+    """
+    if len(data) % 2:
+        data += "\0"
+    s = sum(struct.unpack("!%dH" % (len(data) / 2), data))
+    s = (s >> 16) + (s & 0xffff)
+    s += s >> 16
+    return ~s & 0xffff
+
+
+def ether_header(src, dst, ethertype=ETH_P_IPV6):
+    """ Encodes an Ethernet header for the given textual MAC addresses
+
+    """
+    return pack_mac(dst) + pack_mac(src) + struct.pack("!H", ethertype)
+
+
+def ipv6_udp_frame(eth, src, dst, sport, dport, payload, tc=0,
+                   hlim=DEFAULT_HOP_LIMIT):
+    """ Encodes an IPv6/UDP frame
+
+    eth is an already encoded Ethernet header and src, dst the binary IPv6
+    source and destination addresses.
+
+    """
+    ulen = 8 + len(payload)
+    pseudo = src + dst + struct.pack("!I3xB", ulen, IPPROTO_UDP)
+    udp = struct.pack("!HHHH", sport, dport, ulen, 0) + payload
+    csum = checksum(pseudo + udp) or 0xffff
+    ip = struct.pack("!IHBB", 6 << 28 | tc << 20, ulen, IPPROTO_UDP, hlim)
+    return (eth + ip + src + dst + udp[:6] + struct.pack("!H", csum) +
+            udp[8:])
@@ -0,0 +1,193 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Module for tracking the link state of interfaces through rtnetlink
+
+The monitor subscribes to link events and keeps whether each interface is
+administratively up and has carrier. Interfaces it knows nothing about are
+considered up. It also follows the hardware addresses of the interfaces,
+which change e.g. for bridges as ports come and go.
+
+"""
+
+import errno
+import socket
+import struct
+import logging
+
+from nfdhcpd.proxy_ndp import NETLINK_ROUTE, NLMSGHDR, NLM_F_REQUEST
+
+RTMGRP_LINK = 0x1
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+NLMSG_DONE = 3
+NLM_F_DUMP = 0x300
+
+IFINFOMSG = "BxHiII"
+IFF_UP = 0x1
+IFF_LOWER_UP = 0x10000
+
+RTATTR = "HH"
+IFLA_ADDRESS = 1
+IFLA_IFNAME = 3
+
+
+class LinkMonitor(object):
+    """ Keeps the link state of all interfaces up to date
+
+    callback(ifindex, up) is called whenever an interface goes up or down
+    and address_callback(ifname, address) whenever the hardware address of
+    an interface changes.
+
+    """
+    def __init__(self, callback, address_callback=None):
+        self.callback = callback
+        self.address_callback = address_callback
+        self.state = {}
+        # Interface name -> hardware address
+        self.addresses = {}
+        self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                    NETLINK_ROUTE)
+        self.socket.bind((0, RTMGRP_LINK))
+        self.socket.setblocking(0)
+        self.seq = 0
+        self.dump()
+
+    def fileno(self):
+        """ Returns the file descriptor of the netlink socket
+
+        """
+        return self.socket.fileno()
+
+    def close(self):
+        """ Closes the netlink socket
+
+        """
+        self.socket.close()
+
+    def dump(self):
+        """ Requests the state of all interfaces
+
+        """
+        self.seq += 1
+        body = struct.pack(IFINFOMSG, socket.AF_UNSPEC, 0, 0, 0, 0)
+        hdr = struct.pack(NLMSGHDR, struct.calcsize(NLMSGHDR) + len(body),
+                          RTM_GETLINK, NLM_F_REQUEST | NLM_F_DUMP, self.seq, 0)
+        self.socket.send(hdr + body)
+
+    def is_up(self, ifindex):
+        """ Tells if an interface is up and has carrier
+
+        """
+        return self.state.get(ifindex, True)
+
+    def handle_read(self):
+        """ Processes all pending link messages
+
+        """
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except socket.error as e:
+                if e.errno == errno.ENOBUFS:
+                    # We missed events, so get the full state again
+                    logging.warn("Link events overflow, dumping link state")
+                    self.dump()
+                    continue
+                if e.errno not in (errno.EAGAIN, errno.EINTR):
+                    logging.warn("Cannot read link events: %s", str(e))
+                return
+            if not data:
+                return
+            self._parse(data)
+
+    def _parse(self, data):
+        """ Parses a buffer of netlink messages
+
+        """
+        hdrlen = struct.calcsize(NLMSGHDR)
+        while len(data) >= hdrlen:
+            length, kind = struct.unpack_from(NLMSGHDR, data)[:2]
+            if length < hdrlen:
+                return
+            if kind in (RTM_NEWLINK, RTM_DELLINK):
+                _, _, ifindex, flags, _ = struct.unpack_from(IFINFOMSG, data,
+                                                             hdrlen)
+                attrs = self._attrs(data[hdrlen + struct.calcsize(IFINFOMSG):
+                                         length])
+                if kind == RTM_DELLINK:
+                    self.state.pop(ifindex, None)
+                    self.addresses.pop(attrs.get(IFLA_IFNAME), None)
+                else:
+                    up = flags & (IFF_UP | IFF_LOWER_UP) == \
+                        (IFF_UP | IFF_LOWER_UP)
+                    self._update(ifindex, up)
+                    if IFLA_IFNAME in attrs and IFLA_ADDRESS in attrs:
+                        self._update_address(attrs[IFLA_IFNAME],
+                                             attrs[IFLA_ADDRESS])
+            data = data[(length + 3) & ~3:]
+
+    @staticmethod
+    def _attrs(data):
+        """ Parses the name and address attributes of a link message
+
+        """
+        ret = {}
+        hdrlen = struct.calcsize(RTATTR)
+        while len(data) >= hdrlen:
+            length, kind = struct.unpack_from(RTATTR, data)
+            if length < hdrlen:
+                break
+            value = data[hdrlen:length]
+            if kind == IFLA_IFNAME:
+                ret[kind] = value.rstrip("\0")
+            elif kind == IFLA_ADDRESS:
+                ret[kind] = ":".join("%02x" % ord(c) for c in value)
+            data = data[(length + 3) & ~3:]
+        return ret
+
+    def _update(self, ifindex, up):
+        """ Records the state of an interface, notifying about changes
+
+        """
+        old = self.state.get(ifindex)
+        self.state[ifindex] = up
+        if old is not None and old != up:
+            logging.info("Link with ifindex %d went %s", ifindex,
+                         "up" if up else "down")
+            self.callback(ifindex, up)
+
+    def _update_address(self, ifname, address):
+        """ Records the hardware address of an interface, notifying about
+        changes
+
+        """
+        old = self.addresses.get(ifname)
+        self.addresses[ifname] = address
+        if old is not None and old != address:
+            logging.info("Hardware address of %s changed from %s to %s",
+                         ifname, old, address)
+            if self.address_callback:
+                self.address_callback(ifname, address)
+
+    def to_dict(self):
+        """ Returns the number of interfaces known up and down
+
+        """
+        up = sum(1 for s in self.state.itervalues() if s)
+        return {"up": up, "down": len(self.state) - up}
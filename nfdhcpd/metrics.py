@@ -0,0 +1,71 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Module with simple metrics kept by nfdhcpd"""
+
+import bisect
+
+# Upper bounds (in seconds) of the buckets of latency histograms
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+# Upper bounds of the buckets of histograms of fractions of a period
+PHASE_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9)
+
+
+class Histogram(object):
+    """ A histogram of observed values with fixed bucket boundaries
+
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # The last bucket holds the values above the highest boundary
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """ Records a value
+
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def to_dict(self):
+        """ Returns a serializable representation of the histogram
+
+        """
+        bounds = [str(b) for b in self.buckets] + ["+Inf"]
+        return {
+            "buckets": dict(zip(bounds, self.counts)),
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+        }
+
+    def __str__(self):
+        if not self.count:
+            return "no samples"
+        bounds = ["<=%s" % b for b in self.buckets] + \
+            [">%s" % self.buckets[-1]]
+        return "count %d, avg %.6f, max %.6f [%s]" % (
+            self.count, self.sum / self.count, self.max,
+            " ".join("%s:%d" % (b, c) for b, c in zip(bounds, self.counts)
+                     if c))
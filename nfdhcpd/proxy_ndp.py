@@ -0,0 +1,267 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Module for offloading neighbor discovery to the kernel
+
+For every routed binding with an IPv6 subnet a proxy neighbour entry for
+the gateway is installed on its tap through rtnetlink, so that the kernel
+answers the solicitations for the gateway itself, along with a permanent
+neighbour entry for the EUI-64 address of the client. Proxy entries only
+take effect when proxy_ndp and forwarding are enabled on the tap. Bridged
+taps are left alone, as their frames never reach the IPv6 stack of the tap.
+
+Requests are sent without waiting for the kernel to acknowledge them, and
+the acknowledgements are processed by handle_read() when the socket becomes
+readable, so that bindings can be added from the main loop without stalling
+it.
+
+"""
+
+import os
+import errno
+import socket
+import struct
+import logging
+
+NETLINK_ROUTE = 0
+
+NLMSG_ERROR = 2
+RTM_NEWNEIGH = 28
+RTM_DELNEIGH = 29
+
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_REPLACE = 0x100
+NLM_F_CREATE = 0x400
+
+NDA_DST = 1
+NDA_LLADDR = 2
+
+NUD_PERMANENT = 0x80
+NTF_PROXY = 0x08
+
+PROXY_NDP_SYSCTL = "/proc/sys/net/ipv6/conf/%s/proxy_ndp"
+
+# Requests sent before reading their acknowledgements
+MAX_PENDING = 256
+
+NLMSGHDR = "IHHII"
+NDMSG = "BxxxiHBB"
+NLMSGERR = "i"
+
+
+def rtattr(kind, data):
+    """ Encodes a netlink route attribute
+
+    """
+    length = 4 + len(data)
+    return struct.pack("HH", length, kind) + data + "\0" * (-length % 4)
+
+
+class NeighbourOffload(object):
+    """ Installs and removes the neighbour entries of the bindings
+
+    """
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                    NETLINK_ROUTE)
+        self.socket.bind((0, 0))
+        self.socket.setblocking(0)
+        self.seq = 0
+        # tap -> (ifindex, offloaded gateway, [(flags, address, lladdr)])
+        self.entries = {}
+        # seq -> (msg_type, tap, ifindex, ndm_flags) of the requests not
+        # acknowledged yet
+        self.pending = {}
+        self.errors = 0
+
+    def fileno(self):
+        """ Returns the file descriptor of the netlink socket
+
+        """
+        return self.socket.fileno()
+
+    def close(self):
+        """ Closes the netlink socket
+
+        """
+        self.socket.close()
+
+    def _neigh(self, msg_type, flags, ifindex, ndm_flags, address, lladdr,
+               tap):
+        """ Sends a neighbour request, whose acknowledgement is processed by
+        handle_read()
+
+        Returns False if the request could not be sent.
+
+        """
+        if len(self.pending) >= MAX_PENDING:
+            # Do not let acknowledgements overflow the socket buffer
+            self.handle_read()
+
+        self.seq += 1
+        body = struct.pack(NDMSG, socket.AF_INET6, ifindex, NUD_PERMANENT,
+                           ndm_flags, 0)
+        body += rtattr(NDA_DST, address)
+        if lladdr is not None:
+            body += rtattr(NDA_LLADDR, lladdr)
+        hdr = struct.pack(NLMSGHDR, struct.calcsize(NLMSGHDR) + len(body),
+                          msg_type, NLM_F_REQUEST | NLM_F_ACK | flags,
+                          self.seq, 0)
+        try:
+            self.socket.send(hdr + body)
+        except socket.error as e:
+            self._failed(msg_type, tap, e.errno or errno.EIO)
+            return False
+        self.pending[self.seq] = (msg_type, tap, ifindex, ndm_flags)
+        return True
+
+    def _failed(self, msg_type, tap, err):
+        """ Logs a failed neighbour request
+
+        """
+        # Entries of removed interfaces are already gone
+        if msg_type == RTM_DELNEIGH and err in (errno.ENOENT, errno.ENODEV):
+            return
+        self.errors += 1
+        logging.warn(" - Neighbour request on %s failed: %s", tap,
+                     os.strerror(err))
+
+    def handle_read(self):
+        """ Processes the pending acknowledgements of neighbour requests
+
+        """
+        hdrlen = struct.calcsize(NLMSGHDR)
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except socket.error as e:
+                if e.errno == errno.ENOBUFS:
+                    # Acknowledgements were lost, errors included
+                    logging.warn(" - Lost the acknowledgements of %d "
+                                 "neighbour requests", len(self.pending))
+                    self.pending.clear()
+                    continue
+                if e.errno not in (errno.EAGAIN, errno.EINTR):
+                    logging.warn(" - Cannot read neighbour acknowledgements:"
+                                 " %s", str(e))
+                return
+            if not data:
+                return
+            while len(data) >= hdrlen:
+                length, kind, _, seq, _ = struct.unpack_from(NLMSGHDR, data)
+                if length < hdrlen:
+                    break
+                if kind == NLMSG_ERROR and seq in self.pending:
+                    err = -struct.unpack_from(NLMSGERR, data, hdrlen)[0]
+                    self._acked(self.pending.pop(seq), err)
+                data = data[(length + 3) & ~3:]
+
+    def _acked(self, request, err):
+        """ Handles the acknowledgement of a neighbour request
+
+        """
+        if not err:
+            return
+        msg_type, tap, ifindex, ndm_flags = request
+        self._failed(msg_type, tap, err)
+        try:
+            entry_ifindex, gateway, installed = self.entries[tap]
+        except KeyError:
+            return
+        if msg_type != RTM_NEWNEIGH or entry_ifindex != ifindex:
+            return
+        installed = [e for e in installed if e[0] != ndm_flags]
+        if ndm_flags == NTF_PROXY:
+            # The kernel will not answer for the gateway
+            gateway = None
+        self.entries[tap] = (ifindex, gateway, installed)
+
+    @staticmethod
+    def enable_proxy_ndp(tap):
+        """ Turns on proxy_ndp on a tap, if we are allowed to
+
+        """
+        try:
+            with open(PROXY_NDP_SYSCTL % tap, "w") as f:
+                f.write("1\n")
+        except EnvironmentError as e:
+            logging.debug(" - Cannot enable proxy_ndp on %s: %s", tap, str(e))
+
+    def add(self, binding):
+        """ Installs the neighbour entries of a binding
+
+        """
+        self.remove(binding.tap)
+        if binding.net6.net is None or not binding.ifindex:
+            return
+        if binding.indev != binding.tap:
+            # Bridged, the tap never sees the solicitations
+            return
+
+        entries = []
+        gateway = None
+        if binding.gateway6:
+            self.enable_proxy_ndp(binding.tap)
+            gateway = socket.inet_pton(socket.AF_INET6, binding.gateway6)
+            entries.append((NTF_PROXY, gateway, None))
+        if binding.eui64:
+            entries.append((0,
+                            socket.inet_pton(socket.AF_INET6, binding.eui64),
+                            binding.mac_bytes))
+
+        installed = []
+        for ndm_flags, address, lladdr in entries:
+            if self._neigh(RTM_NEWNEIGH, NLM_F_CREATE | NLM_F_REPLACE,
+                           binding.ifindex, ndm_flags, address, lladdr,
+                           binding.tap):
+                installed.append((ndm_flags, address, lladdr))
+            elif ndm_flags == NTF_PROXY:
+                gateway = None
+        self.entries[binding.tap] = (binding.ifindex, gateway, installed)
+        logging.debug(" - Installing %d neighbour entries on %s",
+                      len(installed), binding.tap)
+
+    def remove(self, tap):
+        """ Removes the neighbour entries installed for a tap
+
+        """
+        try:
+            ifindex, _, installed = self.entries.pop(tap)
+        except KeyError:
+            return
+        for ndm_flags, address, lladdr in installed:
+            self._neigh(RTM_DELNEIGH, 0, ifindex, ndm_flags, address, lladdr,
+                        tap)
+
+    def offloaded(self, binding, target):
+        """ Tells if the kernel answers solicitations for target, a binary
+        IPv6 address, on the tap of a binding
+
+        """
+        try:
+            gateway = self.entries[binding.tap][1]
+        except KeyError:
+            return False
+        return gateway is not None and target == gateway
+
+    def to_dict(self):
+        """ Returns the state of the offload
+
+        """
+        return {"taps": len(self.entries), "pending": len(self.pending),
+                "errors": self.errors}
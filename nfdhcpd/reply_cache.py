@@ -0,0 +1,96 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Module hosting the cache of recently sent replies
+
+Clients often retransmit their requests within milliseconds while booting.
+The encoded replies are kept for a short while, so that a retransmitted
+request is answered by sending the same frame again instead of building it
+from scratch.
+
+"""
+
+import time
+import threading
+import collections
+
+DEFAULT_CACHE_TTL = 2.0  # seconds
+DEFAULT_CACHE_SIZE = 4096  # replies
+
+
+class ReplyCache(object):
+    """ A size and age limited cache of encoded replies, keyed by the binding
+    they were sent to and a request specific key
+
+    """
+    def __init__(self, ttl=DEFAULT_CACHE_TTL, size=DEFAULT_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        # (tap, key) -> (time, binding, frame), least recently used first
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, binding, key):
+        """ Returns the frame sent for the same request of a binding during
+        the last ttl seconds, or None
+
+        """
+        if not self.ttl:
+            return None
+        with self.lock:
+            entry = self.entries.pop((binding.tap, key), None)
+            # A reply for a replaced binding may be stale
+            if entry is None or entry[1] is not binding or \
+                    time.time() - entry[0] > self.ttl:
+                self.misses += 1
+                return None
+            self.entries[(binding.tap, key)] = entry
+            self.hits += 1
+            return entry[2]
+
+    def put(self, binding, key, frame):
+        """ Caches the frame sent in reply to a request of a binding
+
+        """
+        if not self.ttl:
+            return
+        with self.lock:
+            self.entries.pop((binding.tap, key), None)
+            now = time.time()
+            self.entries[(binding.tap, key)] = (now, binding, frame)
+            while len(self.entries) > self.size or \
+                    now - next(self.entries.itervalues())[0] > self.ttl:
+                self.entries.popitem(last=False)
+
+    def expire(self):
+        """ Drops the replies older than ttl seconds
+
+        """
+        limit = time.time() - self.ttl
+        with self.lock:
+            for k, entry in self.entries.items():
+                if entry[0] < limit:
+                    del self.entries[k]
+
+    def to_dict(self):
+        """ Returns the counters of the cache
+
+        """
+        return {"entries": len(self.entries), "hits": self.hits,
+                "misses": self.misses}
@@ -0,0 +1,217 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Module hosting the scheduler of the netfilter queues
+
+Every main loop iteration is a round in which each readable queue may process
+up to its budget of packets, in order of priority. A queue that uses up its
+whole budget is backlogged. While any queue is backlogged the server is
+overloaded and low priority work may be shed.
+
+The time packets wait before being handled and the time the handlers take are
+measured separately per protocol. The wait starts when the packet was received,
+if the payload has a get_timestamp() method, or else when the main loop woke
+up to serve the queue.
+
+"""
+
+import time
+import logging
+
+from nfdhcpd.metrics import Histogram
+
+DEFAULT_BUDGET = 10  # packets per round per unit of weight
+
+# Lower values are served first
+QUEUE_PRIORITIES = {
+    "capture": 0,
+    "dhcp": 0,
+    "dhcpv6": 1,
+    "rs": 2,
+    "ns": 3,
+}
+
+DEFAULT_WEIGHTS = {
+    "capture": 10,
+    "dhcp": 10,
+    "dhcpv6": 1,
+    "rs": 1,
+    "ns": 1,
+}
+
+
+class ScheduledQueue(object):
+    """ A netfilter queue along with its scheduling state
+
+    """
+    def __init__(self, queue, name, priority, budget):
+        self.queue = queue
+        self.name = name
+        self.priority = priority
+        self.budget = budget
+        self.processed = 0
+        self.rounds = 0
+        self.backlogged = 0
+
+    def to_dict(self):
+        """ Returns the counters of the queue
+
+        """
+        return {"priority": self.priority, "budget": self.budget,
+                "processed": self.processed, "rounds": self.rounds,
+                "backlogged": self.backlogged}
+
+
+class QueueTimings(object):
+    """ Queueing delay and handling time of the packets of a protocol
+
+    """
+    def __init__(self):
+        self.wait = Histogram()
+        self.handler = Histogram()
+
+    def to_dict(self):
+        """ Returns the histograms of the queue
+
+        """
+        return {"wait": self.wait.to_dict(),
+                "handler": self.handler.to_dict()}
+
+    def __str__(self):
+        return "wait: %s; handler: %s" % (self.wait, self.handler)
+
+
+class QueueScheduler(object):
+    """ Shares the main loop among the netfilter queues
+
+    """
+    def __init__(self, budget=DEFAULT_BUDGET, weights=None):
+        self.budget = budget
+        self.weights = dict(DEFAULT_WEIGHTS)
+        if weights:
+            self.weights.update(weights)
+        self.queues = {}
+        # Queue name -> QueueTimings
+        self.timings = {}
+        # When the main loop woke up for the current round
+        self.woken = time.time()
+        self.overloaded = False
+        self.overloads = 0
+
+    def add(self, fd, queue, name, kind=None):
+        """ Schedules queue, which is readable through fd, as the queue of
+        protocol kind (name by default)
+
+        """
+        kind = kind or name
+        budget = self.budget * self.weights.get(kind, 1)
+        self.queues[fd] = ScheduledQueue(queue, name,
+                                         QUEUE_PRIORITIES.get(kind, 0),
+                                         budget)
+        logging.debug(" - Scheduling queue %s with a budget of %d", name,
+                      budget)
+
+    def timed(self, name, callback):
+        """ Wraps the packet callback of protocol name, so that the queueing
+        delay and handling time of every packet are measured
+
+        """
+        timings = self.timings.setdefault(name, QueueTimings())
+
+        def measure(*args):
+            """ Runs callback, timing it
+
+            """
+            start = time.time()
+            # The payload is the last argument of any callback signature
+            get_timestamp = getattr(args[-1], "get_timestamp", None)
+            received = get_timestamp() if get_timestamp else None
+            timings.wait.observe(max(0, start - (received or self.woken)))
+            try:
+                return callback(*args)
+            finally:
+                timings.handler.observe(time.time() - start)
+
+        return measure
+
+    def fds(self):
+        """ Returns the file descriptors of all queues
+
+        """
+        return self.queues.keys()
+
+    def close(self):
+        """ Closes all queues
+
+        """
+        for sq in self.queues.values():
+            sq.queue.close()
+
+    def run(self, fds, woken=None):
+        """ Runs a round over the queues readable through fds, which were
+        found readable at time woken (now by default)
+
+        """
+        self.woken = woken or time.time()
+        ready = sorted((self.queues[fd] for fd in fds if fd in self.queues),
+                       key=lambda sq: sq.priority)
+        if not ready:
+            return
+
+        backlog = False
+        for sq in ready:
+            try:
+                cnt = sq.queue.process_pending(sq.budget)
+                logging.debug(" * Processed %d requests on NFQUEUE %s", cnt,
+                              sq.name)
+            except RuntimeError as e:
+                logging.warn("Error processing queue %s: %s", sq.name, str(e))
+                continue
+            except Exception as e:
+                logging.warn("Unknown error processing queue %s: %s",
+                             sq.name, str(e))
+                continue
+            sq.processed += cnt
+            sq.rounds += 1
+            if cnt >= sq.budget:
+                sq.backlogged += 1
+                backlog = True
+
+        if backlog and not self.overloaded:
+            logging.info("Netfilter queues are backlogged, shedding load")
+            self.overloads += 1
+        elif self.overloaded and not backlog:
+            logging.info("Netfilter queue backlog cleared")
+        self.overloaded = backlog
+
+    def to_dict(self):
+        """ Returns the state of the scheduler
+
+        """
+        return {"overloaded": self.overloaded, "overloads": self.overloads,
+                "queues": dict((sq.name, sq.to_dict())
+                               for sq in self.queues.values()),
+                "timings": dict((name, t.to_dict())
+                                for name, t in self.timings.items())}
+
+    def log_timings(self):
+        """ Logs the queueing delay and handling time of every protocol
+
+        """
+        for name, timings in sorted(self.timings.items()):
+            if timings.handler.count:
+                logging.info("Queue %s: %s", name, timings)
@@ -0,0 +1,132 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Module for dumping the client table without blocking the main loop
+
+The dump is built by a background thread from a published generation of the
+client table. It is written atomically, as text to the dump file and as JSON
+to the dump file with a .json suffix.
+
+"""
+
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+
+TEXT_COLUMNS = ("key", "hostname", "mac", "tap", "ifindex", "ip", "eui64",
+                "ll64", "socket", "tx_queued", "replies")
+
+
+def client_states(table):
+    """ Returns the state of every client of a client table generation
+
+    """
+    states = []
+    for key, binding in table.items():
+        state = binding.state()
+        state["key"] = key
+        states.append(state)
+    return states
+
+
+def format_text(dump):
+    """ Formats a dump as a table with one line per client, followed by the
+    server counters
+
+    """
+    lines = ["# nfdhcpd client table at %s, %d clients" %
+             (time.ctime(dump["timestamp"]), len(dump["clients"])),
+             " ".join(TEXT_COLUMNS)]
+    for state in dump["clients"]:
+        lines.append(" ".join(str(state.get(c)) for c in TEXT_COLUMNS))
+    for name, value in sorted(dump["stats"].get("counters", {}).items()):
+        lines.append("# %s = %s" % (name, value))
+    return "\n".join(lines) + "\n"
+
+
+def write_atomically(path, data):
+    """ Replaces the file at path with data
+
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=".nfdhcpd-dump.", dir=dirname)
+    try:
+        f = os.fdopen(fd, "w")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+    except:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class StateDumper(object):
+    """ Writes dumps of the client table of a server from a background
+    thread
+
+    """
+    def __init__(self, server, path):
+        self.server = server
+        self.path = path
+        self.thread = None
+        self.dumps = 0
+
+    def request(self):
+        """ Starts a dump, unless one is already in progress
+
+        Returns True if a dump was started.
+
+        """
+        if self.thread is not None and self.thread.is_alive():
+            logging.info("Client table dump already in progress")
+            return False
+        # The counters are small and kept by the main thread, so take them
+        # right away
+        stats = self.server.get_stats()
+        self.thread = threading.Thread(target=self._run, args=(stats,))
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def _run(self, stats):
+        """ Writes a dump of the published client table
+
+        """
+        start = time.time()
+        try:
+            # Keep the sockets of the dumped bindings open meanwhile
+            with self.server.clients.reader() as table:
+                dump = {"timestamp": start, "stats": stats,
+                        "clients": client_states(table)}
+            write_atomically(self.path, format_text(dump))
+            write_atomically(self.path + ".json",
+                             json.dumps(dump, separators=(",", ":")))
+        except (EnvironmentError, ValueError) as e:
+            logging.warn("Failed to dump client table to %s: %s", self.path,
+                         str(e))
+            return
+        self.dumps += 1
+        logging.info("Dumped %d clients to %s in %.2f seconds",
+                     len(dump["clients"]), self.path, time.time() - start)
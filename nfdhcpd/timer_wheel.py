@@ -0,0 +1,172 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Module hosting the hierarchical timer wheel of the main loop
+
+Time is divided in ticks of RESOLUTION seconds. Timers due within the first
+level's span sit in the slot of their tick, while later ones sit in coarser
+slots of the higher levels and are moved down (cascaded) as their time
+approaches. Scheduling and cancelling cost O(1) regardless of the number of
+timers, and the main loop sleeps until the next occupied slot.
+
+"""
+
+import math
+import time
+import logging
+
+RESOLUTION = 0.05  # seconds per tick
+LEVELS = (256, 64, 64, 64)  # slots per level
+
+
+class Timer(object):
+    """ A scheduled call
+
+    """
+    __slots__ = ("deadline", "callback", "args", "cancelled")
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+
+class TimerWheel(object):
+    """ Calls functions after a delay, when advance() is called on time
+
+    """
+    def __init__(self, resolution=RESOLUTION, levels=LEVELS):
+        self.resolution = resolution
+        self.sizes = levels
+        self.wheels = [[[] for _ in range(n)] for n in levels]
+        # Ticks covered by a single slot of each level
+        self.spans = [1]
+        for n in levels[:-1]:
+            self.spans.append(self.spans[-1] * n)
+        # The next tick to process
+        self.tick = int(time.time() / resolution) + 1
+        self.count = 0
+        self.fired = 0
+
+    def schedule(self, delay, callback, *args):
+        """ Calls callback(*args) after delay seconds
+
+        Returns the timer, which may be passed to cancel().
+
+        """
+        timer = Timer(time.time() + delay, callback, args)
+        self._insert(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        """ Cancels a timer that has not fired yet
+
+        """
+        if timer is not None and not timer.cancelled:
+            timer.cancelled = True
+            self.count -= 1
+
+    def _insert(self, timer):
+        """ Puts a timer in the slot of its tick
+
+        """
+        expiry = max(int(math.ceil(timer.deadline / self.resolution)),
+                     self.tick)
+        delta = expiry - self.tick
+        last = len(self.sizes) - 1
+        for level, n in enumerate(self.sizes):
+            span = self.spans[level]
+            if delta < span * n or level == last:
+                if delta >= span * n:
+                    # Too far away, it will be reinserted on cascading
+                    expiry = self.tick + span * n - 1
+                self.wheels[level][(expiry // span) % n].append(timer)
+                return
+
+    def _cascade(self, level):
+        """ Moves the timers of the current slot of a level down
+
+        """
+        span = self.spans[level]
+        slot = self.wheels[level][(self.tick // span) % self.sizes[level]]
+        timers = slot[:]
+        del slot[:]
+        for timer in timers:
+            if not timer.cancelled:
+                self._insert(timer)
+
+    def advance(self, now=None):
+        """ Fires all timers due until now
+
+        """
+        if now is None:
+            now = time.time()
+        # Tolerate rounding errors when woken up exactly at next_timeout()
+        target = int(now / self.resolution + 1e-6)
+        if not self.count:
+            self.tick = max(self.tick, target + 1)
+            return
+
+        while self.tick <= target:
+            # Higher levels first, so that everything due now ends up in the
+            # current slot of the first level
+            for level in range(len(self.sizes) - 1, 0, -1):
+                if self.tick % self.spans[level] == 0:
+                    self._cascade(level)
+
+            slot = self.wheels[0][self.tick % self.sizes[0]]
+            timers = slot[:]
+            del slot[:]
+            self.tick += 1
+            for timer in timers:
+                if timer.cancelled:
+                    continue
+                timer.cancelled = True
+                self.count -= 1
+                self.fired += 1
+                try:
+                    timer.callback(*timer.args)
+                except Exception as e:
+                    logging.warn("Unknown error in timer %s: %s",
+                                 timer.callback, str(e))
+
+    def next_timeout(self, now=None):
+        """ Returns the seconds until advance() needs to be called, or None
+        if there are no timers
+
+        """
+        if not self.count:
+            return None
+        if now is None:
+            now = time.time()
+        n = self.sizes[0]
+        # Up to the next rotation of the first level, where timers of the
+        # higher levels get cascaded and must be looked at again
+        for i in range(n):
+            tick = self.tick + i
+            if tick % n == 0 or \
+                    any(not t.cancelled for t in self.wheels[0][tick % n]):
+                break
+        return max(0, tick * self.resolution - now)
+
+    def to_dict(self):
+        """ Returns the counters of the wheel
+
+        """
+        return {"timers": self.count, "fired": self.fired}
@@ -0,0 +1,219 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Module hosting the per-binding transmit queues
+
+Replies are sent without blocking. If the socket buffer of a tap is full,
+the reply is queued on the binding instead of being lost, and the main loop
+flushes the queue as soon as the socket becomes writable again.
+
+"""
+
+import os
+import errno
+import fcntl
+import socket
+import logging
+import threading
+import collections
+
+DEFAULT_QUEUE_LEN = 32  # frames per binding
+
+# Locks the bindings are spread over, instead of keeping a lock per binding
+LOCK_STRIPES = 64
+
+# Errors meaning that the socket buffer is (momentarily) full
+TRANSIENT_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS)
+
+
+class TransmitQueues(object):
+    """ Sends frames to the clients, queueing them while a tap is busy
+
+    Frames may be sent from any thread, while the queues are flushed by the
+    main loop through write_fds() and handle_write(). Sending to a binding
+    and changing its queue happen under the lock of the binding, so frames
+    are sent in order. The pending bindings and the counters are guarded by
+    a lock of their own, taken after the lock of a binding.
+
+    """
+    def __init__(self, queue_len=DEFAULT_QUEUE_LEN):
+        self.queue_len = queue_len
+        self.lock = threading.Lock()
+        self.binding_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        # id(binding) -> binding, of the bindings with queued frames
+        self.pending = {}
+        # Socket fd -> binding, as returned by the last write_fds()
+        self.fds = {}
+        self.queued = 0
+        self.flushed = 0
+        self.dropped = 0
+
+        # Wakes up the main loop when frames get queued by other threads
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def close(self):
+        """ Closes the wakeup pipe
+
+        """
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+    def lock_of(self, binding):
+        """ Returns the lock of a binding
+
+        """
+        return self.binding_locks[(id(binding) >> 4) % LOCK_STRIPES]
+
+    def send(self, binding, data):
+        """ Sends data to a client, queueing it if the tap is busy
+
+        Raises socket.error for errors other than a full socket buffer.
+
+        """
+        if not isinstance(data, str):
+            # A scapy packet that needs to be encoded
+            data = str(data)
+
+        with self.lock_of(binding):
+            if binding.txqueue:
+                # Keep the frames in order
+                self._enqueue(binding, data)
+                return
+
+            try:
+                binding.sendp(data)
+            except socket.error as e:
+                if e.errno not in TRANSIENT_ERRORS or not self.queue_len:
+                    raise
+                self._enqueue(binding, data)
+
+    def _enqueue(self, binding, data):
+        """ Queues a frame on a binding, with the lock of the binding held
+
+        """
+        if binding.txqueue is None:
+            binding.txqueue = collections.deque()
+        if len(binding.txqueue) >= self.queue_len:
+            with self.lock:
+                self.dropped += 1
+            logging.debug(" - Transmit queue of %s full, dropping frame",
+                          binding.tap)
+            return
+
+        binding.txqueue.append(data)
+        with self.lock:
+            self.queued += 1
+            if id(binding) in self.pending:
+                return
+            self.pending[id(binding)] = binding
+        try:
+            os.write(self.wakeup_w, "x")
+        except OSError:
+            # The main loop is already woken up
+            pass
+
+    def handle_wakeup(self):
+        """ Drains the wakeup pipe
+
+        """
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except OSError:
+            pass
+
+    def write_fds(self):
+        """ Returns the sockets with queued frames
+
+        """
+        self.fds = {}
+        with self.lock:
+            bindings = self.pending.values()
+        for binding in bindings:
+            sock = binding.socket
+            try:
+                if sock is None:
+                    raise socket.error(errno.EBADF, "No socket")
+                self.fds[sock.fileno()] = binding
+            except socket.error:
+                with self.lock_of(binding):
+                    self._drop_queue(binding)
+        return self.fds.keys()
+
+    def discard(self, binding):
+        """ Drops all frames queued on a binding that is going away
+
+        """
+        with self.lock_of(binding):
+            self._drop_queue(binding)
+
+    def _drop_queue(self, binding):
+        """ Drops all frames queued on a binding, with the lock of the
+        binding held
+
+        """
+        dropped = 0
+        if binding.txqueue:
+            dropped = len(binding.txqueue)
+            binding.txqueue.clear()
+        with self.lock:
+            self.dropped += dropped
+            self.pending.pop(id(binding), None)
+
+    def handle_write(self, fd):
+        """ Flushes the queue of a writable socket returned by write_fds()
+
+        Returns False if fd is not a socket with queued frames.
+
+        """
+        binding = self.fds.pop(fd, None)
+        if binding is None:
+            return False
+
+        flushed = 0
+        with self.lock_of(binding):
+            while binding.txqueue and binding.socket is not None:
+                sock = binding.socket
+                try:
+                    sock.send(binding.txqueue[0], socket.MSG_DONTWAIT)
+                except socket.error as e:
+                    if e.errno in TRANSIENT_ERRORS:
+                        # Still busy, wait until it is writable again
+                        break
+                    logging.warn(" - Flushing transmit queue of %s failed: "
+                                 "%s", binding.tap, str(e))
+                    # Like sendp() does, so that the tap works again
+                    binding.reopen_socket(sock)
+                    self._drop_queue(binding)
+                    break
+                binding.txqueue.popleft()
+                flushed += 1
+            if not binding.txqueue or binding.socket is None:
+                self._drop_queue(binding)
+        with self.lock:
+            self.flushed += flushed
+        return True
+
+    def to_dict(self):
+        """ Returns the counters of the transmit queues
+
+        """
+        return {"pending": len(self.pending), "queued": self.queued,
+                "flushed": self.flushed, "dropped": self.dropped}
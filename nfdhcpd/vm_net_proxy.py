@@ -18,6 +18,7 @@
 """module hosting the VMNetProxy class"""
 
 import os
+import sys
 import logging
 import glob
 import threading
@@ -26,33 +27,59 @@ import time
 import re
 import errno
 import socket
+import struct
+import json
+import sqlite3
+import hashlib
+import collections
+import operator
 from socket import AF_INET, AF_INET6
 
 import nfqueue
 import pyinotify
 
-from scapy.layers.l2 import Ether
-from scapy.layers.inet import IP, UDP
-from scapy.layers.inet6 import (IPv6, ICMPv6ND_RA, ICMPv6ND_NA,
-                                ICMPv6NDOptDstLLAddr, ICMPv6NDOptPrefixInfo,
-                                ICMPv6NDOptRDNSS, ICMPv6NDOptMTU)
-from scapy.layers.dhcp import BOOTP, DHCP
-from scapy.layers.dhcp6 import (DHCP6_Reply, DHCP6OptDNSServers,
-                                DHCP6OptServerId, DHCP6OptClientId,
-                                DUID_LLT, DHCP6_InfoRequest,
-                                DHCP6OptDNSDomains)
-from scapy.fields import ShortField
-import scapy.layers.dhcp as scapy_dhcp
-
-from nfdhcpd.binding_config import BindingConfig
-
-scapy_dhcp.DHCPOptions[26] = ShortField("interface_mtu", 1500)
-scapy_dhcp.DHCPRevOptions["interface_mtu"] = (26, scapy_dhcp.DHCPOptions[26])
+from nfdhcpd.binding_config import (BindingConfig, unpack_mac, is_manifest,
+                                    read_manifest)
+from nfdhcpd.binding_snapshot import file_stat, save_snapshot, load_snapshot
+from nfdhcpd.encoding import ether_header, ipv6_udp_frame
+from nfdhcpd.control import ControlServer
+from nfdhcpd.binding_db import BindingDatabase, is_busy
+from nfdhcpd.watchdog import LoopWatchdog
+from nfdhcpd.workers import ReplyWorkerPool, DEFAULT_QUEUE_SIZE
+from nfdhcpd.scheduler import QueueScheduler, DEFAULT_BUDGET
+from nfdhcpd.client_table import ClientTable
+from nfdhcpd.transmit import TransmitQueues, DEFAULT_QUEUE_LEN
+from nfdhcpd.capture import PacketCapture, classify
+from nfdhcpd.proxy_ndp import NeighbourOffload
+from nfdhcpd.link_monitor import LinkMonitor
+from nfdhcpd.metrics import Histogram, PHASE_BUCKETS
+from nfdhcpd.timer_wheel import TimerWheel
+from nfdhcpd.state_dump import StateDumper, client_states
+from nfdhcpd.reply_cache import (ReplyCache, DEFAULT_CACHE_TTL,
+                                 DEFAULT_CACHE_SIZE)
+
+# Scapy layers are expensive to import, so they are only loaded by
+# import_layers() for the protocols the server is configured to handle
+# pylint: disable=C0103,W0603
+Ether = IP = UDP = None
+BOOTP = DHCP = None
+IPv6 = ICMPv6ND_RA = ICMPv6ND_NA = ICMPv6NDOptDstLLAddr = None
+ICMPv6NDOptPrefixInfo = ICMPv6NDOptRDNSS = ICMPv6NDOptMTU = None
+DHCP6OptDNSServers = DHCP6OptServerId = DHCP6OptClientId = None
+DUID_LL = DHCP6_InfoRequest = DHCP6OptDNSDomains = None
 
 
 DEFAULT_LEASE_LIFETIME = 604800  # 1 week
 DEFAULT_LEASE_RENEWAL = 600  # 10 min
 DEFAULT_RA_PERIOD = 300  # seconds
+DEFAULT_SNAPSHOT_INTERVAL = 300  # seconds
+DEFAULT_CONFIG_DEBOUNCE = 0.2  # seconds to coalesce events on a file
+DEFAULT_CONFIG_BATCH = 64  # binding files to process per main loop iteration
+DEFAULT_BINDING_DB_POLL = 1.0  # seconds between binding database polls
+DEFAULT_WATCHDOG_THRESHOLD = 1.0  # seconds a loop iteration may take
+DEFAULT_CAPTURE_FRAMES = 1024  # frames in the receive ring of each capture
+DEFAULT_STATS_INTERVAL = 300  # seconds between queue timing summaries
+SHED_WINDOW = 10  # seconds a reply makes repeated low priority requests moot
 DHCP_DUMMY_SERVER_IP = "1.2.3.4"
 
 SYSFS_NET = "/sys/class/net"
@@ -77,6 +104,12 @@ DHCP_TYPES = {
     DHCPINFORM: "DHCPINFORM",
 }
 
+DHCP6_REPLY = 7
+
+LINK_LOCAL_NET = "\xfe\x80" + "\x00" * 6
+ALL_NODES = "ff02::1"
+ALL_NODES_MAC = "33:33:00:00:00:01"
+
 DHCP_REQRESP = {
     DHCPDISCOVER: DHCPOFFER,
     DHCPREQUEST: DHCPACK,
@@ -84,6 +117,52 @@ DHCP_REQRESP = {
     }
 
 
+def import_layers(dhcp=False, ipv6=False, dhcpv6=False):
+    """ Imports the scapy layers needed for the given protocols
+
+    Every protocol is still parsed with scapy and only the DHCPv6 replies
+    have an encoder of their own, so the Ethernet layer is always needed.
+    IPv4 and UDP are only loaded for DHCP.
+
+    """
+    global Ether
+    from scapy.layers.l2 import Ether
+
+    if dhcp:
+        global IP, UDP, BOOTP, DHCP
+        from scapy.layers.inet import IP, UDP
+        from scapy.layers.dhcp import BOOTP, DHCP
+        from scapy.fields import ShortField
+        import scapy.layers.dhcp as scapy_dhcp
+
+        scapy_dhcp.DHCPOptions[26] = ShortField("interface_mtu", 1500)
+        scapy_dhcp.DHCPRevOptions["interface_mtu"] = \
+            (26, scapy_dhcp.DHCPOptions[26])
+
+    if ipv6:
+        global IPv6, ICMPv6ND_RA, ICMPv6ND_NA, ICMPv6NDOptDstLLAddr
+        global ICMPv6NDOptPrefixInfo, ICMPv6NDOptRDNSS, ICMPv6NDOptMTU
+        from scapy.layers.inet6 import (IPv6, ICMPv6ND_RA, ICMPv6ND_NA,
+                                        ICMPv6NDOptDstLLAddr,
+                                        ICMPv6NDOptPrefixInfo,
+                                        ICMPv6NDOptRDNSS, ICMPv6NDOptMTU)
+
+    if dhcpv6:
+        global DHCP6OptDNSServers, DHCP6OptServerId, DHCP6OptClientId
+        global DUID_LL, DHCP6_InfoRequest, DHCP6OptDNSDomains
+        from scapy.layers.dhcp6 import (DHCP6OptDNSServers, DHCP6OptServerId,
+                                        DHCP6OptClientId, DUID_LL,
+                                        DHCP6_InfoRequest, DHCP6OptDNSDomains)
+
+
+def iid_to_mac(iid):
+    """ Returns the MAC address embedded in the binary EUI-64 interface
+    identifier iid
+
+    """
+    return unpack_mac(chr(ord(iid[0]) ^ 2) + iid[1:3] + iid[5:])
+
+
 def ipv62mac(ipv6):
     """Given an IPv6 EUI-64 address it returns the corresponding MAC address
 
@@ -93,20 +172,146 @@ def ipv62mac(ipv6):
     if subnet_index != -1:
         ipv6 = ipv6[:subnet_index]
 
-    ipv6_parts = ipv6.split(":")
-    mac_parts = []
-    for ipv6_part in ipv6_parts[-4:]:
-        while len(ipv6_part) < 4:
-            ipv6_part = "0" + ipv6_part
-        mac_parts.append(ipv6_part[:2])
-        mac_parts.append(ipv6_part[-2:])
+    # The interface identifier is the last 8 bytes, with ff:fe in the middle
+    return iid_to_mac(socket.inet_pton(AF_INET6, ipv6)[8:])
+
+
+def eui64_to_mac(ipv6):
+    """ Returns the MAC address embedded in a link-local EUI-64 IPv6 address
+    or None if the address is not of that form
+
+    """
+    try:
+        packed = socket.inet_pton(AF_INET6, ipv6)
+    except (socket.error, TypeError):
+        return None
+    if packed[:8] != LINK_LOCAL_NET or packed[11:13] != "\xff\xfe":
+        return None
+    return ipv62mac(ipv6)
+
+
+# The functions below read the client MAC address straight out of the raw
+# packets at fixed offsets, so that packets of unknown clients can be accepted
+# before they are dissected. They return None if the MAC cannot be found that
+# way, in which case the packet is dissected as usual.
+
+def raw_dhcp_mac(data):
+    """ Returns the client hardware address of a raw IPv4 BOOTP packet
+
+    """
+    if not data:
+        return None
+    # IP header, UDP header and then chaddr at offset 28 of BOOTP
+    offset = (ord(data[0]) & 0x0f) * 4 + 8
+    if len(data) < offset + 34 or ord(data[offset + 2]) != 6:
+        return None
+    return unpack_mac(data[offset + 28:offset + 34])
+
+
+def raw_rs_mac(data):
+    """ Returns the MAC address of the source address of a raw RS, like
+    ipv62mac() does
+
+    """
+    if len(data) < 24:
+        return None
+    return iid_to_mac(data[16:24])
+
+
+def raw_ns_mac(data):
+    """ Returns the MAC address of the source link-layer address option of a
+    raw NS, if it is the first option
+
+    """
+    # IPv6 header, NS header with the target address and then the options
+    if len(data) < 72 or ord(data[6]) != 58 or data[64:66] != "\x01\x01":
+        return None
+    return unpack_mac(data[66:72])
+
+
+def raw_ns_target(data):
+    """ Returns the binary target address of a raw NS without extension
+    headers, or None
+
+    """
+    if len(data) < 64 or ord(data[6]) != 58 or ord(data[40]) != 135:
+        return None
+    return data[48:64]
+
+
+def raw_dhcpv6_mac(data):
+    """ Returns the MAC address of a raw DHCPv6 request sent from a link-local
+    EUI-64 address
+
+    """
+    if len(data) < 24 or data[8:16] != LINK_LOCAL_NET or \
+            data[19:21] != "\xff\xfe":
+        return None
+    return iid_to_mac(data[16:24])
+
+
+def get_hwaddr(payload):
+    """ Returns the source hardware address of a packet, as reported by
+    NFQUEUE, if the nfqueue bindings support it
+
+    """
+    try:
+        hwaddr = payload.get_hwaddr()
+    except AttributeError:
+        return None
+    if not hwaddr:
+        return None
+    if len(hwaddr) == 17:
+        # Already in textual representation
+        return hwaddr.lower()
+    return unpack_mac(hwaddr[:6])
+
+
+def get_dhcpv6_client_mac(payload, pkt):
+    """ Finds the MAC address of the client that sent a DHCPv6 request
+
+    The hardware address reported by NFQUEUE is preferred, then the one
+    embedded in the link-local source address and last the one found in the
+    client's DUID, since DUIDs survive cloning of VM images.
+
+    """
+    mac = get_hwaddr(payload)
+    if mac:
+        return mac
+
+    mac = eui64_to_mac(pkt.src)
+    if mac:
+        return mac
+
+    try:
+        duid = pkt[DHCP6OptClientId].duid
+    except IndexError:
+        return None
+    # Only DUID-LL and DUID-LLT of Ethernet interfaces carry a MAC
+    if getattr(duid, "hwtype", None) == 1 and getattr(duid, "lladdr", None):
+        return duid.lladdr
+    return None
+
 
-    # modify parts to match MAC value
-    mac_parts[0] = "%02x" % (int(mac_parts[0], 16) ^ 2)
-    del mac_parts[4]
-    del mac_parts[3]
+def client_hash(mac):
+    """ Maps a MAC address to a number in [0, 1) that stays the same across
+    restarts
+
+    """
+    digest = hashlib.md5(mac or "").digest()
+    return struct.unpack("!I", digest[:4])[0] / float(1 << 32)
 
-    return ":".join(mac_parts)
+
+def min_timeout(timeout, other):
+    """ Returns the shortest of two select() timeouts, where None means no
+    timeout
+
+    """
+    if timeout is None:
+        return other
+    if other is None:
+        return timeout
+    return min(timeout, other)
 
 
 def get_indev(payload):
@@ -143,27 +348,43 @@ class ClientFileHandler(pyinotify.ProcessEvent):
     def process_IN_DELETE(self, event):  # pylint: disable=C0103
         """ Delete file handler
 
-        Currently this removes an interface from the watch list
+        Schedules the removal of the interface from the watch list
 
         """
-        self.server.remove_tap(event.name)
+        self.server.schedule_config_change(
+            os.path.join(event.path, event.name))
 
     def process_IN_CLOSE_WRITE(self, event):  # pylint: disable=C0103
         """ Add file handler
 
-        Currently this adds an interface to the watch list
+        Schedules the addition of the interface to the watch list
 
         """
-        self.server.add_tap(os.path.join(event.path, event.name))
+        self.server.schedule_config_change(
+            os.path.join(event.path, event.name))
+
+    def process_IN_MOVED_TO(self, event):  # pylint: disable=C0103
+        """ Rename handler, for files atomically replaced by renaming
+
+        """
+        self.server.schedule_config_change(
+            os.path.join(event.path, event.name))
+
+    def process_IN_MOVED_FROM(self, event):  # pylint: disable=C0103
+        """ Rename handler, for files renamed away
+
+        """
+        self.server.schedule_config_change(
+            os.path.join(event.path, event.name))
 
     def process_IN_Q_OVERFLOW(self, event):  # pylint: disable=C0103
         """ Event overflow handler
 
-        Currently this reads all interface configs
+        Schedules a stat-based comparison of all interface configs with the
+        client table
 
         """
-        for path in glob.glob(os.path.join(self.server.data_path, "*")):
-            self.server.add_tap(path)
+        self.server.schedule_reconciliation()
 
 
 class VMNetProxy(object):  # pylint: disable=R0902
@@ -178,57 +399,189 @@ class VMNetProxy(object):  # pylint: disable=R0902
                  dhcp_domain=None, dhcp_server_on_link=False,
                  dhcp_server_ip=DHCP_DUMMY_SERVER_IP, dhcp_nameservers=None,
                  ra_period=DEFAULT_RA_PERIOD, ipv6_nameservers=None,
-                 dhcpv6_domains=None):
+                 dhcpv6_domains=None, snapshot_file=None,
+                 snapshot_interval=DEFAULT_SNAPSHOT_INTERVAL,
+                 config_debounce=DEFAULT_CONFIG_DEBOUNCE,
+                 config_batch=DEFAULT_CONFIG_BATCH, control_socket=None,
+                 binding_db=None, binding_db_poll=DEFAULT_BINDING_DB_POLL,
+                 watchdog_threshold=DEFAULT_WATCHDOG_THRESHOLD,
+                 reply_workers=0, reply_queue=DEFAULT_QUEUE_SIZE,
+                 queue_budget=DEFAULT_BUDGET, queue_weights=None,
+                 load_shedding=True, tx_queue=DEFAULT_QUEUE_LEN,
+                 ingress="nfqueue", capture_interfaces=None,
+                 capture_frames=DEFAULT_CAPTURE_FRAMES, proxy_ndp=False,
+                 ra_multicast=False, dhcp_renewal_jitter=0,
+                 reply_cache_ttl=DEFAULT_CACHE_TTL,
+                 reply_cache_size=DEFAULT_CACHE_SIZE, track_links=True,
+                 stats_interval=DEFAULT_STATS_INTERVAL, dump_file=None):
 
         try:
             getattr(nfqueue.payload, 'get_physindev')
             self.mac_indexed_clients = False
         except AttributeError:
             self.mac_indexed_clients = True
+        if ingress == "packet":
+            # Captured frames always carry the interface they came from
+            self.mac_indexed_clients = False
         self.data_path = data_path
         self.lease_lifetime = dhcp_lease_lifetime
         self.lease_renewal = dhcp_lease_renewal
+        self.renewal_jitter = dhcp_renewal_jitter
+        # Renewal arrivals, see observe_renewal()
+        self.renewal_phase = Histogram(PHASE_BUCKETS)
+        self.renewal_second = 0
+        self.renewal_rate = 0
+        self.renewal_peak = 0
         self.dhcp_domain = dhcp_domain
         self.dhcp_server_ip = dhcp_server_ip
         self.dhcp_server_on_link = dhcp_server_on_link
         self.ra_period = ra_period
+        self.ra_multicast = ra_multicast
+        # indev -> BindingConfig for sending multicast RAs on it
+        self.segment_senders = {}
+        # Guards segment_senders, which the RA thread fills
+        self.segment_lock = threading.Lock()
         self.dhcp_nameservers = dhcp_nameservers or []
         self.ipv6_nameservers = ipv6_nameservers or []
         self.dhcpv6_domains = dhcpv6_domains or []
+        self.snapshot_file = snapshot_file
+        self.snapshot_interval = snapshot_interval
+        self.stats_interval = stats_interval
+        if dump_file:
+            self.dumper = StateDumper(self, dump_file)
+        else:
+            self.dumper = None
+        self.config_debounce = config_debounce
+        self.config_batch = config_batch
 
         # TODO: implement stateful dhcpv6 mode
         assert ipv6_mode in (None, 'slaac', 'slaac+dhcpv6')
         self.ipv6_mode = ipv6_mode
 
-        self.clients = {}
+        self.transmit = TransmitQueues(tx_queue)
+        # Changes become visible to other threads with clients.publish().
+        # Bindings are also indexed by the key the table is not keyed by and
+        # grouped by indev.
+        if self.mac_indexed_clients:
+            alias = operator.attrgetter("ifindex")
+        else:
+            alias = operator.attrgetter("mac")
+        self.clients = ClientTable(self.transmit.discard, alias,
+                                   operator.attrgetter("indev"))
         # self.subnets = {}
         # self.ifaces = {}
         # self.v6nets = {}
-        self.nfq = {}
+        self.scheduler = QueueScheduler(queue_budget, queue_weights)
+        self.load_shedding = load_shedding
+        # Replies to resend to retransmitted requests
+        self.reply_cache = ReplyCache(reply_cache_ttl, reply_cache_size)
+        # Periodic and delayed work of the main loop
+        self.timers = TimerWheel()
+        # Link state of the taps, so that nothing is sent to taps that are
+        # down
+        if track_links:
+            self.links = LinkMonitor(self.link_changed,
+                                     self.indev_address_changed)
+        else:
+            self.links = None
+        # Neighbour entries answering NSs in the kernel
+        if proxy_ndp and self.ipv6_mode:
+            self.neigh_offload = NeighbourOffload()
+        else:
+            self.neigh_offload = None
+        # Encoded DHCPv6 Server Identifier options per interface MAC
+        self.server_duids = {}
+        # Event counters, reported along with the client table
+        self.stats = collections.defaultdict(int)
+        # Guards the counters, the renewal measurements and server_duids,
+        # which the reply workers update too
+        self.lock = threading.Lock()
+
+        if watchdog_threshold:
+            self.watchdog = LoopWatchdog(watchdog_threshold)
+        else:
+            self.watchdog = None
+
+        # Replies are generated inline unless there are reply workers
+        if reply_workers:
+            self.workers = ReplyWorkerPool(reply_workers, reply_queue)
+        else:
+            self.workers = None
+
+        # Binding file path -> (mtime, size, inode) at the time it was parsed
+        self.file_stats = {}
+        # Binding files still to be checked against the client table
+        self.reconcile_queue = collections.deque()
+        # Binding files with inotify events, mapped to the time they are due,
+        # along with (manifest, tap) entries of changed manifests
+        self.pending_changes = collections.OrderedDict()
+        self.snapshot_dirty = False
+        # Interfaces whose bindings were added through the control socket
+        self.control_taps = set()
+        # Manifest path -> {tap: line} of the bindings loaded from it
+        self.manifests = {}
+        # Manifest path -> {tap: line} as last read, applied in batches
+        self.manifest_lines = {}
+
+        # Binding database setup
+        if binding_db:
+            self.binding_db = BindingDatabase(binding_db)
+        else:
+            self.binding_db = None
+        self.binding_db_poll = binding_db_poll
+        # Last change of the binding database applied to the client table
+        self.binding_db_seq = 0
+        self.binding_db_timer = None
 
         # Inotify setup
         self.wm = pyinotify.WatchManager()
         mask = pyinotify.EventsCodes.ALL_FLAGS["IN_DELETE"]
         mask |= pyinotify.EventsCodes.ALL_FLAGS["IN_CLOSE_WRITE"]
+        mask |= pyinotify.EventsCodes.ALL_FLAGS["IN_MOVED_TO"]
+        mask |= pyinotify.EventsCodes.ALL_FLAGS["IN_MOVED_FROM"]
         mask |= pyinotify.EventsCodes.ALL_FLAGS["IN_Q_OVERFLOW"]
         inotify_handler = ClientFileHandler(self)
         self.notifier = pyinotify.Notifier(self.wm, inotify_handler)
         self.wm.add_watch(self.data_path, mask, rec=True)
 
-        # NFQUEUE setup
+        import_layers(dhcp=dhcp_queue_num is not None,
+                      ipv6=self.ipv6_mode is not None,
+                      dhcpv6=self.ipv6_mode == 'slaac+dhcpv6')
+
+        # Control socket setup
+        if control_socket:
+            self.control = ControlServer(control_socket, self)
+        else:
+            self.control = None
+
+        # The handlers of the enabled protocols, as (queue, family, name,
+        # callback) tuples
+        handlers = []
         if dhcp_queue_num is not None:
-            self._setup_nfqueue(dhcp_queue_num, AF_INET, self.dhcp_response, 0)
+            handlers.append((dhcp_queue_num, AF_INET, "dhcp",
+                             self.dhcp_response))
 
         if self.ipv6_mode:
             assert rs_queue_num is not None
             assert ns_queue_num is not None
-            self._setup_nfqueue(rs_queue_num, AF_INET6, self.rs_response, 10)
-            self._setup_nfqueue(ns_queue_num, AF_INET6, self.ns_response, 10)
+            handlers.append((rs_queue_num, AF_INET6, "rs", self.rs_response))
+            handlers.append((ns_queue_num, AF_INET6, "ns", self.ns_response))
 
         if self.ipv6_mode == 'slaac+dhcpv6':
             assert dhcpv6_queue_num is not None
-            self._setup_nfqueue(dhcpv6_queue_num, AF_INET6,
-                                self.dhcpv6_response, 10)
+            handlers.append((dhcpv6_queue_num, AF_INET6, "dhcpv6",
+                             self.dhcpv6_response))
+
+        if ingress == "packet":
+            self.capture_handlers = dict(
+                (name, self.scheduler.timed(name, callback))
+                for _, _, name, callback in handlers)
+            for iface in capture_interfaces or [None]:
+                self._setup_capture(iface, capture_frames)
+        else:
+            # NFQUEUE setup
+            for queue_num, family, name, callback in handlers:
+                self._setup_nfqueue(queue_num, family, callback, name)
 
     def get_binding(self, ifindex, mac):
         """ Returns the binding configuration for a given MAC address or
@@ -251,6 +604,38 @@ class VMNetProxy(object):  # pylint: disable=R0902
                 mac, ifindex)
             return None
 
+    def get_binding_by_ifindex(self, ifindex):
+        """ Returns the binding of the tap with the given interface index, in
+        either indexing mode
+
+        """
+        if self.mac_indexed_clients:
+            return self.clients.get_alias(ifindex)
+        return self.clients.get(ifindex)
+
+    def accept_unknown(self, payload, indev, data, raw_mac):
+        """ Accepts a packet before dissecting it if it certainly does not
+        come from a known client
+
+        raw_mac is a function returning the client MAC address of the raw
+        packet or None, and it is only used in MAC-indexed mode. Returns True
+        if the packet was accepted.
+
+        """
+        mac = None
+        if self.mac_indexed_clients:
+            mac = raw_mac(data)
+            if mac is None or mac in self.clients:
+                return False
+        elif indev in self.clients:
+            return False
+
+        logging.debug(" - Accepting packet of unknown client mac:%s / "
+                      "ifindex:%s", mac, indev)
+        self.count("accepted_unknown")
+        payload.set_verdict(nfqueue.NF_ACCEPT)
+        return True
+
     def dhcpv6_response(self, arg1, arg2=None):  # pylint: disable=W0613
         """ Generates and sends a reply to a DHCPv6 request
 
@@ -264,64 +649,69 @@ class VMNetProxy(object):  # pylint: disable=R0902
             payload = arg2
         else:
             payload = arg1
-        pkt = IPv6(payload.get_data())
+        data = payload.get_data()
         indev = get_indev(payload)
+        if self.accept_unknown(payload, indev, data, lambda d:
+                               get_hwaddr(payload) or raw_dhcpv6_mac(d)):
+            return
 
+        pkt = IPv6(data)
         # logging.debug(pkt.show())
-        # TODO: figure out how to find the src mac
-        mac = None
+        if self.mac_indexed_clients:
+            mac = get_dhcpv6_client_mac(payload, pkt)
+            logging.debug(" - DHCPv6: MAC %s", mac)
+        else:
+            mac = None
         binding = self.get_binding(indev, mac)
         if binding is None:
             # We don't know anything about this interface, so accept the packet
             # and return and let the kernel handle it
+            self.count("dhcpv6_unmatched")
             payload.set_verdict(nfqueue.NF_ACCEPT)
             return
 
         # Signal the kernel that it shouldn't further process the packet
         payload.set_verdict(nfqueue.NF_DROP)
 
+        self.dispatch_reply(self.dhcpv6_reply, binding, pkt)
+
+    def dhcpv6_reply(self, binding, pkt):
+        """ Generates and sends the reply to a DHCPv6 request of a known
+        client
+
+        """
         subnet = binding.net6
 
         if subnet.net is None:
             logging.debug(" - DHCPv6: No IPv6 network assigned to %s", binding)
             return
 
-        indevmac = self.get_iface_hw_addr(binding.indev)
-        if not indevmac:
+        if not self.ensure_indev_mac(binding):
             logging.debug(" - DHCPv6: Could not get MAC for %s", binding)
             return
-        ifll = subnet.make_ll64(indevmac)
-        if ifll is None:
-            return
 
-        ofll = subnet.make_ll64(binding.mac)
-        if ofll is None:
+        if DHCP6_InfoRequest not in pkt or DHCP6OptClientId not in pkt:
+            logging.debug(" - DHCPv6: Ignoring unsupported request from %s",
+                          binding)
             return
 
         logging.debug(" - DHCPv6: Generating response for %s", binding)
 
-        if self.dhcpv6_domains:
-            domains = self.dhcpv6_domains
-        else:
-            domains = [binding.hostname.split('.', 1)[-1]]
+        eth, src, dst, options = self.get_dhcpv6_reply_parts(binding)
 
-        # We do this in order not to caclulate optlen ourselves
-        dnsdomains = str(DHCP6OptDNSDomains(dnsdomains=domains))
-        dnsservers = str(DHCP6OptDNSServers(dnsservers=self.ipv6_nameservers))
+        # Echo the client identifier option as received
+        clientid = pkt[DHCP6OptClientId]
+        clientid = str(clientid)[:4 + clientid.optlen]
 
-        resp = (Ether(src=indevmac, dst=binding.mac) /
-                IPv6(tc=192, src=str(ifll), dst=str(ofll)) /
-                UDP(sport=pkt.dport, dport=pkt.sport) /
-                DHCP6_Reply(trid=pkt[DHCP6_InfoRequest].trid) /
-                DHCP6OptClientId(duid=pkt[DHCP6OptClientId].duid) /
-                DHCP6OptServerId(duid=DUID_LLT(lladdr=indevmac,
-                                               timeval=time.time())) /
-                DHCP6OptDNSDomains(dnsdomains) /
-                DHCP6OptDNSServers(dnsservers))
+        reply = (struct.pack("!I", DHCP6_REPLY << 24 |
+                             pkt[DHCP6_InfoRequest].trid) +
+                 clientid + options)
+        resp = ipv6_udp_frame(eth, src, dst, pkt.dport, pkt.sport, reply,
+                              tc=192)
 
         logging.info(" - DHCPv6: Response for %s", binding)
         try:
-            binding.sendp(resp)
+            self.transmit.send(binding, resp)
         except socket.error as e:
             logging.warn(" - DHCPv6: Response on %s failed: %s",
                          binding, str(e))
@@ -329,6 +719,44 @@ class VMNetProxy(object):  # pylint: disable=R0902
             logging.warn(" - DHCPv6: Unkown error during response on %s: %s",
                          binding, str(e))
 
+    def get_server_duid(self, indevmac):
+        """ Returns the encoded DHCPv6 Server Identifier option for an
+        interface
+
+        A DUID-LL is used, so that the identifier is stable for as long as
+        the interface keeps its hardware address.
+
+        """
+        with self.lock:
+            opt = self.server_duids.get(indevmac)
+        if opt is None:
+            opt = str(DHCP6OptServerId(duid=DUID_LL(lladdr=indevmac)))
+            with self.lock:
+                self.server_duids[indevmac] = opt
+        return opt
+
+    def get_dhcpv6_reply_parts(self, binding):
+        """ Returns the parts of a DHCPv6 reply to a binding that do not
+        depend on the request, encoding them on first use
+
+        """
+        parts = binding.get_reply_part("dhcpv6")
+        if parts is not None:
+            return parts
+
+        if self.dhcpv6_domains:
+            domains = self.dhcpv6_domains
+        else:
+            domains = [binding.hostname.split('.', 1)[-1]]
+
+        options = (self.get_server_duid(binding.indev_mac) +
+                   str(DHCP6OptDNSDomains(dnsdomains=domains)) +
+                   str(DHCP6OptDNSServers(dnsservers=self.ipv6_nameservers)))
+        parts = (ether_header(binding.indev_mac, binding.mac),
+                 binding.indev_ll_bytes, binding.ll64_bytes, options)
+        binding.set_reply_part("dhcpv6", parts)
+        return parts
+
     @staticmethod
     def get_addr_on_link(binding, af=AF_INET):
         """ For a given client and address family return either the gateway
@@ -355,39 +783,393 @@ class VMNetProxy(object):  # pylint: disable=R0902
         """
         logging.info("Cleaning up")
 
+        if self.snapshot_file:
+            logging.debug(" - Saving binding snapshot")
+            self.write_snapshot()
+
         logging.debug(" - Closing netfilter queues")
-        for q, _ in self.nfq.values():
-            q.close()
+        self.scheduler.close()
+        self.transmit.close()
+        if self.links:
+            self.links.close()
+        with self.segment_lock:
+            for sender in self.segment_senders.values():
+                sender.close_socket()
+            self.segment_senders.clear()
+        if self.neigh_offload:
+            # The neighbour entries are left in place, so that the kernel
+            # keeps answering while we are restarted
+            self.neigh_offload.close()
+
+        if self.workers:
+            logging.debug(" - Stopping reply workers")
+            self.workers.stop()
 
         logging.debug(" - Stopping inotify watches")
         self.notifier.stop()
 
+        if self.control:
+            logging.debug(" - Closing control socket")
+            self.control.close()
+
+        if self.binding_db:
+            logging.debug(" - Closing binding database")
+            self.binding_db.close()
+
         logging.info(" - Cleanup finished")
 
-    def _setup_nfqueue(self, queue_num, family, callback, pending):
+    def _setup_nfqueue(self, queue_num, family, callback, name):
         """ Sets a callback function on an netfilter queue
 
         """
         logging.info("Setting up NFQUEUE for queue %d, AF %s",
                      queue_num, family)
         q = nfqueue.queue()
-        q.set_callback(callback)
+        q.set_callback(self.scheduler.timed(name, callback))
         q.fast_open(queue_num, family)
         q.set_queue_maxlen(5000)
         # This is mandatory for the queue to operate
         q.set_mode(nfqueue.NFQNL_COPY_PACKET)
-        self.nfq[q.get_fd()] = (q, pending)
+        self.scheduler.add(q.get_fd(), q, name)
         logging.debug(" - Successfully set up NFQUEUE %d", queue_num)
 
+    def _setup_capture(self, iface, frames):
+        """ Captures requests on an interface (or all interfaces if iface is
+        None) instead of receiving them through NFQUEUE
+
+        """
+        cap = PacketCapture(iface, self.dispatch_captured, frames)
+        self.scheduler.add(cap.get_fd(), cap, "capture:%s" % (iface or "all"),
+                           "capture")
+
+    def dispatch_captured(self, payload):
+        """ Hands a captured request to the handler of its protocol
+
+        """
+        callback = self.capture_handlers.get(classify(payload.frame))
+        if callback is None:
+            self.count("capture_ignored")
+            return
+        if payload.ifindex not in self.clients:
+            # Captured on an interface that is not a tap, e.g. a port of a
+            # bridge other than the tap, so find the client by its MAC
+            binding = self.clients.get_alias(
+                unpack_mac(payload.get_hwaddr()))
+            if binding is not None:
+                payload.ifindex = binding.ifindex
+        callback(payload)
+
     def build_config(self):
         """ Loads config files of all clients"""
+        start = time.time()
         self.clients.clear()
+        self.file_stats.clear()
 
-        for path in glob.glob(os.path.join(self.data_path, "*")):
-            self.add_tap(path)
+        entries = None
+        if self.snapshot_file:
+            entries = load_snapshot(self.snapshot_file)
+
+        if entries is None:
+            for path in glob.glob(os.path.join(self.data_path, "*")):
+                self.add_tap(path)
+            # Nothing is being served yet, so load the manifests at once
+            self.process_config_changes(len(self.pending_changes))
+        else:
+            self.restore_snapshot(entries)
+
+        if self.binding_db:
+            self.load_binding_db()
 
+        self.clients.publish()
+        logging.info("Loaded %d bindings in %.2f seconds", len(self.clients),
+                     time.time() - start)
         self.print_clients()
 
+    def load_binding_db(self):
+        """ Loads all bindings of the binding database
+
+        """
+        try:
+            seq, bindings = self.binding_db.load()
+        except sqlite3.Error as e:
+            logging.error("Failed to load binding database: %s", str(e))
+            # Fetch all changes since the beginning on the first poll
+            self.schedule_binding_db_poll(0)
+            return
+
+        for data in bindings:
+            self.add_db_binding(data)
+        self.binding_db_seq = seq
+        self.schedule_binding_db_poll(self.binding_db_poll)
+
+    def schedule_binding_db_poll(self, delay):
+        """ (Re)schedules the next poll of the binding database
+
+        """
+        self.timers.cancel(self.binding_db_timer)
+        self.binding_db_timer = self.timers.schedule(delay,
+                                                     self.poll_binding_db)
+
+    def poll_binding_db(self):
+        """ Applies at most config_batch changes of the binding database
+
+        """
+        # Keep polling even if applying the changes fails
+        self.schedule_binding_db_poll(self.binding_db_poll)
+        try:
+            changes = self.binding_db.changes(self.binding_db_seq,
+                                              self.config_batch)
+        except sqlite3.Error as e:
+            if is_busy(e):
+                logging.debug("Binding database is locked, polling later")
+            else:
+                logging.warn("Failed to poll binding database: %s", str(e))
+            changes = []
+
+        deleted = False
+        for seq, tap, data in changes:
+            if data is None:
+                logging.debug(" - Binding of %s deleted from database", tap)
+                self.remove_tap(tap)
+                deleted = True
+            else:
+                self.add_db_binding(data)
+            self.binding_db_seq = seq
+
+        if deleted:
+            self.binding_db.prune_deletions(self.binding_db_seq)
+
+        if len(changes) == self.config_batch:
+            # There may be more, continue on the next tick
+            self.schedule_binding_db_poll(0)
+
+    def add_db_binding(self, data):
+        """ Adds a binding read from the binding database
+
+        """
+        try:
+            binding = BindingConfig.from_dict(data)
+            if self.add_binding(binding):
+                self.control_taps.discard(binding.tap)
+        except Exception as e:
+            logging.warn("Cannot add binding %s from database: %s", data,
+                         str(e))
+
+    def binding_db_changed(self):
+        """ Schedules an immediate poll of the binding database
+
+        """
+        self.schedule_binding_db_poll(0)
+
+    def restore_snapshot(self, entries):
+        """ Populates the client table from snapshot entries and schedules
+        the reconciliation of the binding files with it
+
+        """
+        logging.info("Restoring %d bindings from snapshot", len(entries))
+        for entry in entries:
+            try:
+                binding = BindingConfig.from_dict(entry["binding"])
+                if not self.add_binding(binding):
+                    continue
+                if entry.get("manifest"):
+                    path = entry["manifest"]
+                    taps = self.manifests.setdefault(path, {})
+                    taps[binding.tap] = entry["line"]
+                    self.file_stats[path] = tuple(entry["stat"])
+                elif entry["stat"] is None:
+                    # Added through the control socket
+                    self.control_taps.add(binding.tap)
+                else:
+                    path = os.path.join(self.data_path, binding.tap)
+                    self.file_stats[path] = tuple(entry["stat"])
+            except Exception as e:
+                logging.warn("Error while restoring snapshot entry %s: %s",
+                             entry, str(e))
+
+        self.schedule_reconciliation()
+        self.snapshot_dirty = False
+
+    def schedule_reconciliation(self):
+        """ Schedules a comparison of every binding file with the client
+        table, to be performed in batches from the main loop
+
+        """
+        paths = set(glob.glob(os.path.join(self.data_path, "*")))
+        paths.update(self.file_stats.keys())
+        logging.info("Scheduling reconciliation of %d binding files",
+                     len(paths))
+        self.reconcile_queue = collections.deque(sorted(paths))
+
+    def schedule_config_change(self, path):
+        """ Records a change on a binding file
+
+        Changes are applied after config_debounce seconds, so that a burst of
+        events on the same file results in a single reload.
+
+        """
+        if path not in self.pending_changes:
+            self.pending_changes[path] = time.time() + self.config_debounce
+
+    def sync_binding_file(self, path, force=False):
+        """ Brings the client table in line with a binding file
+
+        Unless forced, the file is reloaded only if its stat information
+        differs from the time it was last parsed.
+
+        """
+        stat = file_stat(path)
+        if stat is None:
+            if path in self.file_stats:
+                logging.debug(" - Binding file %s is gone", path)
+            if is_manifest(path):
+                self.file_stats.pop(path, None)
+                self.update_manifest(path, {})
+            else:
+                self.remove_tap(os.path.basename(path))
+        elif force or stat != self.file_stats.get(path):
+            self.add_tap(path)
+
+    def process_config_changes(self, budget=None):
+        """ Applies at most budget (config_batch by default) due
+        configuration changes
+
+        """
+        budget = budget or self.config_batch
+        now = time.time()
+        while budget and self.pending_changes:
+            key, due = next(self.pending_changes.iteritems())
+            if due > now:
+                break
+            del self.pending_changes[key]
+            if isinstance(key, tuple):
+                self.apply_manifest_entry(*key)
+            else:
+                self.sync_binding_file(key, force=True)
+            budget -= 1
+
+        while budget and self.reconcile_queue:
+            self.sync_binding_file(self.reconcile_queue.popleft())
+            budget -= 1
+            if not self.reconcile_queue:
+                logging.info("Reconciliation with %s finished",
+                             self.data_path)
+
+    def _config_timeout(self):
+        """ Returns the time until the next configuration change is due or
+        None if there is nothing pending
+
+        """
+        if self.reconcile_queue:
+            return 0
+        if self.pending_changes:
+            due = next(self.pending_changes.itervalues())
+            return max(0, due - time.time())
+        return None
+
+    def write_snapshot(self):
+        """ Writes a snapshot of the client table to the snapshot file
+
+        """
+        manifest_taps = {}
+        for path, taps in self.manifests.items():
+            for tap, line in taps.iteritems():
+                manifest_taps[tap] = (path, line)
+
+        entries = []
+        for binding in self.clients.values():
+            if binding.tap in manifest_taps:
+                path, line = manifest_taps[binding.tap]
+                entries.append({"binding": binding.to_dict(),
+                                "stat": self.file_stats.get(path),
+                                "manifest": path, "line": line})
+                continue
+            path = os.path.join(self.data_path, binding.tap)
+            stat = self.file_stats.get(path)
+            if stat is None and binding.tap not in self.control_taps:
+                continue
+            entries.append({"binding": binding.to_dict(), "stat": stat})
+
+        try:
+            save_snapshot(self.snapshot_file, entries)
+            self.snapshot_dirty = False
+        except (EnvironmentError, ValueError) as e:
+            logging.warn("Failed to write binding snapshot %s: %s",
+                         self.snapshot_file, str(e))
+
+    def add_control_binding(self, data):
+        """ Adds or updates a binding received through the control socket
+
+        Returns True if the binding was added.
+
+        """
+        if not isinstance(data, dict):
+            raise TypeError("Binding is not an object")
+        if not data.get("tap"):
+            raise ValueError("Binding without tap")
+        binding = BindingConfig.from_dict(data)
+        if not self.add_binding(binding):
+            return False
+        self.control_taps.add(binding.tap)
+        return True
+
+    def remove_control_binding(self, tap):
+        """ Removes a binding on request of the control socket
+
+        Bindings read from binding files or the database are left alone.
+
+        """
+        if tap not in self.control_taps:
+            raise ValueError("No binding of %s added through the control "
+                             "socket" % tap)
+        self.control_taps.discard(tap)
+        self.remove_tap(tap)
+
+    def replace_control_bindings(self, bindings):
+        """ Replaces all bindings added through the control socket
+
+        Returns the interfaces whose bindings could not be added.
+
+        """
+        if not isinstance(bindings, list):
+            raise TypeError("Bindings are not a list")
+        taps = set(str(data.get("tap")) for data in bindings
+                   if isinstance(data, dict))
+        for tap in self.control_taps - taps:
+            self.remove_control_binding(tap)
+
+        failed = []
+        for data in bindings:
+            try:
+                if self.add_control_binding(data):
+                    continue
+            except (ValueError, KeyError, TypeError) as e:
+                logging.warn("Invalid binding %s: %s", data, str(e))
+            failed.append(data.get("tap") if isinstance(data, dict)
+                          else data)
+        return failed
+
+    def find_bindings(self, tap=None, mac=None, ip=None):
+        """ Returns the bindings matching all the given criteria
+
+        """
+        if mac:
+            mac = mac.lower()
+            if self.mac_indexed_clients:
+                binding = self.clients.get(mac)
+                return [binding] if binding else []
+
+        ret = []
+        for binding in self.clients.values():
+            if tap and binding.tap != tap:
+                continue
+            if mac and binding.mac != mac:
+                continue
+            if ip and ip not in (binding.ip, binding.eui64):
+                continue
+            ret.append(binding)
+        return ret
+
     def get_ifindex(self, iface):
         """ Get the interface index from sysfs
 
@@ -453,43 +1235,173 @@ class VMNetProxy(object):  # pylint: disable=R0902
 
         return addr
 
+    def ensure_indev_mac(self, binding):
+        """ Returns the MAC address of the indev of a binding, retrying to
+        read it from sysfs if that failed so far
+
+        """
+        if binding.indev_mac is None and binding.indev:
+            path = os.path.abspath(os.path.join(SYSFS_NET, binding.indev,
+                                                "address"))
+            if not path.startswith(SYSFS_NET):
+                return None
+            try:
+                with open(path, "r") as f:
+                    addr = f.readline().strip()
+            except EnvironmentError:
+                addr = None
+            if addr:
+                logging.debug(" - Got MAC %s of %s", addr, binding.indev)
+                binding.set_indev_mac(addr)
+        return binding.indev_mac
+
+    def indev_address_changed(self, iface, addr):
+        """ Updates the bindings behind an interface whose MAC address
+        changed, e.g. a bridge that got or lost ports
+
+        """
+        for binding in self.clients.get_group(iface):
+            if binding.indev_mac != addr:
+                binding.set_indev_mac(addr)
+        # Server identifiers derived from the old address
+        with self.lock:
+            self.server_duids.clear()
+
     def add_tap(self, path):
         """ Add an interface to monitor
 
         """
+        if is_manifest(path):
+            self.load_manifest(path)
+            return
+
         try:
             tap = os.path.basename(path)
 
             logging.debug("Updating configuration for %s", tap)
+            stat = file_stat(path)
             binding = BindingConfig.load(path)
             if binding is None:
                 return
-            ifindex = self.get_ifindex(binding.tap)
-
-            if ifindex is None:
-                logging.warn(" - Stale configuration for %s found", tap)
-            else:
-                if binding.is_valid():
-                    if self.mac_indexed_clients:
-                        self.clients[binding.mac] = binding
-                        client = binding.mac
-                    else:
-                        self.clients[ifindex] = binding
-                        client = ifindex
-                    logging.debug(" - Added client %s. %s", client, binding)
+            if self.add_binding(binding):
+                # The binding file takes over from the control socket
+                self.control_taps.discard(tap)
+            self.file_stats[path] = stat
         except Exception as e:
             logging.warn("Error while adding interface from path %s: %s",
                          path, str(e))
 
+    def load_manifest(self, path):
+        """ Reads a manifest of bindings and schedules the entries that
+        changed since it was last loaded
+
+        """
+        stat = file_stat(path)
+        old = self.manifest_lines.get(path) or self.manifests.get(path, {})
+        try:
+            lines = read_manifest(path, dict((line, tap) for tap, line
+                                             in old.iteritems()))
+        except EnvironmentError as e:
+            logging.warn(" - Unable to read binding manifest %s: %s", path,
+                         str(e))
+            return
+
+        self.update_manifest(path, lines)
+        self.file_stats[path] = stat
+
+    def update_manifest(self, path, lines):
+        """ Schedules the entries of a manifest that differ from the loaded
+        ones, so that they are applied in batches like any binding file
+
+        """
+        self.manifest_lines[path] = lines
+        loaded = self.manifests.get(path, {})
+        changed = [tap for tap, line in lines.iteritems()
+                   if loaded.get(tap) != line]
+        removed = [tap for tap in loaded if tap not in lines]
+        now = time.time()
+        for tap in changed + removed:
+            self.pending_changes.setdefault((path, tap), now)
+        logging.info(" - Manifest %s: %d bindings, %d changed, %d removed",
+                     path, len(lines), len(changed), len(removed))
+
+    def apply_manifest_entry(self, path, tap):
+        """ Brings the binding of a tap in line with the last read version of
+        a manifest
+
+        """
+        lines = self.manifest_lines.get(path, {})
+        loaded = self.manifests.setdefault(path, {})
+        line = lines.get(tap)
+        if line is not None and loaded.get(tap) != line:
+            try:
+                binding = BindingConfig.from_dict(json.loads(line))
+                if self.add_binding(binding):
+                    # The tap may have moved here from another manifest or
+                    # have been added through the control socket
+                    for taps in self.manifests.values():
+                        taps.pop(tap, None)
+                    self.control_taps.discard(tap)
+                    loaded[tap] = line
+                    return
+            except Exception as e:
+                logging.warn(" - Cannot add binding for %s from %s: %s", tap,
+                             path, str(e))
+        if tap in loaded and loaded.get(tap) != line:
+            self.remove_tap(tap)
+
+        if not lines and not loaded:
+            # The manifest is gone and all its bindings with it
+            self.manifests.pop(path, None)
+            self.manifest_lines.pop(path, None)
+
+    def add_binding(self, binding):
+        """ Register a parsed binding in the client table
+
+        Returns True if the binding was added.
+
+        """
+        ifindex = self.get_ifindex(binding.tap)
+
+        if ifindex is None:
+            logging.warn(" - Stale configuration for %s found", binding.tap)
+            return False
+
+        if not binding.is_valid():
+            return False
+
+        binding.ifindex = ifindex
+        if binding.indev:
+            # Derived once here instead of reading sysfs on every reply
+            binding.set_indev_mac(self.get_iface_hw_addr(binding.indev))
+        if self.mac_indexed_clients:
+            self.clients[binding.mac] = binding
+            client = binding.mac
+        else:
+            self.clients[ifindex] = binding
+            client = ifindex
+        self.snapshot_dirty = True
+        if self.neigh_offload:
+            self.neigh_offload.add(binding)
+        logging.debug(" - Added client %s. %s", client, binding)
+        return True
+
     def remove_tap(self, tap):
         """ Cleanup clients on a removed interface
 
         """
+        self.file_stats.pop(os.path.join(self.data_path, tap), None)
+        for taps in self.manifests.values():
+            taps.pop(tap, None)
+        if self.neigh_offload:
+            self.neigh_offload.remove(tap)
         try:
             for k, cl in self.clients.items():
                 if cl.tap == tap:
-                    cl.socket.close()
+                    # The socket is closed once other threads are done with
+                    # the binding
                     del self.clients[k]
+                    self.snapshot_dirty = True
                     logging.info("Removed client %s. %s", k, cl)
         except KeyError:
             logging.error("Client on %s disappeared!!!", tap)
@@ -507,8 +1419,13 @@ class VMNetProxy(object):  # pylint: disable=R0902
             payload = arg2
         else:
             payload = arg1
+        data = payload.get_data()
+        indev = get_indev(payload)
+        if self.accept_unknown(payload, indev, data, raw_dhcp_mac):
+            return
+
         # Decode the response - NFQUEUE relays IP packets
-        pkt = IP(payload.get_data())
+        pkt = IP(data)
         # logging.debug(pkt.show())
 
         # Get the client MAC address
@@ -524,8 +1441,6 @@ class VMNetProxy(object):  # pylint: disable=R0902
         resp.op = "BOOTREPLY"
         del resp.payload
 
-        indev = get_indev(payload)
-
         binding = self.get_binding(indev, mac)
         if binding is None:
             # We don't know anything about this interface, so accept the packet
@@ -536,13 +1451,21 @@ class VMNetProxy(object):  # pylint: disable=R0902
         # Signal the kernel that it shouldn't further process the packet
         payload.set_verdict(nfqueue.NF_DROP)
 
+        self.dispatch_reply(self.dhcp_reply, binding, pkt, resp, mac)
+
+    def dhcp_reply(self, binding, pkt, resp, mac):  # pylint: disable=R0914
+        """ Generates and sends the reply to a DHCP request of a known client
+
+        """
         if mac != binding.mac and binding.macspoof is None:
             logging.debug(
                 " - DHCP: Received spoofed request from %s (and not %s)",
                 mac, binding)
             return
 
-        if not binding.ip:
+        # Unpacked once, the address is needed several times below
+        client_ip = binding.ip
+        if not client_ip:
             logging.debug(" - DHCP: No IP found in binding file %s.", binding)
             return
 
@@ -563,13 +1486,13 @@ class VMNetProxy(object):  # pylint: disable=R0902
         logging.debug(" - DHCP: Generating response for %s, src %s", binding,
                       dhcp_srv_ip)
 
-        resp = (Ether(dst=mac, src=self.get_iface_hw_addr(binding.indev)) /
-                IP(src=dhcp_srv_ip, dst=binding.ip) /
+        resp = (Ether(dst=mac, src=self.ensure_indev_mac(binding)) /
+                IP(src=dhcp_srv_ip, dst=client_ip) /
                 UDP(sport=pkt.dport, dport=pkt.sport) / resp)
         subnet = binding.net
 
         dhcp_options = []
-        requested_addr = binding.ip
+        requested_addr = client_ip
         for opt in pkt[DHCP].options:
             if isinstance(opt, tuple) and opt[0] == "message-type":
                 req_type = opt[1]
@@ -579,12 +1502,17 @@ class VMNetProxy(object):  # pylint: disable=R0902
         logging.info(" - DHCP: %s from %s",
                      DHCP_TYPES.get(req_type, "UNKNOWN"), binding)
 
+        # Retransmissions get the reply sent for the original request
+        cache_key = ("dhcp", pkt[BOOTP].xid, req_type, requested_addr)
+        if self.send_cached(binding, cache_key):
+            return
+
         if self.dhcp_domain:
             domainname = self.dhcp_domain
         else:
             domainname = binding.hostname.split('.', 1)[-1]
 
-        if req_type == DHCPREQUEST and requested_addr != binding.ip:
+        if req_type == DHCPREQUEST and requested_addr != client_ip:
             resp_type = DHCPNAK
             logging.info(
                 " - DHCP: Sending DHCPNAK to %s (because requested %s)",
@@ -592,15 +1520,21 @@ class VMNetProxy(object):  # pylint: disable=R0902
 
         elif req_type in (DHCPDISCOVER, DHCPREQUEST):
             resp_type = DHCP_REQRESP[req_type]
-            resp.yiaddr = binding.ip
+            resp.yiaddr = client_ip
+            if req_type == DHCPREQUEST and pkt[BOOTP].ciaddr == client_ip:
+                # Only renewing and rebinding clients fill in ciaddr
+                self.observe_renewal()
+            renewal, lifetime, rebinding = self.get_lease_times(binding)
             dhcp_options += [
                 ("hostname", binding.hostname),
                 ("domain", domainname),
-                ("broadcast_address", str(subnet.broadcast)),
-                ("subnet_mask", str(subnet.netmask)),
-                ("renewal_time", self.lease_renewal),
-                ("lease_time", self.lease_lifetime),
+                ("broadcast_address", subnet.broadcast),
+                ("subnet_mask", subnet.netmask),
+                ("renewal_time", renewal),
+                ("lease_time", lifetime),
             ]
+            if rebinding:
+                dhcp_options += [("rebinding_time", rebinding)]
             if subnet.gw and binding.private is None:
                 dhcp_options += [("router", subnet.gw)]
             if binding.mtu:
@@ -630,13 +1564,57 @@ class VMNetProxy(object):  # pylint: disable=R0902
 
         logging.info(" - DHCP: %s for %s", DHCP_TYPES[resp_type], binding)
         try:
-            binding.sendp(resp)
+            frame = str(resp)
+            self.transmit.send(binding, frame)
         except socket.error as e:
             logging.warn(" - DHCP: Response on %s failed: %s", binding, str(e))
         except Exception as e:
             logging.warn(
                 " - DHCP: Unkown error during DHCP response on %s: %s",
                 binding, str(e))
+        else:
+            self.reply_cache.put(binding, cache_key, frame)
+
+    def get_lease_times(self, binding):
+        """ Returns the renewal time (T1), lease time and rebinding time (T2,
+        or None for the client's default) to hand out to a client
+
+        With renewal jitter, the times are shortened by up to that fraction,
+        by an amount derived from the client's MAC, so that clients which got
+        their leases together spread their renewals over a window, while
+        every client keeps getting the same times.
+
+        """
+        if not self.renewal_jitter:
+            return self.lease_renewal, self.lease_lifetime, None
+
+        scale = 1 - self.renewal_jitter * client_hash(binding.mac)
+        renewal = max(1, int(self.lease_renewal * scale))
+        lifetime = max(renewal, int(self.lease_lifetime * scale))
+        rebinding = max(renewal, int(lifetime * 0.875))
+        return renewal, lifetime, rebinding
+
+    def observe_renewal(self):
+        """ Records the arrival of a lease renewal
+
+        The phase of the arrival within the renewal period shows whether
+        clients renew in lockstep, along with the peak renewals per second.
+
+        """
+        now = time.time()
+        second = int(now)
+        with self.lock:
+            self.stats["dhcp_renewals"] += 1
+            if self.lease_renewal:
+                self.renewal_phase.observe(
+                    (now % self.lease_renewal) / float(self.lease_renewal))
+
+            if second != self.renewal_second:
+                self.renewal_second = second
+                self.renewal_rate = 0
+            self.renewal_rate += 1
+            if self.renewal_rate > self.renewal_peak:
+                self.renewal_peak = self.renewal_rate
 
     def rs_response(self, arg1, arg2=None):  # pylint: disable=W0613
         """ Generates a reply to an ICMPv6 router solicitation
@@ -651,7 +1629,12 @@ class VMNetProxy(object):  # pylint: disable=R0902
             payload = arg2
         else:
             payload = arg1
-        pkt = IPv6(payload.get_data())
+        data = payload.get_data()
+        indev = get_indev(payload)
+        if self.accept_unknown(payload, indev, data, raw_rs_mac):
+            return
+
+        pkt = IPv6(data)
         # logging.debug(pkt.show())
         try:
             mac = ipv62mac(pkt.src)
@@ -660,8 +1643,6 @@ class VMNetProxy(object):  # pylint: disable=R0902
             logging.error(" - RS: Cannot obtain MAC in RS")
             return
 
-        indev = get_indev(payload)
-
         binding = self.get_binding(indev, mac)
         if binding is None:
             # We don't know anything about this interface, so accept the packet
@@ -672,6 +1653,15 @@ class VMNetProxy(object):  # pylint: disable=R0902
         # Signal the kernel that it shouldn't further process the packet
         payload.set_verdict(nfqueue.NF_DROP)
 
+        if self.shed_load(binding, "rs"):
+            return
+
+        self.dispatch_reply(self.rs_reply, binding, mac)
+
+    def rs_reply(self, binding, mac):
+        """ Generates and sends an RA in reply to an RS of a known client
+
+        """
         if mac != binding.mac and binding.macspoof is None:
             logging.debug(
                 " - RS: Received spoofed request from %s (and not %s)",
@@ -684,44 +1674,52 @@ class VMNetProxy(object):  # pylint: disable=R0902
             logging.debug(" - RS: No IPv6 network assigned to %s", binding)
             return
 
-        indevmac = self.get_iface_hw_addr(binding.indev)
+        indevmac = self.ensure_indev_mac(binding)
         if not indevmac:
             logging.debug(" - RS: Could not get MAC for %s", binding)
             return
 
-        ifll = subnet.make_ll64(indevmac)
-        if ifll is None:
+        if self.send_cached(binding, ("rs",)):
+            binding.mark_answered("rs", SHED_WINDOW)
             return
 
         logging.debug(" - RS: Generating response for %s", binding)
 
-        # Enable Other Configuration Flag only when the DHCPv6 functionality is
-        # enabled
-        other_config = 1 if self.ipv6_mode == 'slaac+dhcpv6' else 0
-
-        resp = (Ether(src=indevmac) /
-                IPv6(src=str(ifll)) /
-                ICMPv6ND_RA(O=other_config, routerlifetime=14400) /
-                ICMPv6NDOptPrefixInfo(prefix=subnet.gw or str(subnet.prefix),
-                                      prefixlen=subnet.prefixlen,
-                                      R=1 if subnet.gw else 0))
-
-        if self.ipv6_nameservers:
-            resp /= ICMPv6NDOptRDNSS(dns=self.ipv6_nameservers,
-                                     lifetime=self.ra_period * 3)
-        if binding.mtu:
-            resp /= ICMPv6NDOptMTU(mtu=binding.mtu)
+        resp = self.build_ra(binding)
 
         logging.info(" - RS: Sending RA for %s", binding)
 
         try:
-            binding.sendp(resp)
+            frame = str(resp)
+            self.transmit.send(binding, frame)
         except socket.error as e:
             logging.warn(" - RS: RA failed on %s: %s",
                          binding, str(e))
         except Exception as e:
             logging.warn(" - RS: Unkown error during RA on %s: %s",
                          binding, str(e))
+        else:
+            self.reply_cache.put(binding, ("rs",), frame)
+            binding.mark_answered("rs", SHED_WINDOW)
+
+    def send_cached(self, binding, key):
+        """ Sends the reply recently sent for the same request again
+
+        Returns False if there is no such reply in the cache.
+
+        """
+        frame = self.reply_cache.get(binding, key)
+        if frame is None:
+            return False
+
+        logging.debug(" - Resending cached reply %s to %s", key, binding)
+        self.count("replies_reused")
+        try:
+            self.transmit.send(binding, frame)
+        except Exception as e:
+            logging.warn(" - Resending cached reply to %s failed: %s",
+                         binding, str(e))
+        return True
 
     def ns_response(self, arg1, arg2=None):  # pylint: disable=W0613
         """ Generate a reply to an ICMPv6 neighbour solicitation
@@ -738,7 +1736,19 @@ class VMNetProxy(object):  # pylint: disable=R0902
         else:
             payload = arg1
 
-        ns = IPv6(payload.get_data())
+        data = payload.get_data()
+        indev = get_indev(payload)
+        if self.accept_unknown(payload, indev, data, raw_ns_mac):
+            return
+
+        binding = None
+        if self.neigh_offload:
+            # Looked up before dissecting and reused below
+            binding = self.get_binding(indev, raw_ns_mac(data))
+            if self.ns_offloaded(payload, binding, data):
+                return
+
+        ns = IPv6(data)
         # logging.debug(ns.show())
         try:
             mac = ns.lladdr
@@ -747,9 +1757,8 @@ class VMNetProxy(object):  # pylint: disable=R0902
             logging.debug(" - NS: LLaddr not contained in NS. Ignoring.")
             return
 
-        indev = get_indev(payload)
-
-        binding = self.get_binding(indev, mac)
+        if binding is None:
+            binding = self.get_binding(indev, mac)
         if binding is None:
             # We don't know anything about this interface, so accept the packet
             # and return and let the kernel handle it
@@ -758,6 +1767,33 @@ class VMNetProxy(object):  # pylint: disable=R0902
 
         payload.set_verdict(nfqueue.NF_DROP)
 
+        if self.shed_load(binding, ("ns", ns.tgt)):
+            return
+
+        self.dispatch_reply(self.ns_reply, binding, ns, mac)
+
+    def ns_offloaded(self, payload, binding, data):
+        """ Accepts a raw NS of a binding, before dissecting it, if the kernel
+        has a proxy entry for its target
+
+        Returns True if the packet was accepted.
+
+        """
+        target = raw_ns_target(data)
+        if target is None:
+            return False
+        if binding is None or \
+                not self.neigh_offload.offloaded(binding, target):
+            return False
+
+        self.count("ns_offloaded")
+        payload.set_verdict(nfqueue.NF_ACCEPT)
+        return True
+
+    def ns_reply(self, binding, ns, mac):
+        """ Generates and sends an NA in reply to an NS of a known client
+
+        """
         if mac != binding.mac and binding.macspoof is None:
             logging.debug(
                 " - NS: Received spoofed request from %s (and not %s)",
@@ -769,37 +1805,123 @@ class VMNetProxy(object):  # pylint: disable=R0902
             logging.debug(" - NS: No IPv6 network assigned to %s", binding)
             return
 
-        indevmac = self.get_iface_hw_addr(binding.indev)
+        indevmac = self.ensure_indev_mac(binding)
         if not indevmac:
             logging.debug(" - NS: Could not get MAC for %s", binding)
             return
+        ifll = binding.indev_ll
 
-        ifll = subnet.make_ll64(indevmac)
-        if ifll is None:
+        try:
+            tgt = socket.inet_pton(AF_INET6, ns.tgt)
+        except socket.error:
+            logging.debug(" - NS: Invalid target %s", ns.tgt)
             return
-
-        if not (subnet.net.overlaps(ns.tgt) or str(ns.tgt) == str(ifll)):
+        if not (subnet.contains(tgt) or tgt == binding.indev_ll_bytes):
             logging.debug(" - NS: Received NS for a non-routable IP (%s)",
                           ns.tgt)
-            return 1
+            return
 
         logging.debug(" - NS: Generating NA for %s", binding)
 
         resp = (Ether(src=indevmac, dst=binding.mac) /
-                IPv6(src=str(ifll), dst=ns.src) /
+                IPv6(src=ifll, dst=ns.src) /
                 ICMPv6ND_NA(R=1, O=0, S=1, tgt=ns.tgt) /
                 ICMPv6NDOptDstLLAddr(lladdr=indevmac))
 
         logging.info(" - NS: Sending NA for %s ", binding)
 
         try:
-            binding.sendp(resp)
+            self.transmit.send(binding, resp)
         except socket.error as e:
             logging.warn(" - NS: NA on %s failed: %s",
                          binding, str(e))
         except Exception as e:
             logging.warn(" - NS: Unkown error during NA to %s: %s",
                          binding, str(e))
+        else:
+            binding.mark_answered(("ns", ns.tgt), SHED_WINDOW)
+
+    def shed_load(self, binding, key):
+        """ Tells if a request should go unanswered because the queues are
+        backlogged and the same request of the client was recently answered
+
+        """
+        if not (self.load_shedding and self.scheduler.overloaded):
+            return False
+        if not binding.answered_within(key, SHED_WINDOW):
+            return False
+        logging.debug(" - Shedding request %s of %s", key, binding)
+        self.count("shed")
+        return True
+
+    def count(self, name):
+        """ Increments an event counter, from any thread
+
+        """
+        with self.lock:
+            self.stats[name] += 1
+
+    def dispatch_reply(self, func, *args):
+        """ Runs func(*args), which generates and sends a reply to the
+        binding given as the first argument, either inline or in the reply
+        worker pool
+
+        """
+        if self.link_down(args[0]):
+            logging.debug(" - Link of %s is down, not replying", args[0])
+            self.count("replies_link_down")
+            return
+        args[0].replies += 1
+
+        if self.workers is None:
+            func(*args)
+            return
+
+        # Keep the sockets of the bindings open until the worker is done
+        token = self.clients.acquire()
+        if not self.workers.submit(self._run_reply, token, func, args):
+            self.clients.release(token)
+            self.count("replies_dropped")
+            logging.debug(" - Reply queue full, dropping reply")
+
+    def _run_reply(self, token, func, args):
+        """ Runs a reply job in a worker
+
+        """
+        try:
+            func(*args)
+        finally:
+            self.clients.release(token)
+
+    def link_down(self, binding):
+        """ Tells if the tap of a binding is known to be down or without
+        carrier
+
+        """
+        return self.links is not None and \
+            not self.links.is_up(binding.ifindex)
+
+    def link_changed(self, ifindex, up):
+        """ Sends an RA right away to the clients of a tap that came up
+
+        """
+        if not (up and self.ipv6_mode):
+            return
+        binding = self.get_binding_by_ifindex(ifindex)
+        if binding is not None and binding.net6.net is not None and \
+                self.ensure_indev_mac(binding):
+            logging.info(" - RA: Sending RA to %s whose link came up",
+                         binding)
+            self.dispatch_reply(self.send_ra, binding)
+
+    def send_ra(self, binding):
+        """ Sends an unsolicited RA to a client
+
+        """
+        try:
+            self.transmit.send(binding, self.build_ra(binding))
+        except Exception as e:
+            logging.warn(" - RA: Failed on %s: %s", binding, str(e))
 
     def send_periodic_ra(self):
         """ Creates a thread that will send Router Advertisement packages to all
@@ -810,6 +1932,76 @@ class VMNetProxy(object):  # pylint: disable=R0902
         # many interfaces and we want to be responsive in the mean time
         threading.Thread(target=self._send_periodic_ra).start()
 
+    def build_ra(self, binding, multicast=False):
+        """ Builds an RA for a binding, or for all bindings of its segment if
+        multicast is True
+
+        """
+        subnet = binding.net6
+        # Enable Other Configuration Flag only when the DHCPv6
+        # functionality is enabled
+        other_config = 1 if self.ipv6_mode == 'slaac+dhcpv6' else 0
+
+        if multicast:
+            resp = (Ether(src=binding.indev_mac, dst=ALL_NODES_MAC) /
+                    IPv6(src=binding.indev_ll, dst=ALL_NODES))
+        else:
+            resp = (Ether(src=binding.indev_mac) /
+                    IPv6(src=binding.indev_ll))
+        resp /= (ICMPv6ND_RA(O=other_config, routerlifetime=14400) /
+                 ICMPv6NDOptPrefixInfo(prefix=subnet.gw or subnet.prefix,
+                                       prefixlen=subnet.prefixlen,
+                                       R=1 if subnet.gw else 0))
+        if self.ipv6_nameservers:
+            resp /= ICMPv6NDOptRDNSS(dns=self.ipv6_nameservers,
+                                     lifetime=self.ra_period * 3)
+        if binding.mtu:
+            resp /= ICMPv6NDOptMTU(mtu=binding.mtu)
+        return resp
+
+    def group_segments(self, bindings):
+        """ Finds the bridged segments that can share a multicast RA
+
+        Returns a list of (indev, bindings) tuples for the segments and the
+        list of the remaining bindings, which need an RA each. A segment is an
+        indev other than the tap whose bindings all have the same IPv6
+        subnet, gateway and MTU.
+
+        """
+        by_indev = collections.defaultdict(list)
+        rest = []
+        for binding in bindings:
+            if binding.indev and binding.indev != binding.tap and \
+                    binding.private is None:
+                by_indev[binding.indev].append(binding)
+            else:
+                # Routed or isolated
+                rest.append(binding)
+
+        segments = []
+        for indev, members in by_indev.iteritems():
+            keys = set((b.subnet6, b.gateway6, b.mtu) for b in members)
+            if len(members) > 1 and len(keys) == 1:
+                segments.append((indev, members))
+            else:
+                rest.extend(members)
+        return segments, rest
+
+    def get_segment_sender(self, indev):
+        """ Returns the binding used for sending to all clients behind an
+        indev, creating it on first use
+
+        Called from the RA thread, so the senders are guarded by a lock.
+
+        """
+        with self.segment_lock:
+            try:
+                return self.segment_senders[indev]
+            except KeyError:
+                sender = BindingConfig(tap=indev)
+                self.segment_senders[indev] = sender
+                return sender
+
     def _send_periodic_ra(self):
         """ Sends Router Advertisement packages to all clients
 
@@ -817,49 +2009,55 @@ class VMNetProxy(object):  # pylint: disable=R0902
         logging.info(" * Periodic RA: Starting...")
         start = time.time()
         i = 0
-        for binding in self.clients.values():
-            # tap = binding.tap
-            indev = binding.indev
-            # mac = binding.mac
-            subnet = binding.net6
-            if subnet.net is None:
-                logging.debug(" - RA: Skipping %s", binding)
-                continue
-            indevmac = self.get_iface_hw_addr(indev)
-            if not indevmac:
-                logging.debug(" - RA: Could not get MAC for %s", binding)
-                return
-            ifll = subnet.make_ll64(indevmac)
-            if ifll is None:
-                continue
-
-            # Enable Other Configuration Flag only when the DHCPv6
-            # functionality is enabled
-            other_config = 1 if self.ipv6_mode == 'slaac+dhcpv6' else 0
+        multicast = 0
+        with self.clients.reader() as clients:
+            bindings = [b for b in clients.values() if b.net6.net is not None]
+            if self.ra_multicast:
+                segments, bindings = self.group_segments(bindings)
+            else:
+                segments = []
+
+            # One RA to all nodes of each bridged segment
+            for indev, members in segments:
+                binding = members[0]
+                if not self.ensure_indev_mac(binding):
+                    logging.debug(" - RA: Could not get MAC for %s", indev)
+                    bindings.extend(members)
+                    continue
+                sender = self.get_segment_sender(indev)
+                try:
+                    self.transmit.send(sender,
+                                       self.build_ra(binding, True))
+                    multicast += 1
+                except Exception as e:
+                    logging.warn(" - RA: Multicast RA on %s failed: %s",
+                                 indev, str(e))
+                    bindings.extend(members)
+                    continue
+                logging.debug(" - RA: Sent multicast RA on %s for %d "
+                              "clients", indev, len(members))
+                i += len(members)
 
-            resp = \
-                (Ether(src=indevmac) /
-                 IPv6(src=str(ifll)) /
-                 ICMPv6ND_RA(O=other_config, routerlifetime=14400) /
-                 ICMPv6NDOptPrefixInfo(prefix=subnet.gw or str(subnet.prefix),
-                                       prefixlen=subnet.prefixlen,
-                                       R=1 if subnet.gw else 0))
-            if self.ipv6_nameservers:
-                resp /= ICMPv6NDOptRDNSS(dns=self.ipv6_nameservers,
-                                         lifetime=self.ra_period * 3)
-            if binding.mtu:
-                resp /= ICMPv6NDOptMTU(mtu=binding.mtu)
+            for binding in bindings:
+                if not self.ensure_indev_mac(binding):
+                    logging.debug(" - RA: Could not get MAC for %s", binding)
+                    continue
+                if self.link_down(binding):
+                    logging.debug(" - RA: Link of %s is down", binding)
+                    continue
 
-            try:
-                binding.sendp(resp)
-            except socket.error as e:
-                logging.warn(" - RA: Failed on %s: %s",
-                             binding, str(e))
-            except Exception as e:
-                logging.warn(" - RA: Unkown error on %s: %s", binding, str(e))
-            i += 1
-        logging.info(" - RA: Sent %d RAs in %.2f seconds", i,
-                     time.time() - start)
+                try:
+                    self.transmit.send(binding,
+                                       self.build_ra(binding))
+                except socket.error as e:
+                    logging.warn(" - RA: Failed on %s: %s",
+                                 binding, str(e))
+                except Exception as e:
+                    logging.warn(" - RA: Unkown error on %s: %s", binding,
+                                 str(e))
+                i += 1
+        logging.info(" - RA: Sent RAs to %d clients (%d multicast) in %.2f "
+                     "seconds", i, multicast, time.time() - start)
 
     def serve(self):
         """ Safely perform the main loop, freeing all resources upon exit
@@ -880,22 +2078,45 @@ class VMNetProxy(object):  # pylint: disable=R0902
         # single select() loop ;-)
         iwfd = self.notifier._fd  # pylint: disable=W0212
 
-        start = time.time()
         if self.ipv6_mode:
-            timeout = self.ra_period
-            self.send_periodic_ra()
-        else:
-            timeout = None
+            self._ra_timer()
+        if self.snapshot_file and self.snapshot_interval:
+            self.timers.schedule(self.snapshot_interval, self._snapshot_timer)
+        if self.reply_cache.ttl:
+            self.timers.schedule(self.reply_cache.ttl,
+                                 self._reply_cache_timer)
+        if self.stats_interval:
+            self.timers.schedule(self.stats_interval, self._stats_timer)
 
         while True:
+            select_timeout = self.timers.next_timeout()
+            # Wake up for pending configuration changes
+            select_timeout = min_timeout(select_timeout,
+                                         self._config_timeout())
+
+            rfds = self.scheduler.fds() + [iwfd, self.transmit.wakeup_r]
+            if self.links:
+                rfds.append(self.links.fileno())
+            if self.neigh_offload:
+                rfds.append(self.neigh_offload.fileno())
+            # Taps with queued replies
+            wfds = self.transmit.write_fds()
+            if self.control:
+                rfds += self.control.read_fds()
+                wfds += self.control.write_fds()
+
             try:
-                rlist, _, xlist = select.select(self.nfq.keys() + [iwfd],
-                                                [], [], timeout)
+                rlist, wlist, xlist = select.select(rfds, wfds, [],
+                                                    select_timeout)
+                woken = time.time()
             except select.error as e:
                 if e[0] == errno.EINTR:
                     logging.debug("select() got interrupted")
                     continue
 
+            if self.watchdog:
+                self.watchdog.iteration_start()
+
             if xlist:
                 logging.warn("Warning: Exception on %s",
                              ", ".join([str(fd) for fd in xlist]))
@@ -908,28 +2129,94 @@ class VMNetProxy(object):  # pylint: disable=R0902
                     self.notifier.process_events()
                     rlist.remove(iwfd)
 
+                if self.transmit.wakeup_r in rlist:
+                    # Replies got queued, so the taps are in wfds now
+                    self.transmit.handle_wakeup()
+                    rlist.remove(self.transmit.wakeup_r)
+
+                if self.links and self.links.fileno() in rlist:
+                    self.links.handle_read()
+                    rlist.remove(self.links.fileno())
+
+                if self.neigh_offload and \
+                        self.neigh_offload.fileno() in rlist:
+                    self.neigh_offload.handle_read()
+                    rlist.remove(self.neigh_offload.fileno())
+
                 logging.debug("Pending requests on fds %s", rlist)
 
+            # Queues are served in order of priority, each up to its budget
+            self.scheduler.run(rlist, woken)
+
+            for fd in wlist:
+                if not self.transmit.handle_write(fd) and self.control:
+                    self.control.handle_write(fd)
+
+            if self.control:
                 for fd in rlist:
-                    try:
-                        q, num = self.nfq[fd]
-                        cnt = q.process_pending(num)
-                        logging.debug(" * Processed %d requests on NFQUEUE"
-                                      " with fd %d", cnt, fd)
-                    except RuntimeError as e:
-                        logging.warn("Error processing fd %d: %s", fd, str(e))
-                    except Exception as e:
-                        logging.warn("Unknown error processing fd %d: %s",
-                                     fd, str(e))
-
-            if self.ipv6_mode:
-                # Calculate the new timeout
-                timeout = self.ra_period - (time.time() - start)
-
-                if timeout <= 0:
-                    start = time.time()
-                    self.send_periodic_ra()
-                    timeout = self.ra_period - (time.time() - start)
+                    if fd not in self.scheduler.queues:
+                        self.control.handle_read(fd)
+
+            # Configuration changes are applied in bounded batches after the
+            # pending requests, so that a provisioning storm cannot starve
+            # packet processing
+            self.process_config_changes()
+
+            # Periodic work: binding database polls, snapshots, RAs, ...
+            self.timers.advance()
+
+            # All changes of this iteration become visible to the other
+            # threads at once
+            self.clients.publish()
+
+            if self.watchdog:
+                self.watchdog.iteration_end()
+
+    def _ra_timer(self):
+        """ Sends the periodic RAs and schedules the next ones
+
+        """
+        self.timers.schedule(self.ra_period, self._ra_timer)
+        self.send_periodic_ra()
+
+    def _snapshot_timer(self):
+        """ Writes the snapshot if the client table changed and schedules
+        the next one
+
+        """
+        self.timers.schedule(self.snapshot_interval, self._snapshot_timer)
+        if self.snapshot_dirty:
+            self.write_snapshot()
+
+    def _reply_cache_timer(self):
+        """ Drops the expired cached replies
+
+        """
+        self.timers.schedule(self.reply_cache.ttl, self._reply_cache_timer)
+        self.reply_cache.expire()
+
+    def _stats_timer(self):
+        """ Logs how long requests wait and how long they take to handle
+
+        """
+        self.timers.schedule(self.stats_interval, self._stats_timer)
+        self.scheduler.log_timings()
+
+    def dump_clients(self):
+        """ Dumps the client table from a background thread, to the dump file
+        if there is one or else to the log
+
+        """
+        if self.dumper:
+            self.dumper.request()
+        else:
+            threading.Thread(target=self.print_clients).start()
+
+    def get_client_states(self):
+        """ Returns the state of every client, as found in the dump file
+
+        """
+        return client_states(self.clients.snapshot())
 
     def print_clients(self):
         """ Prints the registered clients
@@ -937,6 +2224,48 @@ class VMNetProxy(object):  # pylint: disable=R0902
         """
         logging.info("%10s   %20s %20s %10s %20s %40s",
                      'Key', 'Client', 'MAC', 'TAP', 'IP', 'IPv6')
-        for k, cl in self.clients.items():
+        seen = set()
+        size = 0
+        clients = self.clients.snapshot()
+        for k, cl in clients.items():
             logging.info("%10s | %20s %20s %10s %20s %40s",
                          k, cl.hostname, cl.mac, cl.tap, cl.ip, cl.eui64)
+            size += cl.memory_usage(seen)
+        size += sys.getsizeof(clients)
+        logging.info("Client table: %d bindings using %d bytes (%d bytes per "
+                     "binding)", len(clients), size,
+                     size / max(len(clients), 1))
+        with self.lock:
+            counters = sorted(self.stats.items())
+        if counters:
+            logging.info("Counters: %s", ", ".join(
+                "%s=%d" % kv for kv in counters))
+        if self.watchdog:
+            logging.info("Main loop lag: %s", self.watchdog.lag)
+        if self.renewal_phase.count:
+            logging.info("Renewal phase: %s, peak %d renewals/s",
+                         self.renewal_phase, self.renewal_peak)
+        self.scheduler.log_timings()
+
+    def get_stats(self):
+        """ Returns the counters and measurements of the server
+
+        """
+        with self.lock:
+            ret = {"counters": dict(self.stats), "clients": len(self.clients),
+                   "renewal_phase": self.renewal_phase.to_dict(),
+                   "renewal_peak_rate": self.renewal_peak}
+        if self.watchdog:
+            ret.update(self.watchdog.to_dict())
+        if self.workers:
+            ret["reply_workers"] = self.workers.to_dict()
+        ret["scheduler"] = self.scheduler.to_dict()
+        ret["client_table"] = self.clients.to_dict()
+        ret["transmit"] = self.transmit.to_dict()
+        ret["reply_cache"] = self.reply_cache.to_dict()
+        ret["timers"] = self.timers.to_dict()
+        if self.links:
+            ret["links"] = self.links.to_dict()
+        if self.neigh_offload:
+            ret["proxy_ndp"] = self.neigh_offload.to_dict()
+        return ret
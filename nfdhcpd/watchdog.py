@@ -0,0 +1,99 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Module hosting the main loop stall watchdog"""
+
+import sys
+import time
+import logging
+import threading
+import traceback
+
+from nfdhcpd.metrics import Histogram
+
+
+class LoopWatchdog(object):
+    """ Measures the duration of the main loop iterations and logs the stack
+    of the main thread whenever an iteration takes longer than threshold
+
+    """
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.lag = Histogram()
+        self.ident = threading.current_thread().ident
+        # Start time of the running iteration, None while waiting for events
+        self.busy_since = None
+        self.last_iteration = time.time()
+        self.stalls = 0
+        self._reported = None
+
+        self.thread = threading.Thread(target=self._run,
+                                       name="nfdhcpd-watchdog")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def iteration_start(self):
+        """ Marks the start of a main loop iteration
+
+        """
+        self.busy_since = time.time()
+
+    def iteration_end(self):
+        """ Marks the end of a main loop iteration
+
+        """
+        now = time.time()
+        if self.busy_since is None:
+            return
+        duration = now - self.busy_since
+        self.busy_since = None
+        self.last_iteration = now
+        self.lag.observe(duration)
+        if duration > self.threshold:
+            logging.warn("Main loop iteration took %.3f seconds", duration)
+
+    def _run(self):
+        """ Checks periodically whether the main loop is stalled
+
+        """
+        while True:
+            time.sleep(self.threshold / 2.0)
+            busy_since = self.busy_since
+            if busy_since is None or busy_since == self._reported:
+                continue
+            stalled = time.time() - busy_since
+            if stalled < self.threshold:
+                continue
+
+            self._reported = busy_since
+            self.stalls += 1
+            frames = sys._current_frames()  # pylint: disable=W0212
+            frame = frames.get(self.ident)
+            stack = "".join(traceback.format_stack(frame)) if frame else ""
+            logging.warn("Main loop stalled for %.3f seconds in:\n%s",
+                         stalled, stack)
+
+    def to_dict(self):
+        """ Returns the watchdog measurements
+
+        """
+        return {
+            "loop_lag": self.lag.to_dict(),
+            "since_last_iteration": time.time() - self.last_iteration,
+            "busy": self.busy_since is not None,
+            "stalls": self.stalls,
+        }
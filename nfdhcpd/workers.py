@@ -0,0 +1,84 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Module hosting the pool of threads that generate and send replies"""
+
+import Queue
+import logging
+import threading
+
+DEFAULT_QUEUE_SIZE = 1000
+
+
+class ReplyWorkerPool(object):
+    """ A fixed number of threads running reply jobs from a bounded queue
+
+    """
+    def __init__(self, workers, queue_size=DEFAULT_QUEUE_SIZE):
+        self.queue = Queue.Queue(queue_size)
+        self.dropped = 0
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._run,
+                                 name="nfdhcpd-worker-%d" % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        logging.info("Started %d reply workers", workers)
+
+    def submit(self, func, *args):
+        """ Queues func(*args) for execution by a worker
+
+        Returns False if the job was dropped because the queue is full.
+
+        """
+        try:
+            self.queue.put_nowait((func, args))
+        except Queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def stop(self):
+        """ Makes all workers exit after the jobs queued so far
+
+        """
+        for _ in self.threads:
+            self.queue.put((None, None))
+        for t in self.threads:
+            t.join(1)
+
+    def _run(self):
+        """ Runs jobs until asked to stop
+
+        """
+        while True:
+            func, args = self.queue.get()
+            if func is None:
+                return
+            try:
+                func(*args)
+            except Exception as e:
+                logging.warn("Unknown error in reply worker: %s", str(e))
+
+    def to_dict(self):
+        """ Returns the state of the pool
+
+        """
+        return {"workers": len(self.threads),
+                "queued": self.queue.qsize(),
+                "dropped": self.dropped}
@@ -0,0 +1,139 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Tests for reading bindings from an SQLite database"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from nfdhcpd.binding_db import BindingDatabase, is_busy
+
+
+class BindingDatabaseTest(unittest.TestCase):
+    """ Changes a temporary database as a writer would and reads it back
+
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "bindings.db")
+        self.db = BindingDatabase(self.path)
+        self.writer = sqlite3.connect(self.path)
+
+    def tearDown(self):
+        self.writer.close()
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, sql, *args):
+        """ Runs a statement in its own transaction
+
+        """
+        self.writer.execute(sql, args)
+        self.writer.commit()
+
+    def add(self, tap, mac):
+        """ Inserts a binding
+
+        """
+        self.write("INSERT INTO bindings (tap, mac, ip) VALUES (?, ?, ?)",
+                   tap, mac, "10.0.0.1")
+
+    def test_load(self):
+        self.assertEqual(self.db.load(), (0, []))
+        self.add("tap0", "aa:00:00:00:00:01")
+        seq, bindings = self.db.load()
+        self.assertEqual(seq, 1)
+        self.assertEqual(len(bindings), 1)
+        self.assertEqual(bindings[0]["tap"], "tap0")
+        self.assertEqual(bindings[0]["mac"], "aa:00:00:00:00:01")
+        self.assertIsNone(bindings[0]["gateway"])
+        # Strings are returned as str, like the other binding sources do
+        self.assertIsInstance(bindings[0]["tap"], str)
+
+    def test_schema_is_kept(self):
+        self.add("tap0", "aa:00:00:00:00:01")
+        self.db.close()
+        self.db = BindingDatabase(self.path)
+        self.assertEqual(self.db.load()[0], 1)
+
+    def test_changes(self):
+        self.add("tap0", "aa:00:00:00:00:01")
+        self.add("tap1", "aa:00:00:00:00:02")
+        self.write("UPDATE bindings SET ip = ? WHERE tap = ?", "10.0.0.2",
+                   "tap0")
+        changes = self.db.changes(0, 10)
+        self.assertEqual([(seq, tap) for seq, tap, _ in changes],
+                         [(2, "tap1"), (3, "tap0")])
+        self.assertEqual(changes[1][2]["ip"], "10.0.0.2")
+        self.assertEqual(self.db.changes(3, 10), [])
+
+    def test_unrelated_update(self):
+        self.add("tap0", "aa:00:00:00:00:01")
+        self.write("UPDATE bindings SET seq = seq")
+        self.assertEqual(self.db.load()[0], 1)
+
+    def test_delete(self):
+        self.add("tap0", "aa:00:00:00:00:01")
+        self.write("DELETE FROM bindings WHERE tap = ?", "tap0")
+        self.assertEqual(self.db.changes(1, 10), [(2, "tap0", None)])
+
+    def test_rename(self):
+        self.add("tap0", "aa:00:00:00:00:01")
+        self.write("UPDATE bindings SET tap = ? WHERE tap = ?", "tap1",
+                   "tap0")
+        changes = self.db.changes(1, 10)
+        # The old tap is removed and the binding added under the new one
+        self.assertEqual([(tap, b is None) for _, tap, b in changes],
+                         [("tap0", True), ("tap1", False)])
+        self.assertLess(changes[0][0], changes[1][0])
+
+    def test_limit(self):
+        for i in range(3):
+            self.add("tap%d" % i, "aa:00:00:00:00:0%d" % i)
+        self.write("DELETE FROM bindings WHERE tap = ?", "tap0")
+        self.assertEqual([tap for _, tap, _ in self.db.changes(0, 2)],
+                         ["tap1", "tap2"])
+        self.assertEqual(self.db.changes(3, 2), [(4, "tap0", None)])
+
+    def test_prune_deletions(self):
+        self.add("tap0", "aa:00:00:00:00:01")
+        self.write("DELETE FROM bindings WHERE tap = ?", "tap0")
+        self.add("tap1", "aa:00:00:00:00:02")
+        self.write("DELETE FROM bindings WHERE tap = ?", "tap1")
+        self.db.prune_deletions(2)
+        self.assertEqual(self.db.changes(0, 10), [(4, "tap1", None)])
+
+    def test_is_busy(self):
+        self.assertTrue(is_busy(sqlite3.OperationalError(
+            "database is locked")))
+        self.assertFalse(is_busy(sqlite3.OperationalError("no such table")))
+        self.assertFalse(is_busy(ValueError("database is locked")))
+
+    def test_writer_does_not_block_reads(self):
+        self.writer.execute("BEGIN IMMEDIATE")
+        try:
+            self.writer.execute("INSERT INTO bindings (tap) VALUES ('tap0')")
+            # Uncommitted changes are not seen, but reading does not wait
+            self.assertEqual(self.db.changes(0, 10), [])
+        finally:
+            self.writer.rollback()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Tests for persisting the client table across restarts"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from nfdhcpd.binding_snapshot import file_stat, save_snapshot, \
+    load_snapshot
+
+
+class BindingSnapshotTest(unittest.TestCase):
+    """ Writes and reads snapshots in a temporary directory
+
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "snapshot")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, data):
+        """ Writes a snapshot file by hand
+
+        """
+        with open(self.path, "w") as f:
+            f.write(data)
+
+    def test_round_trip(self):
+        entries = [{"binding": {"tap": "tap0", "mtu": 1500},
+                    "stat": [1.5, 10, 42]}]
+        save_snapshot(self.path, entries)
+        self.assertEqual(load_snapshot(self.path), entries)
+        # No temporary files are left behind
+        self.assertEqual(os.listdir(self.tmpdir), ["snapshot"])
+
+    def test_replace(self):
+        save_snapshot(self.path, [{"binding": {"tap": "tap0"}}])
+        save_snapshot(self.path, [])
+        self.assertEqual(load_snapshot(self.path), [])
+
+    def test_failed_write(self):
+        save_snapshot(self.path, [])
+        # Sets cannot be serialized
+        self.assertRaises(TypeError, save_snapshot, self.path, [set()])
+        self.assertEqual(load_snapshot(self.path), [])
+        self.assertEqual(os.listdir(self.tmpdir), ["snapshot"])
+
+    def test_missing(self):
+        self.assertIsNone(load_snapshot(self.path))
+
+    def test_corrupt(self):
+        self.write('{"version": 1, "entries": [')
+        self.assertIsNone(load_snapshot(self.path))
+
+    def test_version(self):
+        self.write(json.dumps({"version": 2, "entries": []}))
+        self.assertIsNone(load_snapshot(self.path))
+        self.write(json.dumps([1]))
+        self.assertIsNone(load_snapshot(self.path))
+
+    def test_file_stat(self):
+        self.assertIsNone(file_stat(self.path))
+        self.write("tap0")
+        st = os.stat(self.path)
+        self.assertEqual(file_stat(self.path),
+                         (st.st_mtime, 4, st.st_ino))
+
+
+if __name__ == "__main__":
+    unittest.main()
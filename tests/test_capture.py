@@ -0,0 +1,131 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Tests for capturing requests with AF_PACKET sockets
+
+A DHCP request is injected through a port of a bridge in a private network
+namespace, so these tests need root and unshare(1).
+
+"""
+
+import os
+import sys
+import time
+import socket
+import struct
+import subprocess
+import unittest
+
+NETNS_ARG = "--in-netns"
+
+
+def dhcp_request(mac):
+    """ Returns an Ethernet frame carrying a DHCP request from mac
+
+    """
+    from nfdhcpd.encoding import checksum
+
+    bootp = struct.pack("!BBBBI", 1, 1, 6, 0, 0x1234) + "\0" * 20 + \
+        mac + "\0" * 202 + "\x63\x82\x53\x63\x35\x01\x01\xff"
+    udp = struct.pack("!HHHH", 68, 67, 8 + len(bootp), 0) + bootp
+    ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(udp), 0, 0, 64, 17,
+                     0, "\0" * 4, "\xff" * 4)
+    # Bridges may check the IPv4 header before passing the frame up
+    ip = ip[:10] + struct.pack("!H", checksum(ip)) + ip[12:]
+    return "\xff" * 6 + mac + "\x08\x00" + ip + udp
+
+
+def ifindex(iface):
+    """ Returns the index of an interface
+
+    """
+    return int(subprocess.check_output(
+        "ip -o link show %s" % iface, shell=True).split(":")[0])
+
+
+def capture(iface, frame):
+    """ Sends frame out of veth1 and returns the interface indexes it was
+    captured with on iface (all interfaces if None)
+
+    """
+    from nfdhcpd.capture import PacketCapture
+
+    def callback(payload):
+        # Other traffic, like DAD probes, may be captured as well
+        if payload.frame == frame:
+            seen.append(payload.get_physindev())
+
+    seen = []
+    cap = PacketCapture(iface, callback, 64)
+    out = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+    out.bind(("veth1", 0))
+    out.send(frame)
+    out.close()
+    time.sleep(0.2)
+    cap.process_pending(64)
+    cap.close()
+    return seen
+
+
+def run_in_netns():
+    """ Captures a request coming in from a bridge port and exits with a
+    non-zero status if it is not reported once, with the expected ifindex
+
+    """
+    subprocess.check_call("ip link add br0 type bridge && "
+                          "ip link add veth0 type veth peer name veth1 && "
+                          "ip link set veth0 master br0 && "
+                          "ip link set br0 up && ip link set veth0 up && "
+                          "ip link set veth1 up", shell=True)
+    # Wait for the port to start forwarding
+    time.sleep(0.5)
+    frame = dhcp_request("\x52\x54\x00\xab\xcd\xef")
+    port = ifindex("veth0")
+
+    seen = capture("veth0", frame)
+    assert seen == [port], (seen, port)
+
+    # The bridge passes the frame up as its own, so the server has to map
+    # the ifindex to a client through the source MAC
+    seen = capture("br0", frame)
+    assert seen == [ifindex("br0")], seen
+
+    # The copy seen on the bridge is not reported a second time
+    seen = capture(None, frame)
+    assert seen == [port], (seen, port)
+
+
+class PacketCaptureTest(unittest.TestCase):
+    """ Runs run_in_netns() in a fresh network namespace
+
+    """
+    def test_bridge_port_ifindex(self):
+        if os.geteuid() != 0:
+            self.skipTest("needs root")
+        try:
+            ret = subprocess.call(["unshare", "-n", sys.executable,
+                                   os.path.abspath(__file__), NETNS_ARG])
+        except OSError:
+            self.skipTest("needs unshare")
+        self.assertEqual(ret, 0)
+
+
+if __name__ == "__main__":
+    if NETNS_ARG in sys.argv:
+        run_in_netns()
+    else:
+        unittest.main()
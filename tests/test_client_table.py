@@ -0,0 +1,171 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Tests for the copy-on-write client table"""
+
+import operator
+import unittest
+
+from nfdhcpd.client_table import ClientTable
+
+
+class FakeBinding(object):
+    """ The attributes of a binding the client table uses
+
+    """
+    def __init__(self, mac, ifindex, indev="br0"):
+        self.mac = mac
+        self.ifindex = ifindex
+        self.indev = indev
+        self.socket = object()
+        self.closed = False
+
+    def close_socket(self):
+        """ Records that the socket was closed
+
+        """
+        self.closed = True
+        self.socket = None
+
+
+class ClientTableTest(unittest.TestCase):
+    """ Changes a table keyed by MAC and reads it as other threads would
+
+    """
+    def setUp(self):
+        self.released = []
+        self.table = ClientTable(on_release=self.released.append,
+                                 alias=operator.attrgetter("ifindex"),
+                                 group=operator.attrgetter("indev"))
+        self.a = FakeBinding("aa", 1)
+        self.b = FakeBinding("bb", 2)
+
+    def test_publish(self):
+        self.table["aa"] = self.a
+        # The main thread sees its changes before they are published
+        self.assertIs(self.table.get("aa"), self.a)
+        self.assertEqual(self.table.snapshot(), {})
+        self.table.publish()
+        self.assertEqual(self.table.snapshot(), {"aa": self.a})
+        self.assertEqual(self.table.generation, 1)
+
+    def test_published_table_is_not_modified(self):
+        self.table["aa"] = self.a
+        self.table.publish()
+        published = self.table.snapshot()
+        self.table["bb"] = self.b
+        del self.table["aa"]
+        self.assertEqual(published, {"aa": self.a})
+        self.assertEqual(len(self.table), 1)
+        self.assertIn("bb", self.table)
+
+    def test_no_changes(self):
+        self.table.publish()
+        self.assertEqual(self.table.generation, 0)
+
+    def test_release_removed(self):
+        self.table["aa"] = self.a
+        self.table.publish()
+        del self.table["aa"]
+        self.assertFalse(self.a.closed)
+        self.table.publish()
+        self.assertTrue(self.a.closed)
+        self.assertEqual(self.released, [self.a])
+
+    def test_release_replaced(self):
+        self.table["aa"] = self.a
+        self.table.publish()
+        self.table["aa"] = FakeBinding("aa", 1)
+        self.table.publish()
+        self.assertTrue(self.a.closed)
+
+    def test_readers_keep_bindings_open(self):
+        self.table["aa"] = self.a
+        self.table.publish()
+        token = self.table.acquire()
+        del self.table["aa"]
+        self.table.publish()
+        # The reader may still use the binding
+        self.assertFalse(self.a.closed)
+        self.assertEqual(self.table.to_dict(), {"generation": 2,
+                                                "readers": 1, "retired": 1})
+        self.table.release(token)
+        self.table.publish()
+        self.assertTrue(self.a.closed)
+        self.assertEqual(self.table.to_dict()["retired"], 0)
+
+    def test_newer_readers_do_not_delay_release(self):
+        self.table["aa"] = self.a
+        self.table.publish()
+        del self.table["aa"]
+        self.table.publish()
+        with self.table.reader() as table:
+            self.assertEqual(table, {})
+            self.table.release_retired()
+            self.assertTrue(self.a.closed)
+
+    def test_reader_context(self):
+        self.table["aa"] = self.a
+        self.table.publish()
+        with self.table.reader() as table:
+            del self.table["aa"]
+            self.table.publish()
+            self.assertIs(table["aa"], self.a)
+            self.assertFalse(self.a.closed)
+        self.table.publish()
+        self.assertTrue(self.a.closed)
+
+    def test_clear(self):
+        self.table["aa"] = self.a
+        self.table["bb"] = self.b
+        self.table.publish()
+        self.table.clear()
+        self.table.publish()
+        self.assertEqual(len(self.table), 0)
+        self.assertTrue(self.a.closed and self.b.closed)
+        self.assertIsNone(self.table.get_alias(1))
+        self.assertEqual(self.table.get_group("br0"), [])
+
+    def test_alias(self):
+        self.table["aa"] = self.a
+        self.assertIs(self.table.get_alias(1), self.a)
+        del self.table["aa"]
+        self.assertIsNone(self.table.get_alias(1))
+
+    def test_alias_taken_over(self):
+        self.table["aa"] = self.a
+        # A new binding on the same interface before the old one is gone
+        c = FakeBinding("cc", 1)
+        self.table["cc"] = c
+        del self.table["aa"]
+        self.assertIs(self.table.get_alias(1), c)
+
+    def test_group(self):
+        self.table["aa"] = self.a
+        self.table["bb"] = self.b
+        self.assertEqual(set(self.table.get_group("br0")),
+                         set([self.a, self.b]))
+        self.table["bb"] = FakeBinding("bb", 2, indev="br1")
+        self.assertEqual(self.table.get_group("br0"), [self.a])
+        self.assertEqual(len(self.table.get_group("br1")), 1)
+        del self.table["aa"]
+        self.assertEqual(self.table.get_group("br0"), [])
+        self.assertNotIn("br0", self.table.groups)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,148 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Tests for parsing and dispatching control requests"""
+
+import json
+import unittest
+
+from nfdhcpd.control import ControlServer
+
+
+class FakeBinding(object):
+    """ A binding as returned by find_bindings()
+
+    """
+    def __init__(self, tap):
+        self.tap = tap
+
+    def to_dict(self):
+        """ Returns the binding in the form of BindingConfig.to_dict()
+
+        """
+        return {"tap": self.tap}
+
+
+class FakeServer(object):
+    """ Records the calls of the control server
+
+    """
+    binding_db = None
+
+    def __init__(self):
+        self.calls = []
+
+    def add_control_binding(self, binding):
+        """ Accepts bindings with a tap
+
+        """
+        self.calls.append(("add", binding))
+        return "tap" in binding
+
+    def remove_control_binding(self, tap):
+        """ Records the removal
+
+        """
+        self.calls.append(("remove", tap))
+
+    def replace_control_bindings(self, bindings):
+        """ Fails all bindings
+
+        """
+        return [b.get("tap") for b in bindings]
+
+    def find_bindings(self, tap=None, mac=None, ip=None):
+        """ Finds a binding by tap
+
+        """
+        self.calls.append(("find", tap, mac, ip))
+        return [FakeBinding(tap)] if tap else []
+
+    def get_stats(self):
+        """ Fails like a bug would
+
+        """
+        raise AttributeError("bug")
+
+
+class ControlServerTest(unittest.TestCase):
+    """ Processes requests without a socket
+
+    """
+    def setUp(self):
+        self.server = FakeServer()
+        self.control = ControlServer.__new__(ControlServer)
+        self.control.server = self.server
+
+    def process(self, req):
+        """ Processes a request given as an object
+
+        """
+        return self.control.process(json.dumps(req))
+
+    def assertError(self, reply, error):  # pylint: disable=C0103
+        """ Checks that a request failed with error
+
+        """
+        self.assertEqual(reply, {"status": "error", "error": error})
+
+    def test_malformed(self):
+        for line in ["{", "[]", "42", '"op"', "{}", '["op"]']:
+            self.assertError(self.control.process(line),
+                             "Malformed request")
+
+    def test_unknown_op(self):
+        self.assertError(self.process({"op": "reboot"}), "Unknown op reboot")
+        self.assertError(self.process({"op": "_drop"}), "Unknown op _drop")
+
+    def test_add(self):
+        self.assertEqual(self.process({"op": "add",
+                                       "binding": {"tap": "tap0"}}),
+                         {"status": "ok"})
+        self.assertError(self.process({"op": "add", "binding": {}}),
+                         "Stale or invalid binding")
+        self.assertEqual(self.process({"op": "add"})["status"], "error")
+
+    def test_remove(self):
+        self.assertEqual(self.process({"op": "remove", "tap": "tap0"}),
+                         {"status": "ok"})
+        self.assertEqual(self.server.calls, [("remove", "tap0")])
+
+    def test_replace(self):
+        reply = self.process({"op": "replace", "bindings": [{"tap": "tap0"}]})
+        self.assertEqual(reply, {"status": "ok", "failed": ["tap0"]})
+
+    def test_get(self):
+        self.assertEqual(self.process({"op": "get", "tap": "tap0"}),
+                         {"status": "ok", "bindings": [{"tap": "tap0"}]})
+        self.assertEqual(self.server.calls, [("find", "tap0", None, None)])
+
+    def test_get_type_error(self):
+        self.assertError(self.process({"op": "get", "mac": ["aa"]}),
+                         "mac is not a string")
+        self.assertEqual(self.server.calls, [])
+
+    def test_no_database(self):
+        self.assertError(self.process({"op": "db_changed"}),
+                         "No binding database configured")
+
+    def test_internal_error(self):
+        self.assertError(self.process({"op": "stats"}), "Internal error")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,164 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Tests for reading binding manifests and applying them in batches"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import collections
+
+from nfdhcpd.binding_config import read_manifest, is_manifest, \
+    MANIFEST_SUFFIX
+from nfdhcpd.client_table import ClientTable
+from nfdhcpd.vm_net_proxy import VMNetProxy
+
+
+def entry(tap, ip="10.0.0.1"):
+    """ Returns the manifest line of a binding
+
+    """
+    return json.dumps({"tap": tap, "mac": "aa:00:00:00:00:01", "ip": ip})
+
+
+class ReadManifestTest(unittest.TestCase):
+    """ Reads manifests from a temporary directory
+
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "vms" + MANIFEST_SUFFIX)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, *lines):
+        """ Writes the manifest
+
+        """
+        with open(self.path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def test_is_manifest(self):
+        self.assertTrue(is_manifest(self.path))
+        self.assertFalse(is_manifest(os.path.join(self.tmpdir, "tap0")))
+
+    def test_read(self):
+        self.write("# bindings", "", entry("tap0"), "  " + entry("tap1"))
+        self.assertEqual(read_manifest(self.path), {"tap0": entry("tap0"),
+                                                    "tap1": entry("tap1")})
+
+    def test_malformed(self):
+        self.write("{", "[1]", '{"mac": "aa"}', entry("tap0"))
+        self.assertEqual(read_manifest(self.path).keys(), ["tap0"])
+
+    def test_known_lines(self):
+        # Known lines are taken as is, without parsing them again
+        self.write(entry("tap0"), "not json")
+        self.assertEqual(read_manifest(self.path, {"not json": "tap1"}),
+                         {"tap0": entry("tap0"), "tap1": "not json"})
+
+    def test_missing(self):
+        self.assertRaises(EnvironmentError, read_manifest, self.path)
+
+
+class ManifestBatchTest(unittest.TestCase):
+    """ Applies manifest changes through a server with just the state
+    they touch
+
+    """
+    path = "/var/lib/nfdhcpd/vms" + MANIFEST_SUFFIX
+
+    def setUp(self):
+        self.proxy = VMNetProxy.__new__(VMNetProxy)
+        self.proxy.data_path = "/var/lib/nfdhcpd"
+        self.proxy.config_batch = 2
+        self.proxy.pending_changes = collections.OrderedDict()
+        self.proxy.reconcile_queue = collections.deque()
+        self.proxy.manifests = {}
+        self.proxy.manifest_lines = {}
+        self.proxy.control_taps = set()
+        self.proxy.file_stats = {}
+        self.proxy.neigh_offload = None
+        self.proxy.clients = ClientTable()
+        self.added = []
+        self.proxy.add_binding = self.add_binding
+
+    def add_binding(self, binding):
+        """ Records the binding instead of looking up its interface
+
+        """
+        self.added.append((binding.tap, binding.ip))
+        return binding.ip != "10.0.0.99"
+
+    def update(self, *lines):
+        """ Schedules a new version of the manifest and applies all of it
+
+        """
+        self.proxy.update_manifest(
+            self.path, dict((json.loads(l)["tap"], l) for l in lines))
+        while self.proxy.pending_changes:
+            self.proxy.process_config_changes()
+
+    def test_batches(self):
+        self.proxy.update_manifest(
+            self.path, dict(("tap%d" % i, entry("tap%d" % i))
+                            for i in range(5)))
+        self.assertEqual(len(self.proxy.pending_changes), 5)
+        self.proxy.process_config_changes()
+        self.assertEqual(len(self.added), 2)
+        self.assertEqual(len(self.proxy.pending_changes), 3)
+        self.proxy.process_config_changes(10)
+        self.assertEqual(len(self.added), 5)
+        self.assertEqual(len(self.proxy.manifests[self.path]), 5)
+
+    def test_only_changes(self):
+        self.update(entry("tap0"), entry("tap1"))
+        del self.added[:]
+        self.update(entry("tap0"), entry("tap1", "10.0.0.2"))
+        self.assertEqual(self.added, [("tap1", "10.0.0.2")])
+
+    def test_removed(self):
+        self.update(entry("tap0"), entry("tap1"))
+        self.update(entry("tap0"))
+        self.assertEqual(self.proxy.manifests[self.path].keys(), ["tap0"])
+
+    def test_manifest_gone(self):
+        self.update(entry("tap0"))
+        self.update()
+        self.assertEqual(self.proxy.manifests, {})
+        self.assertEqual(self.proxy.manifest_lines, {})
+
+    def test_failed_binding(self):
+        self.update(entry("tap0"))
+        self.update(entry("tap0", "10.0.0.99"))
+        # The stale binding is not kept around
+        self.assertEqual(self.proxy.manifests[self.path], {})
+
+    def test_takeover(self):
+        other = "/var/lib/nfdhcpd/more" + MANIFEST_SUFFIX
+        self.proxy.manifests[other] = {"tap0": entry("tap0")}
+        self.proxy.control_taps.add("tap0")
+        self.update(entry("tap0", "10.0.0.2"))
+        self.assertEqual(self.proxy.manifests[other], {})
+        self.assertEqual(self.proxy.control_taps, set())
+
+
+if __name__ == "__main__":
+    unittest.main()
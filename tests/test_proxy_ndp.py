@@ -0,0 +1,107 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Tests for offloading neighbor discovery to the kernel
+
+The entries are installed on a veth pair in a private network namespace,
+so these tests need root and unshare(1).
+
+"""
+
+import os
+import sys
+import socket
+import subprocess
+import unittest
+
+NETNS_ARG = "--in-netns"
+
+
+def run_in_netns():
+    """ Installs and removes the entries of a binding on a veth pair and
+    exits with a non-zero status on failure
+
+    """
+    from nfdhcpd.proxy_ndp import NeighbourOffload
+    from nfdhcpd.binding_config import BindingConfig
+
+    subprocess.check_call("ip link add veth0 type veth peer name veth1 && "
+                          "ip link set veth0 up && ip link set veth1 up",
+                          shell=True)
+    binding = BindingConfig(tap="veth0", indev="veth0",
+                            mac="52:54:00:ab:cd:ef",
+                            hostname="test", subnet6="2001:db8::/64",
+                            gateway6="2001:db8::1",
+                            eui64="2001:db8::5054:ff:feab:cdef")
+    binding.ifindex = int(subprocess.check_output(
+        "ip -o link show veth0", shell=True).split(":")[0])
+
+    offload = NeighbourOffload()
+    offload.add(binding)
+    offload.handle_read()
+    assert not offload.pending, offload.pending
+    proxy = subprocess.check_output("ip -6 neigh show proxy dev veth0",
+                                    shell=True)
+    neigh = subprocess.check_output("ip -6 neigh show dev veth0", shell=True)
+    assert "2001:db8::1" in proxy, proxy
+    assert "2001:db8::5054:ff:feab:cdef" in neigh, neigh
+    assert "52:54:00:ab:cd:ef" in neigh, neigh
+
+    gateway = socket.inet_pton(socket.AF_INET6, "2001:db8::1")
+    other = socket.inet_pton(socket.AF_INET6, "2001:db8::2")
+    assert offload.offloaded(binding, gateway)
+    assert not offload.offloaded(binding, other)
+
+    offload.remove("veth0")
+    offload.handle_read()
+    assert not offload.offloaded(binding, gateway)
+
+    # Bridged taps are left to nfdhcpd
+    bridged = BindingConfig(tap="veth1", indev="br0",
+                            mac="52:54:00:ab:cd:ee",
+                            hostname="test", subnet6="2001:db8::/64",
+                            gateway6="2001:db8::1")
+    bridged.ifindex = binding.ifindex + 1
+    offload.add(bridged)
+    assert not offload.offloaded(bridged, gateway)
+    assert "veth1" not in offload.entries, offload.entries
+    left = subprocess.check_output("ip -6 neigh show proxy dev veth0; "
+                                   "ip -6 neigh show dev veth0", shell=True)
+    assert "2001:db8" not in left, left
+    assert offload.to_dict()["errors"] == 0, offload.to_dict()
+
+
+class NeighbourOffloadTest(unittest.TestCase):
+    """ Runs run_in_netns() in a fresh network namespace
+
+    """
+    def test_entries_on_veth(self):
+        if os.geteuid() != 0:
+            self.skipTest("needs root")
+        try:
+            ret = subprocess.call(["unshare", "-n", sys.executable,
+                                   os.path.abspath(__file__), NETNS_ARG])
+        except OSError:
+            self.skipTest("needs unshare")
+        self.assertEqual(ret, 0)
+
+
+if __name__ == "__main__":
+    if NETNS_ARG in sys.argv:
+        run_in_netns()
+    else:
+        unittest.main()
@@ -0,0 +1,118 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Tests for the cache of recently sent replies"""
+
+import unittest
+
+from nfdhcpd import reply_cache
+from nfdhcpd.reply_cache import ReplyCache
+
+
+class FakeClock(object):
+    """ Stands in for the time module, advancing only when told to
+
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        """ Returns the fake time
+
+        """
+        return self.now
+
+
+class FakeBinding(object):
+    """ The attributes of a binding the cache uses
+
+    """
+    def __init__(self, tap):
+        self.tap = tap
+
+
+class ReplyCacheTest(unittest.TestCase):
+    """ Caches replies with a fake clock
+
+    """
+    def setUp(self):
+        self.clock = FakeClock()
+        self.orig_time = reply_cache.time
+        reply_cache.time = self.clock
+        self.cache = ReplyCache(ttl=2, size=3)
+        self.binding = FakeBinding("tap0")
+
+    def tearDown(self):
+        reply_cache.time = self.orig_time
+
+    def test_hit(self):
+        self.cache.put(self.binding, "offer", "frame")
+        self.assertEqual(self.cache.get(self.binding, "offer"), "frame")
+        self.assertIsNone(self.cache.get(self.binding, "ack"))
+        self.assertEqual(self.cache.to_dict(), {"entries": 1, "hits": 1,
+                                                "misses": 1})
+
+    def test_ttl(self):
+        self.cache.put(self.binding, "offer", "frame")
+        self.clock.now += 3
+        self.assertIsNone(self.cache.get(self.binding, "offer"))
+        # The stale entry is dropped on the miss
+        self.assertEqual(self.cache.to_dict()["entries"], 0)
+
+    def test_replaced_binding(self):
+        self.cache.put(self.binding, "offer", "frame")
+        self.assertIsNone(self.cache.get(FakeBinding("tap0"), "offer"))
+
+    def test_size(self):
+        for i in range(4):
+            self.cache.put(FakeBinding("tap%d" % i), "offer", str(i))
+        self.assertEqual(self.cache.to_dict()["entries"], 3)
+        self.assertNotIn(("tap0", "offer"), self.cache.entries)
+
+    def test_least_recently_used_first(self):
+        self.cache.put(self.binding, "offer", "frame")
+        self.cache.put(FakeBinding("tap1"), "offer", "1")
+        self.cache.put(FakeBinding("tap2"), "offer", "2")
+        self.cache.get(self.binding, "offer")
+        self.cache.put(FakeBinding("tap3"), "offer", "3")
+        self.assertEqual(self.cache.get(self.binding, "offer"), "frame")
+        self.assertNotIn(("tap1", "offer"), self.cache.entries)
+
+    def test_put_drops_old_entries(self):
+        self.cache.put(self.binding, "offer", "frame")
+        self.clock.now += 3
+        self.cache.put(FakeBinding("tap1"), "offer", "1")
+        self.assertEqual(self.cache.entries.keys(), [("tap1", "offer")])
+
+    def test_expire(self):
+        self.cache.put(self.binding, "offer", "frame")
+        self.clock.now += 1
+        self.cache.put(FakeBinding("tap1"), "offer", "1")
+        self.clock.now += 1.5
+        self.cache.expire()
+        self.assertEqual(self.cache.entries.keys(), [("tap1", "offer")])
+
+    def test_disabled(self):
+        cache = ReplyCache(ttl=0)
+        cache.put(self.binding, "offer", "frame")
+        self.assertIsNone(cache.get(self.binding, "offer"))
+        self.assertEqual(cache.to_dict(), {"entries": 0, "hits": 0,
+                                           "misses": 0})
+
+
+if __name__ == "__main__":
+    unittest.main()
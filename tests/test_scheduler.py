@@ -0,0 +1,183 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Tests for sharing the main loop among the netfilter queues"""
+
+import unittest
+
+from nfdhcpd.scheduler import QueueScheduler
+
+
+class FakeQueue(object):
+    """ A queue with a number of pending packets, recording the order it is
+    served in
+
+    """
+    def __init__(self, order, name, pending=0, error=None):
+        self.order = order
+        self.name = name
+        self.pending = pending
+        self.error = error
+        self.budgets = []
+        self.closed = False
+
+    def process_pending(self, budget):
+        """ Processes up to budget of the pending packets
+
+        """
+        self.order.append(self.name)
+        self.budgets.append(budget)
+        if self.error:
+            raise self.error
+        cnt = min(budget, self.pending)
+        self.pending -= cnt
+        return cnt
+
+    def close(self):
+        """ Records that the queue was closed
+
+        """
+        self.closed = True
+
+
+class FakePayload(object):
+    """ A packet received at a known time
+
+    """
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+
+    def get_timestamp(self):
+        """ Returns the reception time
+
+        """
+        return self.timestamp
+
+
+class QueueSchedulerTest(unittest.TestCase):
+    """ Runs rounds over fake queues
+
+    """
+    def setUp(self):
+        self.order = []
+        self.scheduler = QueueScheduler(budget=2)
+
+    def add(self, fd, name, pending=0, kind=None, error=None):
+        """ Schedules a fake queue
+
+        """
+        queue = FakeQueue(self.order, name, pending, error)
+        self.scheduler.add(fd, queue, name, kind)
+        return queue
+
+    def test_budgets(self):
+        dhcp = self.add(1, "dhcp", 100)
+        ns = self.add(2, "ns", 100)
+        rs = self.add(3, "rs-bridge", 100, kind="rs")
+        other = self.add(4, "other", 100)
+        self.scheduler.run([1, 2, 3, 4])
+        self.assertEqual(dhcp.budgets, [20])
+        self.assertEqual(ns.budgets, [2])
+        self.assertEqual(rs.budgets, [2])
+        self.assertEqual(other.budgets, [2])
+
+    def test_weights(self):
+        scheduler = QueueScheduler(budget=2, weights={"ns": 5})
+        queue = FakeQueue(self.order, "ns", 100)
+        scheduler.add(1, queue, "ns")
+        scheduler.run([1])
+        self.assertEqual(queue.budgets, [10])
+
+    def test_priorities(self):
+        self.add(1, "ns")
+        self.add(2, "rs")
+        self.add(3, "dhcpv6")
+        self.add(4, "dhcp")
+        self.scheduler.run([1, 2, 3, 4])
+        self.assertEqual(self.order, ["dhcp", "dhcpv6", "rs", "ns"])
+
+    def test_only_readable(self):
+        self.add(1, "dhcp")
+        self.add(2, "ns")
+        self.scheduler.run([2, 5])
+        self.assertEqual(self.order, ["ns"])
+
+    def test_overload(self):
+        self.add(1, "dhcp", 50)
+        self.add(2, "ns", 1)
+        self.scheduler.run([1, 2])
+        self.assertTrue(self.scheduler.overloaded)
+        self.scheduler.run([1, 2])
+        # Still backlogged, but it is the same overload
+        self.assertTrue(self.scheduler.overloaded)
+        self.scheduler.run([1])
+        self.assertFalse(self.scheduler.overloaded)
+        self.assertEqual(self.scheduler.overloads, 1)
+
+        state = self.scheduler.to_dict()
+        self.assertEqual(state["queues"]["dhcp"],
+                         {"priority": 0, "budget": 20, "processed": 50,
+                          "rounds": 3, "backlogged": 2})
+        self.assertEqual(state["queues"]["ns"]["backlogged"], 0)
+
+    def test_errors(self):
+        self.add(1, "dhcp", error=RuntimeError("failed"))
+        self.add(2, "ns", error=ValueError("failed"))
+        self.add(3, "rs", 1)
+        self.scheduler.run([1, 2, 3])
+        # A failing queue does not keep the others from being served
+        self.assertEqual(self.order, ["dhcp", "rs", "ns"])
+        self.assertEqual(self.scheduler.to_dict()["queues"]["dhcp"]["rounds"],
+                         0)
+        self.assertEqual(self.scheduler.to_dict()["queues"]["rs"]["rounds"],
+                         1)
+
+    def test_close(self):
+        queues = [self.add(1, "dhcp"), self.add(2, "ns")]
+        self.assertEqual(sorted(self.scheduler.fds()), [1, 2])
+        self.scheduler.close()
+        self.assertTrue(all(q.closed for q in queues))
+
+    def test_timed(self):
+        calls = []
+
+        def handle(*args):
+            calls.append(args)
+            return "verdict"
+
+        callback = self.scheduler.timed("dhcp", handle)
+        self.scheduler.woken = 0
+        payload = FakePayload(None)
+        self.assertEqual(callback(1, payload), "verdict")
+        self.assertEqual(calls, [(1, payload)])
+
+        timings = self.scheduler.to_dict()["timings"]["dhcp"]
+        self.assertEqual(timings["handler"]["count"], 1)
+        self.assertEqual(timings["wait"]["count"], 1)
+
+    def test_timed_error(self):
+        def fail(_):
+            raise ValueError("failed")
+
+        callback = self.scheduler.timed("dhcp", fail)
+        self.assertRaises(ValueError, callback, FakePayload(None))
+        # The time spent is measured anyway
+        self.assertEqual(self.scheduler.timings["dhcp"].handler.count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
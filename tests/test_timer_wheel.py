@@ -0,0 +1,106 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Tests for the timer wheel of the main loop"""
+
+import unittest
+
+from nfdhcpd import timer_wheel
+from nfdhcpd.timer_wheel import TimerWheel, RESOLUTION
+
+
+class FakeClock(object):
+    """ A clock that only moves when told to
+
+    """
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        """ Returns the current fake time
+
+        """
+        return self.now
+
+
+class TimerWheelTest(unittest.TestCase):
+    """ Runs the wheel the way the main loop does, sleeping exactly
+    next_timeout() seconds between calls to advance()
+
+    """
+    def setUp(self):
+        self.clock = FakeClock(1000000.0)
+        self.real_time = timer_wheel.time.time
+        timer_wheel.time.time = self.clock.time
+        self.wheel = TimerWheel()
+        self.fired = {}
+
+    def tearDown(self):
+        timer_wheel.time.time = self.real_time
+
+    def fire(self, name):
+        """ Records when a timer fired
+
+        """
+        self.fired[name] = self.clock.now
+
+    def run_until_idle(self):
+        """ Sleeps and advances the wheel until no timers are left
+
+        """
+        timeout = self.wheel.next_timeout()
+        while timeout is not None:
+            self.clock.now += timeout
+            self.wheel.advance()
+            timeout = self.wheel.next_timeout()
+
+    def test_fires_on_time(self):
+        start = self.clock.now
+        delays = (0, 0.3, 5, 12.8, 20, 300, 3000, 100000)
+        for delay in delays:
+            self.wheel.schedule(delay, self.fire, delay)
+        self.run_until_idle()
+
+        for delay in delays:
+            late = self.fired[delay] - (start + delay)
+            self.assertTrue(0 <= late <= RESOLUTION + 1e-6,
+                            "%ss timer fired %.3fs late" % (delay, late))
+
+    def test_periodic_timer_does_not_drift(self):
+        start = self.clock.now
+        runs = []
+
+        def periodic():
+            runs.append(self.clock.now)
+            if len(runs) < 10:
+                self.wheel.schedule(300, periodic)
+
+        self.wheel.schedule(300, periodic)
+        self.run_until_idle()
+        self.assertTrue(runs[-1] - (start + 3000) <= 10 * RESOLUTION + 1e-6)
+
+    def test_cancelled_timer_does_not_fire(self):
+        timer = self.wheel.schedule(20, self.fire, "cancelled")
+        self.wheel.schedule(30, self.fire, "kept")
+        self.wheel.cancel(timer)
+        self.run_until_idle()
+        self.assertEqual(self.fired.keys(), ["kept"])
+        self.assertEqual(self.wheel.to_dict()["timers"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,177 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Tests for the per-binding transmit queues"""
+
+import errno
+import socket
+import unittest
+
+from nfdhcpd.transmit import TransmitQueues
+
+
+class FakeSocket(object):
+    """ A socket failing sends with the errors it is told to
+
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        self.sent = []
+        self.errors = []
+
+    def fileno(self):
+        """ Returns the fake file descriptor
+
+        """
+        return self.fd
+
+    def send(self, data, flags=0):  # pylint: disable=W0613
+        """ Records data, unless an error is pending
+
+        """
+        if self.errors:
+            err = self.errors.pop(0)
+            raise socket.error(err, "fake")
+        self.sent.append(data)
+        return len(data)
+
+
+class FakeBinding(object):
+    """ The attributes of a binding the transmit queues use
+
+    """
+    def __init__(self, fd=10):
+        self.tap = "tap%d" % fd
+        self.socket = FakeSocket(fd)
+        self.txqueue = None
+        self.reopened = 0
+
+    def sendp(self, data):
+        """ Sends like BindingConfig.sendp() does
+
+        """
+        self.socket.send(data)
+
+    def reopen_socket(self, failed):
+        """ Replaces the failed socket with a new one
+
+        """
+        if self.socket is failed:
+            self.reopened += 1
+            self.socket = FakeSocket(failed.fd + 100)
+
+
+class TransmitQueuesTest(unittest.TestCase):
+    """ Sends frames to a fake binding
+
+    """
+    def setUp(self):
+        self.tx = TransmitQueues(queue_len=2)
+        self.binding = FakeBinding()
+
+    def tearDown(self):
+        self.tx.close()
+
+    def flush(self):
+        """ Does what the main loop does when the socket is writable
+
+        """
+        for fd in self.tx.write_fds():
+            self.tx.handle_write(fd)
+
+    def test_send(self):
+        self.tx.send(self.binding, "a")
+        self.assertEqual(self.binding.socket.sent, ["a"])
+        self.assertEqual(self.tx.write_fds(), [])
+
+    def test_queue_on_eagain(self):
+        sock = self.binding.socket
+        sock.errors = [errno.EAGAIN]
+        self.tx.send(self.binding, "a")
+        # Queued frames go out first, so b is queued too
+        self.tx.send(self.binding, "b")
+        self.assertEqual(sock.sent, [])
+        self.assertEqual(self.tx.write_fds(), [sock.fileno()])
+
+        self.flush()
+        self.assertEqual(sock.sent, ["a", "b"])
+        self.assertEqual(self.tx.write_fds(), [])
+        self.assertEqual(self.tx.to_dict(), {"pending": 0, "queued": 2,
+                                             "flushed": 2, "dropped": 0})
+
+    def test_still_busy(self):
+        sock = self.binding.socket
+        sock.errors = [errno.EAGAIN, errno.ENOBUFS]
+        self.tx.send(self.binding, "a")
+        self.flush()
+        # Stays queued until the socket takes it
+        self.assertEqual(self.tx.write_fds(), [sock.fileno()])
+        self.flush()
+        self.assertEqual(sock.sent, ["a"])
+        self.assertEqual(self.tx.write_fds(), [])
+
+    def test_queue_limit(self):
+        self.binding.socket.errors = [errno.EAGAIN]
+        for frame in "abcd":
+            self.tx.send(self.binding, frame)
+        self.assertEqual(list(self.binding.txqueue), ["a", "b"])
+        self.assertEqual(self.tx.to_dict()["dropped"], 2)
+
+    def test_no_queueing(self):
+        tx = TransmitQueues(queue_len=0)
+        self.binding.socket.errors = [errno.EAGAIN]
+        self.assertRaises(socket.error, tx.send, self.binding, "a")
+        self.assertEqual(tx.write_fds(), [])
+        tx.close()
+
+    def test_hard_error(self):
+        self.binding.socket.errors = [errno.ENETDOWN]
+        self.assertRaises(socket.error, self.tx.send, self.binding, "a")
+        self.assertEqual(self.tx.write_fds(), [])
+
+    def test_hard_error_while_flushing(self):
+        sock = self.binding.socket
+        sock.errors = [errno.EAGAIN, errno.ENETDOWN]
+        self.tx.send(self.binding, "a")
+        self.tx.send(self.binding, "b")
+        self.flush()
+        # The socket is replaced and the frames for the old one dropped
+        self.assertEqual(self.binding.reopened, 1)
+        self.assertIsNot(self.binding.socket, sock)
+        self.assertEqual(self.tx.write_fds(), [])
+        self.assertEqual(self.tx.to_dict()["dropped"], 2)
+
+        self.tx.send(self.binding, "c")
+        self.assertEqual(self.binding.socket.sent, ["c"])
+
+    def test_discard(self):
+        self.binding.socket.errors = [errno.EAGAIN]
+        self.tx.send(self.binding, "a")
+        self.tx.discard(self.binding)
+        self.assertEqual(self.tx.write_fds(), [])
+        self.assertEqual(self.tx.to_dict()["dropped"], 1)
+
+    def test_closed_socket(self):
+        self.binding.socket.errors = [errno.EAGAIN]
+        self.tx.send(self.binding, "a")
+        self.binding.socket = None
+        self.assertEqual(self.tx.write_fds(), [])
+        self.assertEqual(self.tx.to_dict()["dropped"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
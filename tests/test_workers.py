@@ -0,0 +1,109 @@
+# Copyright (c) 2010-2017 GRNET SA
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""Tests for generating replies in the reply worker pool"""
+
+import threading
+import collections
+import unittest
+
+from nfdhcpd.workers import ReplyWorkerPool
+from nfdhcpd.client_table import ClientTable
+from nfdhcpd.vm_net_proxy import VMNetProxy
+
+
+class FakeBinding(object):
+    """ The attributes of a binding dispatch_reply() uses
+
+    """
+    socket = None
+    ifindex = 1
+    replies = 0
+
+
+class FakePayload(object):
+    """ A queued packet recording its verdict
+
+    """
+    def __init__(self, events):
+        self.events = events
+
+    def set_verdict(self, verdict):
+        """ Records the verdict
+
+        """
+        self.events.append(("verdict", verdict))
+
+
+class DispatchReplyTest(unittest.TestCase):
+    """ Runs dispatch_reply() of a server with just a worker pool
+
+    """
+    def setUp(self):
+        self.proxy = VMNetProxy.__new__(VMNetProxy)
+        self.proxy.links = None
+        self.proxy.workers = ReplyWorkerPool(1, 1)
+        self.proxy.clients = ClientTable()
+        self.proxy.stats = collections.defaultdict(int)
+        self.proxy.lock = threading.Lock()
+        self.events = []
+        self.release = threading.Event()
+        self.done = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.proxy.workers.stop()
+
+    def slow_reply(self, binding):
+        """ A reply taking until the test lets it finish
+
+        """
+        self.release.wait(5)
+        self.events.append(("reply", binding))
+        self.done.set()
+
+    def handle(self, binding):
+        """ Does what the request handlers do once the binding is known
+
+        """
+        FakePayload(self.events).set_verdict(1)
+        self.proxy.dispatch_reply(self.slow_reply, binding)
+
+    def test_verdict_before_slow_reply(self):
+        binding = FakeBinding()
+        self.handle(binding)
+        # The next request gets its verdict while the reply is still built
+        self.handle(binding)
+        self.assertEqual(self.events, [("verdict", 1), ("verdict", 1)])
+        self.assertEqual(binding.replies, 2)
+
+        self.release.set()
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.events[2], ("reply", binding))
+
+    def test_full_queue_drops_replies(self):
+        binding = FakeBinding()
+        # One reply runs, one waits in the queue and the rest are dropped
+        for _ in range(4):
+            self.handle(binding)
+        self.assertGreaterEqual(self.proxy.stats["replies_dropped"], 1)
+        self.assertEqual(len([e for e in self.events if e[0] == "verdict"]),
+                         4)
+
+
+if __name__ == "__main__":
+    unittest.main()